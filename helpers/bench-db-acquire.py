@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+# Micro-benchmark for the latency of acquiring a database connection and
+# running a trivial query, comparing the old behaviour (setting up type
+# codecs on every acquire) with per-connection initialization.
+
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import asyncpg  # noqa: E402
+from janitor import state  # noqa: E402
+from janitor.config import read_config  # noqa: E402
+
+from benchutil import report, time_iterations  # noqa: E402
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--config', type=str, default='janitor.conf',
+    help='Path to configuration.')
+parser.add_argument(
+    '--database-location', type=str,
+    help='Database URL (overrides configuration).')
+parser.add_argument(
+    '--iterations', type=int, default=2000,
+    help='Number of acquire+query iterations per mode.')
+parser.add_argument(
+    '--query', type=str, default='SELECT 1',
+    help='Query to run on each iteration.')
+args = parser.parse_args()
+
+if args.database_location:
+    database_location = args.database_location
+else:
+    with open(args.config, 'r') as f:
+        database_location = read_config(f).database_location
+
+
+async def bench_per_acquire(url, iterations, query):
+    pool = await asyncpg.create_pool(url)
+
+    async def run(i):
+        async with pool.acquire() as conn:
+            await state.init_connection(conn)
+            await conn.fetchval(query)
+    try:
+        return await time_iterations(run, iterations)
+    finally:
+        await pool.close()
+
+
+async def bench_per_connection(url, iterations, query):
+    db = state.Database(url)
+    await db.warm_up()
+
+    async def run(i):
+        async with db.acquire() as conn:
+            await conn.fetchval(query)
+    try:
+        return await time_iterations(run, iterations)
+    finally:
+        await db.pool.close()
+
+
+async def main():
+    for name, bench in [
+            ('per-acquire', bench_per_acquire),
+            ('per-connection', bench_per_connection)]:
+        report(name, await bench(
+            database_location, args.iterations, args.query))
+
+
+asyncio.run(main())
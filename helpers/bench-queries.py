@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+# Benchmark the hot queries in janitor.state, janitor.debian.state and the
+# site modules against a database, e.g. one filled by
+# helpers/generate-synthetic-data.py.
+#
+# Results can be saved with --output and compared against a previous run with
+# --compare, to evaluate schema and index changes.
+
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from janitor import state  # noqa: E402
+from janitor.debian import state as debian_state  # noqa: E402
+
+from benchutil import summarize, time_iterations  # noqa: E402
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--database-location', type=str, required=True,
+    help='Database URL.')
+parser.add_argument(
+    '--iterations', type=int, default=20,
+    help='Number of iterations per query.')
+parser.add_argument(
+    '--filter', type=str,
+    help='Only run benchmarks whose name matches this regular expression.')
+parser.add_argument(
+    '--output', type=str,
+    help='Write results to this file (as JSON).')
+parser.add_argument(
+    '--compare', type=str,
+    help='Compare with results previously written with --output.')
+args = parser.parse_args()
+
+
+async def consume(ret):
+    """Fully evaluate the result of a query function."""
+    if inspect.isawaitable(ret):
+        ret = await ret
+    if hasattr(ret, '__aiter__'):
+        return len([x async for x in ret])
+    if ret is None:
+        return 0
+    try:
+        return len(ret)
+    except TypeError:
+        return 1
+
+
+async def sample_parameters(conn):
+    """Pick realistic arguments for the benchmarks from the database."""
+    row = await conn.fetchrow("""
+WITH successes AS (
+  SELECT run.id, run.package, run.suite, package.maintainer_email
+  FROM last_run
+  INNER JOIN run ON run.id = last_run.run_id
+  INNER JOIN package ON package.name = run.package
+  WHERE run.result_code = 'success')
+SELECT * FROM successes ORDER BY package, suite
+LIMIT 1 OFFSET (SELECT count(*) / 2 FROM successes)
+""")
+    if row is None:
+        raise Exception('no successful runs in database')
+    packages = [r[0] for r in await conn.fetch(
+        'SELECT name FROM package WHERE maintainer_email = $1',
+        row['maintainer_email'])]
+    tag = await conn.fetchval(
+        'SELECT tag FROM run_lintian_fix GROUP BY tag '
+        'ORDER BY count(*) DESC LIMIT 1')
+    hint = await conn.fetchval(
+        "SELECT jsonb_array_elements_text(result_applied_hint_links) "
+        "FROM run WHERE suite = 'multiarch-fixes' LIMIT 1")
+    return {
+        'run_id': row['id'],
+        'package': row['package'],
+        'suite': row['suite'],
+        'maintainer': row['maintainer_email'],
+        'packages': packages,
+        'tag': tag,
+        'hint': hint.split('#')[-1] if hint else None,
+    }
+
+
+def site_benchmarks():
+    """Benchmarks for the queries in the site modules."""
+    from janitor.site import lintian_fixes, multiarch_hints
+    from janitor.site.queue import iter_queue_with_last_run
+
+    return [
+        ('site.lintian_fixes.iter_lintian_tags',
+         lambda db, conn, p: lintian_fixes.iter_lintian_tags(conn)),
+        ('site.lintian_fixes.iter_last_successes_by_lintian_tag',
+         lambda db, conn, p:
+            lintian_fixes.iter_last_successes_by_lintian_tag(
+                conn, [p['tag']])),
+        ('site.lintian_fixes.iter_lintian_fixes_counts',
+         lambda db, conn, p: lintian_fixes.iter_lintian_fixes_counts(conn)),
+        ('site.lintian_fixes.generate_stats',
+         lambda db, conn, p: lintian_fixes.generate_stats(db)),
+        ('site.lintian_fixes.generate_developer_table_page',
+         lambda db, conn, p: lintian_fixes.generate_developer_table_page(
+             db, p['maintainer'])),
+        ('site.multiarch_hints.iter_hint_links',
+         lambda db, conn, p: multiarch_hints.iter_hint_links(conn)),
+        ('site.multiarch_hints.iter_last_successes_by_hint',
+         lambda db, conn, p: multiarch_hints.iter_last_successes_by_hint(
+             conn, p['hint'])),
+        ('site.queue.iter_queue_with_last_run',
+         lambda db, conn, p: iter_queue_with_last_run(db, limit=100)),
+    ]
+
+
+BENCHMARKS = [
+    ('state.get_run',
+     lambda db, conn, p: state.get_run(conn, p['run_id'])),
+    ('state.iter_runs(package)',
+     lambda db, conn, p: state.iter_runs(db, package=p['package'])),
+    ('state.iter_runs(limit)',
+     lambda db, conn, p: state.iter_runs(db, limit=100)),
+    ('state.iter_previous_runs',
+     lambda db, conn, p: state.iter_previous_runs(
+         conn, p['package'], p['suite'])),
+    ('state.get_last_unabsorbed_run',
+     lambda db, conn, p: state.get_last_unabsorbed_run(
+         conn, p['package'], p['suite'])),
+    ('state.iter_last_unabsorbed_runs(packages)',
+     lambda db, conn, p: state.iter_last_unabsorbed_runs(
+         conn, suite=p['suite'], packages=p['packages'])),
+    ('state.iter_last_runs(suite)',
+     lambda db, conn, p: state.iter_last_runs(
+         conn, suite=p['suite'], limit=100)),
+    ('state.iter_proposals(package)',
+     lambda db, conn, p: state.iter_proposals(conn, p['package'])),
+    ('state.iter_proposals(suite)',
+     lambda db, conn, p: state.iter_proposals(conn, suite=p['suite'])),
+    ('state.iter_publish_ready',
+     lambda db, conn, p: state.iter_publish_ready(
+         conn, suites=[p['suite']], limit=100)),
+    ('state.iter_queue',
+     lambda db, conn, p: state.iter_queue(conn, limit=100)),
+    ('state.get_queue_position',
+     lambda db, conn, p: state.get_queue_position(
+         conn, p['suite'], p['package'])),
+    ('state.queue_stats',
+     lambda db, conn, p: state.queue_stats(conn)),
+    ('state.queue_duration',
+     lambda db, conn, p: state.queue_duration(conn)),
+    ('state.stats_by_result_codes',
+     lambda db, conn, p: state.stats_by_result_codes(
+         conn, suite=p['suite'])),
+    ('state.get_never_processed_count',
+     lambda db, conn, p: state.get_never_processed_count(conn)),
+    ('state.iter_by_suite_result_code',
+     lambda db, conn, p: state.iter_by_suite_result_code(conn)),
+    ('state.iter_review_status',
+     lambda db, conn, p: state.iter_review_status(conn)),
+    ('debian_state.get_package',
+     lambda db, conn, p: debian_state.get_package(conn, p['package'])),
+    ('debian_state.iter_packages_by_maintainer',
+     lambda db, conn, p: debian_state.iter_packages_by_maintainer(
+         conn, p['maintainer'])),
+    ('debian_state.iter_candidates(suite)',
+     lambda db, conn, p: debian_state.iter_candidates(
+         conn, suite=p['suite'])),
+    ('debian_state.iter_candidates(packages)',
+     lambda db, conn, p: debian_state.iter_candidates(
+         conn, packages=p['packages'])),
+]
+
+
+async def run_benchmark(db, conn, params, fn, iterations):
+    # Warm up caches and prepared statements.
+    rows = await consume(fn(db, conn, params))
+    timings = await time_iterations(
+        lambda i: consume(fn(db, conn, params)), iterations)
+    result = summarize(timings)
+    result['rows'] = rows
+    return result
+
+
+async def main():
+    benchmarks = list(BENCHMARKS)
+    try:
+        benchmarks.extend(site_benchmarks())
+    except ImportError as e:
+        print('Skipping site benchmarks: %s' % e)
+    if args.filter:
+        benchmarks = [(name, fn) for (name, fn) in benchmarks
+                      if re.search(args.filter, name)]
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    else:
+        baseline = {}
+
+    db = state.Database(args.database_location)
+    results = {}
+    async with db.acquire() as conn:
+        params = await sample_parameters(conn)
+        print('%-55s %6s %9s %9s %9s %8s' % (
+            'benchmark', 'rows', 'mean', 'p50', 'p95', 'change'))
+        for name, fn in benchmarks:
+            result = await run_benchmark(
+                db, conn, params, fn, args.iterations)
+            results[name] = result
+            if name in baseline:
+                change = '%+7.1f%%' % (
+                    100 * (result['mean'] - baseline[name]['mean']) /
+                    baseline[name]['mean'])
+            else:
+                change = ''
+            print('%-55s %6d %7.2fms %7.2fms %7.2fms %8s' % (
+                name, result['rows'], 1000 * result['mean'],
+                1000 * result['p50'], 1000 * result['p95'], change))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+sys.exit(asyncio.run(main()))
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+# Micro-benchmark for the cost of storing a site session (i.e. a login) as
+# the number of sessions in the database grows. With --legacy, the trigger
+# that used to delete expired sessions on every insert is installed (and the
+# timestamp index dropped) for comparison.
+#
+# Everything happens in a transaction that is rolled back afterwards, so
+# this leaves the database unchanged.
+
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from janitor import state  # noqa: E402
+from janitor.config import read_config  # noqa: E402
+
+from benchutil import report, time_iterations  # noqa: E402
+
+
+LEGACY_TRIGGER = """\
+CREATE FUNCTION expire_site_session_delete_old_rows() RETURNS trigger
+  LANGUAGE PLPGSQL
+  AS
+$$
+BEGIN
+  DELETE FROM site_session WHERE timestamp < NOW() - INTERVAL '1 week';
+  RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER expire_site_session_delete_old_rows_trigger
+   AFTER INSERT ON site_session
+   EXECUTE PROCEDURE expire_site_session_delete_old_rows();
+
+DROP INDEX IF EXISTS site_session_timestamp_idx;
+"""
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--config', type=str, default='janitor.conf',
+    help='Path to configuration.')
+parser.add_argument(
+    '--database-location', type=str,
+    help='Database URL (overrides configuration).')
+parser.add_argument(
+    '--sessions', type=str, default='1000,10000,100000,1000000',
+    help='Comma-separated list of numbers of existing sessions.')
+parser.add_argument(
+    '--expired', type=float, default=0.1,
+    help='Fraction of the existing sessions that has expired.')
+parser.add_argument(
+    '--iterations', type=int, default=200,
+    help='Number of logins per session count.')
+parser.add_argument(
+    '--legacy', action='store_true',
+    help='Expire sessions on insert, like the old trigger did.')
+args = parser.parse_args()
+
+if args.database_location:
+    database_location = args.database_location
+else:
+    with open(args.config, 'r') as f:
+        database_location = read_config(f).database_location
+
+
+async def bench(conn, sessions, iterations):
+    await conn.execute("""
+INSERT INTO site_session (id, timestamp, userinfo)
+SELECT 'bench-' || i,
+  CASE WHEN i <= $2 THEN NOW() - INTERVAL '8 days'
+  ELSE NOW() - random() * INTERVAL '6 days' END,
+  '{"email": "user@example.com"}'
+FROM generate_series(1, $1) AS i""", sessions, int(sessions * args.expired))
+    await conn.execute('ANALYZE site_session')
+    if args.legacy:
+        await conn.execute(LEGACY_TRIGGER)
+
+    async def store(i):
+        await state.store_site_session(
+            conn, 'bench-login-%d' % i, {'email': 'user@example.com'})
+    return await time_iterations(store, iterations)
+
+
+async def main():
+    db = state.Database(database_location)
+    for sessions in map(int, args.sessions.split(',')):
+        async with db.acquire() as conn:
+            tr = conn.transaction()
+            await tr.start()
+            try:
+                timings = await bench(conn, sessions, args.iterations)
+            finally:
+                await tr.rollback()
+        report('%d sessions' % sessions, timings)
+
+
+asyncio.run(main())
@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+# Timing helpers shared by the benchmark scripts in this directory.
+
+import time
+
+
+async def time_iterations(fn, iterations):
+    """Time repeated calls of a coroutine function.
+
+    Args:
+      fn: Coroutine function, called with the iteration number
+      iterations: Number of iterations
+    Returns:
+      list with the time (in seconds) each iteration took
+    """
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        await fn(i)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def percentile(timings, p):
+    """Return the p-th percentile of a sorted list of timings."""
+    n = len(timings)
+    return timings[min(n - 1, (n * p) // 100)]
+
+
+def summarize(timings):
+    """Summarize timings.
+
+    Returns:
+      dictionary with the mean, median, 95th and 99th percentile
+    """
+    timings = sorted(timings)
+    return {
+        'mean': sum(timings) / len(timings),
+        'p50': percentile(timings, 50),
+        'p95': percentile(timings, 95),
+        'p99': percentile(timings, 99),
+    }
+
+
+def report(name, timings):
+    """Print a summary of timings."""
+    summary = summarize(timings)
+    print('%-16s mean %7.3fms  p50 %7.3fms  p99 %7.3fms' % (
+        name, 1000 * summary['mean'], 1000 * summary['p50'],
+        1000 * summary['p99']))
@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+# Fill an empty database (loaded with state.sql) with a synthetic dataset,
+# for evaluating queries, views and indexes at scale without access to the
+# production database. See also helpers/bench-queries.py.
+#
+# All data is generated server-side with generate_series, so large datasets
+# load in minutes. Triggers are disabled while loading (which requires
+# superuser access) and the tables they maintain are populated afterwards.
+
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import asyncpg  # noqa: E402
+from janitor import rollup, run_archive  # noqa: E402
+
+
+DEFAULT_RESULT_CODES = (
+    'success:30,nothing-to-do:30,nothing-new-to-do:10,build-failed:10,'
+    'dist-command-failed:5,worker-failure:5,install-deps-unsatisfied:5,'
+    'timeout:5')
+
+# Command to use for runs in each suite.
+SUITE_COMMANDS = {
+    'lintian-fixes': 'lintian-brush',
+    'fresh-releases': 'new-upstream',
+    'fresh-snapshots': 'new-upstream --snapshot',
+    'multiarch-fixes': 'apply-multiarch-hints',
+    'unchanged': 'just-build',
+}
+
+SUCCESS_RESULT = """\
+CASE $suite$
+  WHEN 'lintian-fixes' THEN jsonb_build_object(
+    'applied', jsonb_build_array(jsonb_build_object(
+      'summary', 'Fix tag', 'certainty', 'certain',
+      'fixed_lintian_tags', jsonb_build_array(
+        'tag-' || (j %% %(tags)d), 'tag-' || ((j * 7) %% %(tags)d)))),
+    'failed', '{}'::jsonb,
+    'versions', jsonb_build_object('lintian-brush', '0.' || (j %% 20)))
+  WHEN 'multiarch-fixes' THEN jsonb_build_object(
+    'applied-hints', jsonb_build_array(jsonb_build_object(
+      'binary', p.name, 'source', p.name, 'version', '1.0-1',
+      'severity', 'normal', 'certainty', 'certain',
+      'link', 'https://wiki.debian.org/MultiArch/Hints#hint-' ||
+      (j %% %(tags)d))))
+  WHEN 'fresh-releases' THEN jsonb_build_object(
+    'upstream_version', '2.' || j, 'old_upstream_version', '1.' || j,
+    'upstream_branch_url', 'https://example.com/' || p.name || '.git')
+  WHEN 'fresh-snapshots' THEN jsonb_build_object(
+    'upstream_version', '2.' || j || '+git', 'old_upstream_version', '1.' || j,
+    'upstream_branch_url', 'https://example.com/' || p.name || '.git')
+  ELSE '{}'::jsonb
+END"""
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--database-location', type=str, required=True,
+    help='Database URL. The schema should already be loaded.')
+parser.add_argument(
+    '--packages', type=int, default=30000,
+    help='Number of packages.')
+parser.add_argument(
+    '--suites', type=str, default=','.join(SUITE_COMMANDS),
+    help='Comma-separated list of suites.')
+parser.add_argument(
+    '--runs-per-package', type=int, default=20,
+    help='Average number of runs per package (across all suites).')
+parser.add_argument(
+    '--months', type=int, default=12,
+    help='Number of months of history to spread runs over.')
+parser.add_argument(
+    '--merge-proposals', type=int, default=10000,
+    help='Number of merge proposals.')
+parser.add_argument(
+    '--queue-size', type=int, default=100000,
+    help='Number of queue items.')
+parser.add_argument(
+    '--maintainers', type=int, default=2000,
+    help='Number of distinct maintainers.')
+parser.add_argument(
+    '--lintian-tags', type=int, default=200,
+    help='Number of distinct lintian tags (and multiarch hints).')
+parser.add_argument(
+    '--result-codes', type=str, default=DEFAULT_RESULT_CODES,
+    help='Comma-separated list of result_code:weight pairs.')
+parser.add_argument(
+    '--seed', type=float, default=0.5,
+    help='Seed for the random number generator (between -1 and 1).')
+args = parser.parse_args()
+
+suites = args.suites.split(',')
+result_codes = []
+weights = []
+for entry in args.result_codes.split(','):
+    code, weight = entry.split(':')
+    result_codes.append(code)
+    weights.append(float(weight))
+cumulative_weights = [
+    sum(weights[:i + 1]) / sum(weights) for i in range(len(weights))]
+cumulative_weights[-1] = 1.0
+
+
+async def step(conn, description, query, *args):
+    start = time.perf_counter()
+    status = await conn.execute(query, *args)
+    print('%-40s %-20s %6.1fs' % (
+        description, status, time.perf_counter() - start))
+
+
+async def generate(conn):
+    await conn.execute('SELECT setseed($1)', args.seed)
+    await conn.execute("SET session_replication_role = 'replica'")
+
+    today = datetime.date.today()
+    this_month = datetime.date(today.year, today.month, 1)
+    for i in range(args.months + 1):
+        await run_archive.create_partition(
+            conn, run_archive.add_months(this_month, -i))
+
+    await step(conn, 'packages', """
+INSERT INTO package (
+  name, distribution, branch_url, subpath, maintainer_email,
+  uploader_emails, vcs_type, vcs_url, vcs_browse, popcon_inst, removed)
+SELECT
+  'pkg' || i, 'unstable',
+  'https://salsa.debian.org/debian/pkg' || i || '.git', '',
+  'maint' || (i % $2) || '@example.com',
+  ARRAY['uploader' || ((i * 13) % $2) || '@example.com'],
+  'git', 'https://salsa.debian.org/debian/pkg' || i || '.git',
+  'https://salsa.debian.org/debian/pkg' || i,
+  (random() * 10000)::integer, random() < 0.02
+FROM generate_series(1, $1) AS i
+""", args.packages, args.maintainers)
+
+    await step(conn, 'candidates', """
+INSERT INTO candidate (package, suite, context, value, success_chance)
+SELECT p.name, s.suite, 'tag-' || (abs(hashtext(p.name)) % $2),
+  (random() * 100)::integer, random()
+FROM package p, unnest($1::text[]) AS s(suite)
+WHERE random() < 0.5
+""", suites, args.lintian_tags)
+
+    await step(conn, 'policy', """
+INSERT INTO policy (package, suite, update_changelog, publish, command)
+SELECT p.name, s.suite, 'auto',
+  ARRAY[ROW('main', (CASE WHEN random() < 0.8 THEN 'propose'
+                     ELSE 'push' END)::publish_mode)::publish_policy],
+  s.command
+FROM package p, unnest($1::text[], $2::text[]) AS s(suite, command)
+""", suites, [SUITE_COMMANDS.get(suite, suite) for suite in suites])
+
+    await step(conn, 'runs', """
+INSERT INTO run (
+  id, command, description, start_time, finish_time, package,
+  build_version, build_distribution, result_code, context,
+  main_branch_revision, branch_name, revision, result, suite, branch_url,
+  logfilenames, value, worker, review_status)
+SELECT
+  md5(p.name || '/' || j), r.command, 'Synthetic run', r.start_time,
+  r.start_time + (random() * interval '2 hours'), p.name,
+  CASE WHEN r.result_code = 'success' THEN ('1.' || j || '-1')::debversion
+  END,
+  r.suite, r.result_code, 'tag-' || (j %% %(tags)d),
+  md5('main' || p.name || j), 'main',
+  CASE WHEN r.result_code = 'success' THEN md5('new' || p.name || j) END,
+  CASE WHEN r.result_code = 'success' THEN %(result)s END,
+  r.suite, p.branch_url,
+  ARRAY['worker.log', 'build.log'], (random() * 100)::integer,
+  'worker-' || (j %% 10),
+  (CASE WHEN random() < 0.7 THEN 'unreviewed' ELSE 'approved' END)
+    ::review_status
+FROM package p, generate_series(1, $1) AS j,
+-- Refer to both p and j, so that these are evaluated for every run.
+LATERAL (
+  SELECT random() AS x, random() AS y WHERE j > 0 AND p.name IS NOT NULL
+) AS rnd,
+LATERAL (
+  SELECT
+    s.suite, s.command,
+    now() - rnd.y * interval '%(months)d months' AS start_time,
+    (SELECT c.code FROM unnest($3::text[], $4::float[]) AS c(code, w)
+     WHERE c.w >= rnd.x ORDER BY c.w LIMIT 1) AS result_code
+  FROM unnest($2::text[], $5::text[]) WITH ORDINALITY AS s(suite, command, n)
+  WHERE s.n = 1 + ((j + abs(hashtext(p.name))) %% array_length($2, 1))
+) AS r
+""" % {
+        'tags': args.lintian_tags, 'months': args.months,
+        'result': SUCCESS_RESULT.replace('$suite$', 'r.suite') % {
+            'tags': args.lintian_tags}},
+        args.runs_per_package, suites, result_codes, cumulative_weights,
+        [SUITE_COMMANDS.get(suite, suite) for suite in suites])
+
+    # The triggers are disabled while loading, so run_key is not maintained
+    # by update_run_key.
+    await step(conn, 'run keys', """
+INSERT INTO run_key (id, start_time) SELECT id, start_time FROM run
+""")
+
+    await step(conn, 'result branches', """
+INSERT INTO new_result_branch (
+  run_id, role, remote_name, base_revision, revision)
+SELECT id, 'main', NULL, main_branch_revision, revision FROM run
+WHERE revision IS NOT NULL
+""")
+
+    await step(conn, 'lintian fixes', """
+INSERT INTO run_lintian_fix (run_id, package, tag)
+SELECT id, package, jsonb_array_elements_text(result_fixed_lintian_tags)
+FROM run ON CONFLICT DO NOTHING
+""")
+
+    await step(conn, 'merge proposals', """
+INSERT INTO merge_proposal (url, package, status, revision, merged_at)
+SELECT
+  'https://salsa.debian.org/debian/' || package || '/merge_requests/' ||
+  left(id, 8), package, status, revision,
+  CASE WHEN status = 'merged'
+  THEN finish_time + random() * interval '30 days' END
+FROM (
+  SELECT run.*, (CASE
+    WHEN random() < 0.3 THEN 'open' WHEN random() < 0.7 THEN 'merged'
+    ELSE 'closed' END)::merge_proposal_status AS status
+  -- Not ORDER BY random(): PostgreSQL would reuse the sort key for the
+  -- random() calls above, making every sampled proposal 'open'.
+  FROM run WHERE revision IS NOT NULL ORDER BY md5(id) LIMIT $1) AS r
+""", args.merge_proposals)
+
+    await step(conn, 'publishes', """
+INSERT INTO publish (
+  id, package, branch_name, main_branch_revision, revision, role, mode,
+  merge_proposal_url, result_code, description, requestor, timestamp)
+SELECT
+  md5('publish' || run.id), run.package, 'main', run.main_branch_revision,
+  run.revision, 'main', 'propose', merge_proposal.url, 'success',
+  'Synthetic publish', 'publisher',
+  run.finish_time + random() * interval '1 day'
+FROM merge_proposal INNER JOIN run ON run.revision = merge_proposal.revision
+""")
+
+    await step(conn, 'queue', """
+INSERT INTO queue (
+  bucket, package, suite, command, priority, context, estimated_duration,
+  requestor)
+SELECT
+  (CASE WHEN random() < 0.9 THEN 'default'
+   ELSE 'update-existing-mp' END)::queue_bucket,
+  p.name, s.suite, s.command, (random() * 100000)::bigint,
+  'tag-' || (abs(hashtext(p.name)) % $4),
+  random() * interval '30 minutes', 'scheduler'
+FROM package p, unnest($2::text[], $3::text[]) AS s(suite, command)
+WHERE NOT p.removed
+ORDER BY random() LIMIT $1
+""", args.queue_size, suites, [
+        SUITE_COMMANDS.get(suite, suite) for suite in suites],
+        args.lintian_tags)
+
+    await conn.execute("SET session_replication_role = 'origin'")
+
+    await step(conn, 'absorbed runs', """
+SELECT refresh_run_absorbed(id) FROM run WHERE result_code = 'success'
+""")
+    await step(conn, 'last runs', """
+SELECT refresh_last_runs(package, suite)
+FROM (SELECT DISTINCT package, suite FROM run) AS r
+""")
+
+    start = time.perf_counter()
+    await rollup.refresh_rollups(conn)
+    print('%-40s %-20s %6.1fs' % (
+        'rollups', '', time.perf_counter() - start))
+
+    await step(conn, 'analyze', 'ANALYZE')
+
+
+async def main():
+    conn = await asyncpg.connect(args.database_location)
+    try:
+        if await conn.fetchval('SELECT count(*) FROM package'):
+            print('Database already contains packages; '
+                  'please start from an empty database.')
+            return 1
+        await generate(conn)
+    finally:
+        await conn.close()
+    return 0
+
+
+sys.exit(asyncio.run(main()))
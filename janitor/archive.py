@@ -357,7 +357,9 @@ async def main(argv=None):
 
     os.makedirs(args.dists_directory, exist_ok=True)
 
-    db = state.Database(config.database_location)
+    db = state.Database(
+        config.database_location,
+        slow_query_threshold=(config.slow_query_threshold or None))
 
     artifact_manager = get_artifact_manager(config.artifact_location)
 
@@ -27,6 +27,7 @@ import tempfile
 
 from yarl import URL
 
+from .logs import ChunkStream, iter_file_chunks
 from .trace import note, warning
 
 
@@ -49,6 +50,17 @@ class ArtifactManager(object):
     async def get_artifact(self, run_id, filename, timeout=None):
         raise NotImplementedError(self.get_artifact)
 
+    async def iter_artifact_chunks(self, run_id, filename, timeout=None):
+        """Retrieve an artifact as a stream of chunks.
+
+        The caller is responsible for closing the stream.
+
+        Raises:
+          FileNotFoundError: if the artifact does not exist
+        """
+        return iter_file_chunks(
+            await self.get_artifact(run_id, filename, timeout=timeout))
+
     async def retrieve_artifacts(
             self, run_id, local_path, filter_fn=None, timeout=None):
         raise NotImplementedError(self.retrieve_artifacts)
@@ -187,6 +199,22 @@ class GCSArtifactManager(ArtifactManager):
             bucket=self.bucket_name, object_name='%s/%s' % (run_id, filename),
             timeout=timeout))
 
+    async def iter_artifact_chunks(
+            self, run_id, filename, timeout=DEFAULT_GCS_TIMEOUT):
+        try:
+            stream = await self.storage.download_stream(
+                self.bucket_name, '%s/%s' % (run_id, filename),
+                session=self.session, timeout=timeout)
+        except ClientResponseError as e:
+            if e.status == 404:
+                raise FileNotFoundError(filename)
+            if e.status == 503:
+                raise ServiceUnavailable()
+            raise
+
+        return ChunkStream(
+            stream.read, lambda: stream.__aexit__(None, None, None))
+
 
 def get_artifact_manager(location):
     if location.startswith('gs://'):
@@ -19,30 +19,16 @@ import os
 import itertools
 import re
 import shutil
+from typing import TYPE_CHECKING
 
 from debian.changelog import Changelog, Version
 from debian.deb822 import Changes
 
-from breezy import (
-    osutils,
-    urlutils,
-    )
-from breezy.trace import note
-from breezy.workingtree import WorkingTree
-
-from lintian_brush.salsa import (
-    guess_repository_url,
-    salsa_url_from_alioth_url,
-    )
-
-from silver_platter.debian import (
-    select_probers,
-    )
-
-from ..vcs import (
-    open_branch_ext,
-    BranchOpenFailure,
-    )
+# breezy, lintian-brush and silver-platter are slow to import, and most users
+# of this package (e.g. the site, via janitor.debian.state) don't need them,
+# so they are imported by the functions that use them.
+if TYPE_CHECKING:
+    from breezy.workingtree import WorkingTree
 
 # Timeout in seconds for uploads
 UPLOAD_TIMEOUT = 30 * 60
@@ -69,6 +55,7 @@ def find_changes(path, package):
 
 
 def possible_salsa_urls_from_package_name(package_name, maintainer_email=None):
+    from lintian_brush.salsa import guess_repository_url
     yield guess_repository_url(package_name, maintainer_email)
     yield 'https://salsa.debian.org/debian/%s.git' % package_name
 
@@ -82,6 +69,7 @@ def possible_urls_from_alioth_url(vcs_type, vcs_url):
         vcs_url)
 
     yield https_alioth_url
+    from lintian_brush.salsa import salsa_url_from_alioth_url
     yield salsa_url_from_alioth_url(vcs_type, vcs_url)
 
 
@@ -89,7 +77,11 @@ async def open_guessed_salsa_branch(
         conn, pkg, vcs_type, vcs_url, possible_transports=None):
     # Don't do this as a top-level export, since it imports asyncpg, which
     # isn't available on jenkins.debian.net.
+    from breezy import urlutils
+    from breezy.trace import note
+    from silver_platter.debian import select_probers
     from ..debian import state as debian_state
+    from ..vcs import open_branch_ext, BranchOpenFailure
     package = await debian_state.get_package(conn, pkg)
     probers = select_probers('git')
     vcs_url, params = urlutils.split_segment_parameters_raw(vcs_url)
@@ -149,7 +141,8 @@ def dget(changes_location, target_dir):
 
 
 def tree_set_changelog_version(
-        tree: WorkingTree, build_version: Version, subpath: str) -> None:
+        tree: 'WorkingTree', build_version: Version, subpath: str) -> None:
+    from breezy import osutils
     cl_path = osutils.pathjoin(subpath, 'debian/changelog')
     with tree.get_file(cl_path) as f:
         cl = Changelog(f)
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+# Copyright (C) 2019-2021 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Analysis of sbuild logs.
+
+The runner summarizes the build log of each run when it imports the logs,
+so that the site doesn't have to retrieve and parse the log every time a
+run is viewed.
+"""
+
+from io import BytesIO
+import os
+from typing import Any, BinaryIO, Dict, Optional
+
+from buildlog_consultant.sbuild import (
+    parse_sbuild_log,
+    find_failed_stage,
+    find_build_failure_description,
+    find_install_deps_failure_description,
+    SBUILD_FOCUS_SECTION,
+    strip_useless_build_tail,
+)
+
+# Number of lines of the build log to show for a failure.
+FAIL_BUILD_LOG_LEN = 15
+
+BUILD_LOG_NAME = 'build.log'
+
+
+def _find_failure(paragraphs, offsets, linecount, length):
+    """Find the part of a build log that describes the failure.
+
+    Returns:
+      tuple with failed stage, range of lines to include, lines to highlight
+      and the error (if known)
+    """
+    highlight_lines = []
+    include_lines = None
+    error = None
+    failed_stage = find_failed_stage(paragraphs.get('summary', []))
+    focus_section = SBUILD_FOCUS_SECTION.get(failed_stage)
+    if focus_section not in paragraphs:
+        focus_section = None
+    if failed_stage == 'install-deps':
+        (focus_section, offset, line,
+         error) = find_install_deps_failure_description(paragraphs)
+        if offset is not None:
+            lines = paragraphs[focus_section]
+            abs_offset = offsets[focus_section][0] + offset
+            include_lines = (
+                max(1, abs_offset - length//2),
+                abs_offset + min(length//2, len(lines)))
+            highlight_lines = [abs_offset]
+            return (failed_stage, include_lines, highlight_lines, error)
+
+    if focus_section:
+        include_lines = (max(1, offsets[focus_section][1]-length),
+                         offsets[focus_section][1])
+    elif length < linecount:
+        include_lines = (linecount-length, None)
+    else:
+        include_lines = (1, linecount)
+    if focus_section == 'build':
+        lines = paragraphs.get(focus_section, [])
+        lines = strip_useless_build_tail(lines)
+        include_lines = (max(1, offsets[focus_section][0] + len(lines)-length),
+                         offsets[focus_section][0] + len(lines))
+        offset, unused_line, error = find_build_failure_description(lines)
+        if offset is not None:
+            highlight_lines = [offsets[focus_section][0] + offset]
+
+    return (failed_stage, include_lines, highlight_lines, error)
+
+
+def _parse(logf):
+    offsets = {}
+    linecount = 0
+    paragraphs = {}
+    for title, offset, lines in parse_sbuild_log(logf):
+        if title is not None:
+            title = title.lower()
+        paragraphs[title] = lines
+        linecount = max(offset[1], linecount)
+        offsets[title] = offset
+    return paragraphs, offsets, linecount
+
+
+def summarize_build_log(
+        logf: BinaryIO, length: int = FAIL_BUILD_LOG_LEN) -> Dict[str, Any]:
+    """Summarize a build log.
+
+    Args:
+      logf: File-like object with the (uncompressed) log
+      length: Number of lines to include in the excerpt
+    Returns:
+      dictionary with:
+        line_count: number of lines in the log
+        sections: list of (title, first line, last line) tuples
+        failed_stage: the stage that failed, if any
+        error: description of the error, if one was found
+        include_lines: first and last line of the excerpt
+        include_bytes: start and end offset of the excerpt in the log, for
+            retrieving it (or its context) with a range request
+        highlight_lines: lines to highlight
+        excerpt: the lines of the excerpt
+    """
+    lines = logf.readlines()
+    paragraphs, offsets, linecount = _parse(BytesIO(b''.join(lines)))
+    (failed_stage, include_lines, highlight_lines,
+     error) = _find_failure(paragraphs, offsets, linecount, length)
+    first, last = include_lines
+    if last is None:
+        last = len(lines)
+    first = min(max(1, first), len(lines) + 1)
+    last = min(max(first - 1, last), len(lines))
+    start = sum(len(line) for line in lines[:first - 1])
+    end = start + sum(len(line) for line in lines[first - 1:last])
+    return {
+        'line_count': linecount,
+        'sections': [
+            (title, first_line, last_line)
+            for (title, (first_line, last_line)) in offsets.items()],
+        'failed_stage': failed_stage,
+        'error': str(error) if error is not None else None,
+        'include_lines': [first, last],
+        'include_bytes': [start, end],
+        'highlight_lines': highlight_lines,
+        'excerpt': [
+            line.decode('utf-8', 'replace') for line in lines[first - 1:last]],
+    }
+
+
+def summarize_build_log_file(
+        output_directory: str,
+        length: int = FAIL_BUILD_LOG_LEN) -> Optional[Dict[str, Any]]:
+    """Summarize the build log in a run's output directory, if there is one.
+    """
+    try:
+        with open(os.path.join(output_directory, BUILD_LOG_NAME), 'rb') as f:
+            return summarize_build_log(f, length)
+    except FileNotFoundError:
+        return None
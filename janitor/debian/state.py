@@ -18,9 +18,10 @@
 import asyncpg
 from debian.changelog import Version
 import shlex
-from typing import Optional, Dict, List, Tuple
+import sys
+from typing import Any, Optional, Dict, List, Tuple
 from breezy import urlutils
-from janitor.state import Codebase
+from janitor.state import Codebase, instrument_queries
 
 
 async def popcon(conn: asyncpg.Connection):
@@ -343,6 +344,20 @@ async def store_debian_build(
         run_id, source, str(version), distribution)
 
 
+async def store_build_log_summary(
+        conn: asyncpg.Connection, run_id: str, summary: Dict[str, Any]):
+    await conn.execute(
+        "INSERT INTO build_log_summary (run_id, summary) VALUES ($1, $2) "
+        "ON CONFLICT (run_id) DO UPDATE SET summary = EXCLUDED.summary",
+        run_id, summary)
+
+
+async def get_build_log_summary(
+        conn: asyncpg.Connection, run_id: str) -> Optional[Dict[str, Any]]:
+    return await conn.fetchval(
+        "SELECT summary FROM build_log_summary WHERE run_id = $1", run_id)
+
+
 async def update_removals(
         conn: asyncpg.Connection, distribution: str,
         items: List[Tuple[str, Optional[Version]]]) -> None:
@@ -372,4 +387,4 @@ where rb.revision = $1 and run.package is not null
     return None, None
 
 
-
+instrument_queries(sys.modules[__name__])
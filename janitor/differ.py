@@ -514,7 +514,9 @@ def main(argv=None):
 
     artifact_manager = get_artifact_manager(config.artifact_location)
 
-    db = state.Database(config.database_location)
+    db = state.Database(
+        config.database_location,
+        slow_query_threshold=(config.slow_query_threshold or None))
     loop = asyncio.get_event_loop()
 
     if args.cache_path and not os.path.isdir(args.cache_path):
@@ -0,0 +1,395 @@
+#!/usr/bin/python3
+# Copyright (C) 2021 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Export of the run history to columnar files, for offline analysis.
+
+Runs and publishes are (mostly) only appended to, so they are exported
+incrementally: a watermark (timestamp and id of the last exported row) is
+kept per table, and every export only appends the rows after it. Merge
+proposals and the queue change in place, so each export writes a full
+snapshot of them instead.
+
+Runs are ordered by their finish time; runs without a finish time are
+never exported.
+
+Files are laid out in hive-style partitions, which DuckDB, pandas and Spark
+can read directly:
+
+  run/month=2021-05/part-<watermark>.parquet
+  publish/month=2021-05/part-<watermark>.parquet
+  merge_proposal/snapshot=2021-05-30T120000/data.parquet
+  queue/snapshot=2021-05-30T120000/data.parquet
+  watermarks.json
+
+Columns of runs that change after the run has finished (such as the review
+status) are not exported, since they would be out of date. The exception
+is the result code and description: reprocess-build-results.py rewrites
+these for existing runs (see state.update_run_result), and exported copies
+of those runs keep the old values. Remove the run partitions and their
+watermark to export them again after reprocessing.
+"""
+
+import asyncio
+import datetime
+import json
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+import asyncpg
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+
+from .trace import note
+
+
+DEFAULT_BATCH_SIZE = 50000
+
+# Only export rows that are at least this old. Rows are not necessarily
+# committed in timestamp order, and the replica may lag behind slightly.
+EXPORT_DELAY = datetime.timedelta(minutes=15)
+
+WATERMARK_FILENAME = 'watermarks.json'
+
+FORMATS = {
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+}
+
+# Column name, SQL expression and Arrow type for each exported column.
+Columns = List[Tuple[str, str, pyarrow.DataType]]
+
+RUN_COLUMNS: Columns = [
+    ('id', 'id', pyarrow.string()),
+    ('package', 'package', pyarrow.string()),
+    ('suite', 'suite', pyarrow.string()),
+    ('command', 'command', pyarrow.string()),
+    ('start_time', 'start_time', pyarrow.timestamp('us')),
+    ('finish_time', 'finish_time', pyarrow.timestamp('us')),
+    ('duration', 'extract(epoch FROM finish_time - start_time)::float8',
+     pyarrow.float64()),
+    ('result_code', 'result_code', pyarrow.string()),
+    ('description', 'description', pyarrow.string()),
+    ('instigated_context', 'instigated_context', pyarrow.string()),
+    ('context', 'context', pyarrow.string()),
+    ('build_version', 'build_version::text', pyarrow.string()),
+    ('build_distribution', 'build_distribution', pyarrow.string()),
+    ('main_branch_revision', 'main_branch_revision', pyarrow.string()),
+    ('revision', 'revision', pyarrow.string()),
+    ('branch_url', 'branch_url', pyarrow.string()),
+    ('value', 'value', pyarrow.int32()),
+    ('worker', 'worker', pyarrow.string()),
+    ('result', 'result::text', pyarrow.string()),
+    ('fixed_lintian_tags',
+     'ARRAY(SELECT jsonb_array_elements_text(result_fixed_lintian_tags))',
+     pyarrow.list_(pyarrow.string())),
+    ('lintian_brush_version', 'result_lintian_brush_version',
+     pyarrow.string()),
+]
+
+PUBLISH_COLUMNS: Columns = [
+    ('id', 'id', pyarrow.string()),
+    ('package', 'package', pyarrow.string()),
+    ('timestamp', 'timestamp', pyarrow.timestamp('us')),
+    ('mode', 'mode::text', pyarrow.string()),
+    ('role', 'role', pyarrow.string()),
+    ('branch_name', 'branch_name', pyarrow.string()),
+    ('main_branch_revision', 'main_branch_revision', pyarrow.string()),
+    ('revision', 'revision', pyarrow.string()),
+    ('merge_proposal_url', 'merge_proposal_url', pyarrow.string()),
+    ('result_code', 'result_code', pyarrow.string()),
+    ('description', 'description', pyarrow.string()),
+    ('requestor', 'requestor', pyarrow.string()),
+]
+
+MERGE_PROPOSAL_COLUMNS: Columns = [
+    ('url', 'url', pyarrow.string()),
+    ('package', 'package', pyarrow.string()),
+    ('status', 'status::text', pyarrow.string()),
+    ('revision', 'revision', pyarrow.string()),
+    ('merged_by', 'merged_by', pyarrow.string()),
+    ('merged_at', 'merged_at', pyarrow.timestamp('us')),
+]
+
+QUEUE_COLUMNS: Columns = [
+    ('id', 'id', pyarrow.int64()),
+    ('bucket', 'bucket::text', pyarrow.string()),
+    ('package', 'package', pyarrow.string()),
+    ('suite', 'suite', pyarrow.string()),
+    ('command', 'command', pyarrow.string()),
+    ('priority', 'priority', pyarrow.int64()),
+    ('context', 'context', pyarrow.string()),
+    ('estimated_duration', 'extract(epoch FROM estimated_duration)::float8',
+     pyarrow.float64()),
+    ('refresh', 'refresh', pyarrow.bool_()),
+    ('requestor', 'requestor', pyarrow.string()),
+]
+
+# Tables that are only appended to, with the timestamp and key columns that
+# determine the export order.
+INCREMENTAL_TABLES: Dict[str, Tuple[str, str, Columns]] = {
+    'run': ('finish_time', 'id', RUN_COLUMNS),
+    'publish': ('timestamp', 'id', PUBLISH_COLUMNS),
+}
+
+# Tables that are exported as a full snapshot, with their sort order.
+SNAPSHOT_TABLES: Dict[str, Tuple[str, Columns]] = {
+    'merge_proposal': ('url', MERGE_PROPOSAL_COLUMNS),
+    'queue': ('bucket, priority, id', QUEUE_COLUMNS),
+}
+
+Watermark = Tuple[datetime.datetime, str]
+
+INITIAL_WATERMARK: Watermark = (datetime.datetime.min, '')
+
+
+def _schema(columns: Columns) -> pyarrow.Schema:
+    return pyarrow.schema([(name, type) for (name, expr, type) in columns])
+
+
+def _select_list(columns: Columns) -> str:
+    return ', '.join(
+        '%s AS %s' % (expr, name) for (name, expr, type) in columns)
+
+
+def _to_table(rows, columns: Columns) -> pyarrow.Table:
+    return pyarrow.Table.from_arrays(
+        [pyarrow.array([row[i] for row in rows], type=type)
+         for i, (name, expr, type) in enumerate(columns)],
+        schema=_schema(columns))
+
+
+def _open_writer(path: str, schema: pyarrow.Schema, format: str):
+    if format == 'parquet':
+        return pyarrow.parquet.ParquetWriter(path, schema)
+    elif format == 'arrow':
+        return pyarrow.ipc.new_file(path, schema)
+    else:
+        raise ValueError('unknown format %r' % format)
+
+
+def _temporary_path(path: str) -> str:
+    # Files are written under a temporary name first, so that readers never
+    # see partial files. Readers skip files whose name starts with a dot.
+    return os.path.join(
+        os.path.dirname(path), '.%s.tmp' % os.path.basename(path))
+
+
+def _write_table(path: str, table: pyarrow.Table, format: str) -> None:
+    writer = _open_writer(_temporary_path(path), table.schema, format)
+    try:
+        writer.write_table(table)
+    finally:
+        writer.close()
+    os.rename(_temporary_path(path), path)
+
+
+def read_watermarks(directory: str) -> Dict[str, Watermark]:
+    try:
+        with open(os.path.join(directory, WATERMARK_FILENAME), 'r') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return {
+        table: (datetime.datetime.fromisoformat(timestamp), key)
+        for (table, (timestamp, key)) in data.items()}
+
+
+def write_watermarks(
+        directory: str, watermarks: Dict[str, Watermark]) -> None:
+    path = os.path.join(directory, WATERMARK_FILENAME)
+    with open(_temporary_path(path), 'w') as f:
+        json.dump({
+            table: (timestamp.isoformat(), key)
+            for (table, (timestamp, key)) in watermarks.items()},
+            f, indent=2, sort_keys=True)
+    os.rename(_temporary_path(path), path)
+
+
+def _part_name(watermark: Watermark) -> str:
+    timestamp, key = watermark
+    return 'part-%s-%s' % (
+        timestamp.isoformat().replace(':', ''),
+        re.sub('[^A-Za-z0-9_.-]', '_', key))
+
+
+async def export_incremental(
+        conn: asyncpg.Connection, directory: str, table: str,
+        watermarks: Dict[str, Watermark], format: str = 'parquet',
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        cutoff: Optional[datetime.datetime] = None) -> int:
+    """Export the rows of an append-only table added since the last export.
+
+    The watermark is updated (and saved) after every batch, so an
+    interrupted export continues where it left off. Files are named after
+    the watermark they start at, so a batch that is exported again replaces
+    the file written earlier rather than duplicating its rows.
+
+    Args:
+      conn: Database connection
+      directory: Export directory
+      table: Name of the table to export
+      watermarks: Dictionary with watermarks per table; updated in place
+      format: Output format (see FORMATS)
+      batch_size: Maximum number of rows per file
+      cutoff: Only export rows older than this; defaults to EXPORT_DELAY ago
+    Returns:
+      number of rows exported
+    """
+    timestamp_column, key_column, columns = INCREMENTAL_TABLES[table]
+    if cutoff is None:
+        cutoff = datetime.datetime.now() - EXPORT_DELAY
+    query = """\
+SELECT %(columns)s FROM %(table)s
+WHERE %(timestamp)s < $3 AND (%(timestamp)s, %(key)s) > ($1, $2)
+ORDER BY %(timestamp)s, %(key)s
+LIMIT $4
+""" % {'columns': _select_list(columns), 'table': table,
+       'timestamp': timestamp_column, 'key': key_column}
+    timestamp_index = [name for (name, expr, type) in columns].index(
+        timestamp_column)
+    key_index = [name for (name, expr, type) in columns].index(key_column)
+    total = 0
+    while True:
+        watermark = watermarks.get(table, INITIAL_WATERMARK)
+        rows = await conn.fetch(query, *watermark, cutoff, batch_size)
+        if not rows:
+            return total
+        by_month: Dict[str, list] = {}
+        for row in rows:
+            by_month.setdefault(
+                row[timestamp_index].strftime('%Y-%m'), []).append(row)
+        for month, month_rows in by_month.items():
+            path = os.path.join(directory, table, 'month=%s' % month)
+            os.makedirs(path, exist_ok=True)
+            _write_table(
+                os.path.join(
+                    path, _part_name(watermark) + FORMATS[format]),
+                _to_table(month_rows, columns), format)
+        watermarks[table] = (rows[-1][timestamp_index], rows[-1][key_index])
+        write_watermarks(directory, watermarks)
+        total += len(rows)
+
+
+async def export_snapshot(
+        conn: asyncpg.Connection, directory: str, table: str,
+        snapshot_time: datetime.datetime, format: str = 'parquet',
+        batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """Export a full snapshot of a table.
+
+    Returns:
+      number of rows exported
+    """
+    order_by, columns = SNAPSHOT_TABLES[table]
+    path = os.path.join(
+        directory, table,
+        'snapshot=%s' % snapshot_time.strftime('%Y-%m-%dT%H%M%S'))
+    os.makedirs(path, exist_ok=True)
+    filename = os.path.join(path, 'data' + FORMATS[format])
+    total = 0
+    writer = _open_writer(
+        _temporary_path(filename), _schema(columns), format)
+    try:
+        async with conn.transaction(isolation='repeatable_read',
+                                    readonly=True):
+            cursor = await conn.cursor(
+                'SELECT %s FROM %s ORDER BY %s' % (
+                    _select_list(columns), table, order_by))
+            while True:
+                rows = await cursor.fetch(batch_size)
+                if not rows:
+                    break
+                writer.write_table(_to_table(rows, columns))
+                total += len(rows)
+    finally:
+        writer.close()
+    os.rename(_temporary_path(filename), filename)
+    return total
+
+
+async def export(
+        conn: asyncpg.Connection, directory: str,
+        tables: Optional[List[str]] = None, format: str = 'parquet',
+        batch_size: int = DEFAULT_BATCH_SIZE) -> Dict[str, int]:
+    """Export all (or the specified) tables.
+
+    Returns:
+      dictionary mapping table names to the number of rows exported
+    """
+    if tables is None:
+        tables = list(INCREMENTAL_TABLES) + list(SNAPSHOT_TABLES)
+    os.makedirs(directory, exist_ok=True)
+    watermarks = read_watermarks(directory)
+    now = datetime.datetime.now()
+    ret = {}
+    for table in tables:
+        if table in INCREMENTAL_TABLES:
+            ret[table] = await export_incremental(
+                conn, directory, table, watermarks, format=format,
+                batch_size=batch_size, cutoff=now - EXPORT_DELAY)
+        elif table in SNAPSHOT_TABLES:
+            ret[table] = await export_snapshot(
+                conn, directory, table, now, format=format,
+                batch_size=batch_size)
+        else:
+            raise KeyError(table)
+        note('Exported %d rows from %s', ret[table], table)
+    return ret
+
+
+async def main(args):
+    from .config import read_config
+    from . import state
+
+    with open(args.config, 'r') as f:
+        config = read_config(f)
+
+    # Exports are read-only and potentially large, so use the replica if
+    # there is one.
+    db = state.Database(
+        config.database_location,
+        replica_url=(config.database_replica_location or None)).readonly()
+    async with db.acquire() as conn:
+        await export(
+            conn, args.directory, tables=args.table or None,
+            format=args.format, batch_size=args.batch_size)
+    return 0
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--config', type=str, default='janitor.conf',
+        help='Path to configuration.')
+    parser.add_argument(
+        'directory', type=str, help='Directory to export to.')
+    parser.add_argument(
+        '--table', type=str, action='append',
+        choices=list(INCREMENTAL_TABLES) + list(SNAPSHOT_TABLES),
+        help='Table to export (can be specified multiple times). '
+        'Defaults to all tables.')
+    parser.add_argument(
+        '--format', type=str, choices=list(FORMATS), default='parquet',
+        help='File format to write.')
+    parser.add_argument(
+        '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+        help='Maximum number of rows to fetch at a time.')
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,362 @@
+#!/usr/bin/python3
+# Copyright (C) 2021 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""HTTP client for calls between the janitor services.
+
+HttpClient wraps a single long-lived, pooled aiohttp ClientSession and can
+be used in its place. For each backend (i.e. origin: the differ, the VCS
+store, the runner, ...) it limits the number of concurrent requests,
+retries idempotent requests that fail with a connection error or a
+gateway error, and keeps a circuit breaker. While a backend's circuit is
+open, requests to it fail immediately with CircuitOpen rather than
+waiting for a timeout.
+"""
+
+import asyncio
+from collections import namedtuple
+import errno
+import random
+import time
+from typing import Dict, Optional
+
+from aiohttp import (
+    ClientConnectionError,
+    ClientConnectorError,
+    ClientSession,
+    ClientTimeout,
+    TCPConnector,
+    )
+from prometheus_client import Counter, Gauge
+from yarl import URL
+
+from .trace import note, warning
+
+
+# Maximum number of connections, in total and per backend.
+DEFAULT_CONNECTION_LIMIT = 100
+DEFAULT_CONNECTION_LIMIT_PER_BACKEND = 50
+
+# Maximum number of concurrent requests per backend. Requests beyond this
+# wait for an earlier one to finish.
+DEFAULT_CONCURRENCY_PER_BACKEND = 50
+
+# Time (in seconds) to keep idle connections open.
+KEEPALIVE_TIMEOUT = 60
+
+# Default timeouts (in seconds). Individual requests can override these.
+DEFAULT_TIMEOUT = ClientTimeout(total=5 * 60, sock_connect=10)
+
+# Number of times to retry idempotent requests, and the base delay (in
+# seconds) between attempts. The actual delay is random (up to twice as
+# long for every attempt), so that clients don't retry in lockstep.
+DEFAULT_RETRIES = 2
+RETRY_BACKOFF = 0.2
+
+# Number of consecutive failures after which the circuit for a backend
+# opens, and the time (in seconds) after which a single trial request is let
+# through again.
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+# Responses that indicate the backend (or the proxy in front of it) is
+# unavailable, rather than an error in the request.
+UNAVAILABLE_STATUSES = frozenset([502, 503, 504])
+
+
+backend_requests = Counter(
+    'backend_requests_total', 'Requests to backends.',
+    labelnames=('backend', 'result'))
+backend_retries = Counter(
+    'backend_retries_total', 'Requests to backends that were retried.',
+    labelnames=('backend', ))
+backend_circuit_open = Gauge(
+    'backend_circuit_open',
+    'Whether the circuit breaker for a backend is open.',
+    labelnames=('backend', ))
+
+
+_ConnectionKey = namedtuple('_ConnectionKey', ['host', 'port', 'ssl'])
+
+
+class CircuitOpen(ClientConnectorError):
+    """The circuit breaker for a backend is open.
+
+    This is a ClientConnectorError, so that callers that already handle
+    unreachable backends handle this too.
+    """
+
+    def __init__(self, url: URL):
+        super(CircuitOpen, self).__init__(
+            _ConnectionKey(url.host, url.port, url.scheme == 'https'),
+            OSError(errno.ECONNREFUSED, 'Backend unavailable'))
+
+
+class CircuitBreaker(object):
+    """Circuit breaker for a single backend.
+
+    The circuit opens after failure_threshold consecutive failures. Once
+    reset_timeout has passed, a single trial request is allowed; if it
+    succeeds the circuit closes again, otherwise it stays open for another
+    reset_timeout.
+    """
+
+    def __init__(self, name: str,
+                 failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_progress = False
+        backend_circuit_open.labels(backend=name).set(0)
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        """Check whether a request can be made."""
+        if self.opened_at is None:
+            return True
+        if self._trial_in_progress:
+            return False
+        if time.monotonic() < self.opened_at + self.reset_timeout:
+            return False
+        self._trial_in_progress = True
+        return True
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            note('Backend %s is available again.', self.name)
+            backend_circuit_open.labels(backend=self.name).set(0)
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+
+    def abandon(self) -> None:
+        """Record that a request was abandoned (e.g. cancelled)."""
+        self._trial_in_progress = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.opened_at is not None:
+            # The trial request failed.
+            self.opened_at = time.monotonic()
+            self._trial_in_progress = False
+        elif self.failures >= self.failure_threshold:
+            warning('Backend %s failed %d times in a row; '
+                    'failing requests for %ds.',
+                    self.name, self.failures, self.reset_timeout)
+            self.opened_at = time.monotonic()
+            backend_circuit_open.labels(backend=self.name).set(1)
+
+
+class _BackendState(object):
+
+    def __init__(self, name, concurrency, failure_threshold, reset_timeout):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.breaker = CircuitBreaker(
+            name, failure_threshold=failure_threshold,
+            reset_timeout=reset_timeout)
+
+
+class _RequestContextManager(object):
+
+    def __init__(self, client, method, url, kwargs):
+        self._client = client
+        self._method = method
+        self._url = URL(url)
+        self._limit = kwargs.pop('limit', True)
+        self._kwargs = kwargs
+        self._resp = None
+        self._semaphore = None
+
+    def _total_timeout(self) -> Optional[float]:
+        timeout = self._kwargs.get('timeout') or self._client.session.timeout
+        return getattr(timeout, 'total', timeout)
+
+    async def _acquire(self, backend):
+        if not self._limit:
+            return None
+        # Don't wait for a slot for longer than the request itself may take.
+        await asyncio.wait_for(
+            backend.semaphore.acquire(), self._total_timeout())
+        return backend.semaphore
+
+    async def __aenter__(self):
+        name = self._client.backend_name(self._url)
+        backend = self._client.get_backend(self._url)
+        # Streamed request bodies can only be sent once.
+        if (self._method.upper() in IDEMPOTENT_METHODS and
+                isinstance(self._kwargs.get('data'),
+                           (type(None), bytes, str, dict))):
+            retries = self._client.retries
+        else:
+            retries = 0
+        if not backend.breaker.allow():
+            backend_requests.labels(backend=name, result='rejected').inc()
+            raise CircuitOpen(self._url)
+        # The circuit breaker sees the outcome of the request as a whole,
+        # rather than that of the individual attempts.
+        attempt = 0
+        while True:
+            try:
+                semaphore = await self._acquire(backend)
+            except BaseException:
+                backend.breaker.abandon()
+                raise
+            try:
+                resp = await self._client.session.request(
+                    self._method, self._url, **self._kwargs)
+            except ClientConnectionError:
+                if semaphore is not None:
+                    semaphore.release()
+                backend_requests.labels(backend=name, result='failure').inc()
+                if attempt >= retries:
+                    backend.breaker.record_failure()
+                    raise
+            except asyncio.TimeoutError:
+                # The request already took as long as it was allowed to, so
+                # don't retry it.
+                if semaphore is not None:
+                    semaphore.release()
+                backend_requests.labels(backend=name, result='failure').inc()
+                backend.breaker.record_failure()
+                raise
+            except BaseException:
+                if semaphore is not None:
+                    semaphore.release()
+                backend.breaker.abandon()
+                raise
+            else:
+                if resp.status not in UNAVAILABLE_STATUSES:
+                    backend.breaker.record_success()
+                    backend_requests.labels(
+                        backend=name, result='success').inc()
+                    self._resp = resp
+                    self._semaphore = semaphore
+                    return resp
+                backend_requests.labels(backend=name, result='failure').inc()
+                if attempt >= retries:
+                    backend.breaker.record_failure()
+                    self._resp = resp
+                    self._semaphore = semaphore
+                    return resp
+                resp.release()
+                if semaphore is not None:
+                    semaphore.release()
+            attempt += 1
+            backend_retries.labels(backend=name).inc()
+            await asyncio.sleep(
+                random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            self._resp.release()
+        finally:
+            if self._semaphore is not None:
+                self._semaphore.release()
+        return False
+
+
+class HttpClient(object):
+    """Pooled HTTP client for calls to other janitor services.
+
+    This supports the subset of the ClientSession API that the services use
+    (request, get, post, put, delete, head and ws_connect), so it can be used
+    in place of a ClientSession. Requests should be used as asynchronous
+    context managers, e.g.:
+
+      async with client.get(url) as resp:
+          ...
+
+    Requests wait for at most their total timeout for one of the backend's
+    concurrency slots. Long-lived requests (e.g. streamed proxy requests)
+    can pass limit=False so they don't take up a slot at all.
+    """
+
+    def __init__(
+            self, session: Optional[ClientSession] = None,
+            concurrency: int = DEFAULT_CONCURRENCY_PER_BACKEND,
+            retries: int = DEFAULT_RETRIES,
+            failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+            reset_timeout: float = DEFAULT_RESET_TIMEOUT):
+        if session is None:
+            session = ClientSession(
+                connector=TCPConnector(
+                    limit=DEFAULT_CONNECTION_LIMIT,
+                    limit_per_host=DEFAULT_CONNECTION_LIMIT_PER_BACKEND,
+                    keepalive_timeout=KEEPALIVE_TIMEOUT),
+                timeout=DEFAULT_TIMEOUT)
+        self.session = session
+        self.concurrency = concurrency
+        self.retries = retries
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._backends: Dict[str, _BackendState] = {}
+
+    @staticmethod
+    def backend_name(url: URL) -> str:
+        return '%s:%s' % (url.host, url.port)
+
+    def get_backend(self, url: URL) -> _BackendState:
+        name = self.backend_name(url)
+        try:
+            return self._backends[name]
+        except KeyError:
+            backend = self._backends[name] = _BackendState(
+                name, self.concurrency, self.failure_threshold,
+                self.reset_timeout)
+            return backend
+
+    def is_available(self, url: str) -> bool:
+        """Check whether the backend for a URL is believed to be available.
+        """
+        return not self.get_backend(URL(url)).breaker.is_open
+
+    def request(self, method: str, url, **kwargs) -> _RequestContextManager:
+        return _RequestContextManager(self, method, url, kwargs)
+
+    def get(self, url, **kwargs) -> _RequestContextManager:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs) -> _RequestContextManager:
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs) -> _RequestContextManager:
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs) -> _RequestContextManager:
+        return self.request('DELETE', url, **kwargs)
+
+    def head(self, url, **kwargs) -> _RequestContextManager:
+        return self.request('HEAD', url, **kwargs)
+
+    def ws_connect(self, url, **kwargs):
+        # Websockets are long-lived, so they're not subject to the
+        # concurrency limits or circuit breakers.
+        return self.session.ws_connect(url, **kwargs)
+
+    @property
+    def closed(self) -> bool:
+        return self.session.closed
+
+    async def close(self) -> None:
+        await self.session.close()
@@ -22,15 +22,94 @@ from aiohttp import (
     ServerDisconnectedError,
     )
 import gzip
+import inspect
 from io import BytesIO
 import os
+from typing import AsyncIterator, Optional, Tuple
 from yarl import URL
+import zlib
+
+
+# Size of the chunks in which logs are streamed.
+CHUNK_SIZE = 64 * 1024
 
 
 class ServiceUnavailable(Exception):
     """The remote server is temporarily unavailable."""
 
 
+class ChunkStream(object):
+    """A stream of chunks read from an underlying resource.
+
+    Unlike an async generator, aclose() releases the resource even if
+    iteration never started (e.g. for HEAD requests).
+    """
+
+    def __init__(self, read, close, chunk_size: int = CHUNK_SIZE):
+        """Create a chunk stream.
+
+        Args:
+          read: Coroutine function that reads up to a number of bytes and
+            returns an empty bytestring at the end of the stream
+          close: Function that releases the resource; may return an
+            awaitable
+          chunk_size: Maximum size of the chunks
+        """
+        self._read = read
+        self._close = close
+        self._chunk_size = chunk_size
+        self._closed = False
+
+    def __aiter__(self) -> 'ChunkStream':
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self._closed:
+            raise StopAsyncIteration
+        chunk = await self._read(self._chunk_size)
+        if not chunk:
+            await self.aclose()
+            raise StopAsyncIteration
+        return chunk
+
+    async def aclose(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        ret = self._close()
+        if inspect.isawaitable(ret):
+            await ret
+
+
+def iter_file_chunks(f, chunk_size: int = CHUNK_SIZE) -> ChunkStream:
+    """Stream the contents of a file object, closing it afterwards."""
+    async def read(size):
+        return f.read(size)
+    return ChunkStream(read, f.close, chunk_size)
+
+
+async def gunzip_chunks(
+        chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Decompress a gzip stream, one chunk at a time.
+
+    Like gzip.GzipFile, this supports streams with multiple members.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            if not decompressor.eof:
+                break
+            # Start of the next member, if any.
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
 class LogFileManager(object):
 
     async def has_log(self, pkg, run_id, name, timeout=None):
@@ -39,6 +118,23 @@ class LogFileManager(object):
     async def get_log(self, pkg, run_id, name, timeout=None):
         raise NotImplementedError(self.get_log)
 
+    async def iter_log_chunks(
+            self, pkg, run_id, name, timeout=None
+            ) -> Tuple[Optional[str], ChunkStream]:
+        """Retrieve a log file as a stream of chunks.
+
+        Unlike get_log, this doesn't keep the whole log in memory, and
+        returns the log as it is stored (i.e. possibly compressed). The
+        caller is responsible for closing the stream.
+
+        Returns:
+          tuple with content encoding ('gzip' or None) and chunks
+        Raises:
+          FileNotFoundError: if the log does not exist
+        """
+        return None, iter_file_chunks(
+            await self.get_log(pkg, run_id, name, timeout=timeout))
+
     async def import_log(self, pkg, run_id, orig_path, timeout=None):
         raise NotImplementedError(self.import_log)
 
@@ -69,6 +165,17 @@ class FileSystemLogFileManager(LogFileManager):
                 return open(path, 'rb')
         raise FileNotFoundError(name)
 
+    async def iter_log_chunks(self, pkg, run_id, name, timeout=None):
+        for path in self._get_paths(pkg, run_id, name):
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            return (
+                'gzip' if path.endswith('.gz') else None,
+                iter_file_chunks(f))
+        raise FileNotFoundError(name)
+
     async def import_log(self, pkg, run_id, orig_path, timeout=None):
         dest_dir = os.path.join(self.log_directory, pkg, run_id)
         os.makedirs(dest_dir, exist_ok=True)
@@ -132,6 +239,24 @@ class S3LogFileManager(LogFileManager):
                 'Unexpected response code %d: %s' % (
                     resp.status, await resp.text()))
 
+    async def iter_log_chunks(self, pkg, run_id, name, timeout=10):
+        url = self._get_url(pkg, run_id, name)
+        # Only limit the time spent waiting for data, since big logs can
+        # take a while to stream.
+        client_timeout = ClientTimeout(sock_connect=timeout, sock_read=timeout)
+        resp = await self.session.get(url, timeout=client_timeout)
+        if resp.status != 200:
+            async with resp:
+                if resp.status == 404:
+                    raise FileNotFoundError(name)
+                if resp.status == 403:
+                    raise PermissionError(await resp.text())
+                raise LogRetrievalError(
+                    'Unexpected response code %d: %s' % (
+                        resp.status, await resp.text()))
+
+        return 'gzip', ChunkStream(resp.content.read, resp.release)
+
     async def import_log(self, pkg, run_id, orig_path, timeout=360):
         with open(orig_path, 'rb') as f:
             data = gzip.compress(f.read())
@@ -174,6 +299,22 @@ class GCSLogFilemanager(LogFileManager):
         except ServerDisconnectedError:
             raise ServiceUnavailable()
 
+    async def iter_log_chunks(self, pkg, run_id, name, timeout=30):
+        object_name = self._get_object_name(pkg, run_id, name)
+        try:
+            stream = await self.storage.download_stream(
+                self.bucket_name, object_name, session=self.session,
+                timeout=timeout)
+        except ClientResponseError as e:
+            if e.status == 404:
+                raise FileNotFoundError(name)
+            raise ServiceUnavailable()
+        except ServerDisconnectedError:
+            raise ServiceUnavailable()
+
+        return 'gzip', ChunkStream(
+            stream.read, lambda: stream.__aexit__(None, None, None))
+
     async def import_log(self, pkg, run_id, orig_path, timeout=360):
         object_name = self._get_object_name(
             pkg, run_id, os.path.basename(orig_path))
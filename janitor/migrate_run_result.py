@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+# Copyright (C) 2021 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Conversion of run.result from json to jsonb.
+
+Changing the type of the column in place, or adding stored generated
+columns, rewrites the whole run table while holding an exclusive lock on it.
+Instead, existing databases are converted in steps that each only take
+short locks, and that can be re-run if interrupted:
+
+ prepare: add result_jsonb and the result_* field columns as regular
+   columns, with a trigger that fills them in for new and updated runs
+ backfill: fill in the new columns for existing runs, in small batches
+ swap: replace result with result_jsonb, and recreate the views that
+   depend on it from state.sql
+ index: create the indexes on the result_* columns, one partition at a
+   time and without blocking writes
+
+On a converted database the result_* columns are maintained by the trigger
+rather than generated by PostgreSQL; queries can't tell the difference.
+"""
+
+import asyncio
+import re
+from typing import List, Tuple
+
+import asyncpg
+
+from .run_archive import iter_partition_tables
+from .trace import note, warning
+
+
+# Column name, type and expression (given the jsonb result) for the fields
+# from result that are stored in their own column. These need to match the
+# generated columns in state.sql.
+RESULT_FIELDS: List[Tuple[str, str, str]] = [
+    ('result_fixed_lintian_tags', 'jsonb',
+     "jsonb_path_query_array(%s, '$.applied[*].fixed_lintian_tags[*]')"),
+    ('result_applied_hint_links', 'jsonb',
+     "jsonb_path_query_array(%s, '$.\"applied-hints\"[*].link')"),
+    ('result_upstream_branch_url', 'text',
+     "%s->>'upstream_branch_url'"),
+    ('result_lintian_brush_version', 'text',
+     "%s#>>'{versions,lintian-brush}'"),
+]
+
+# Index name suffix and definition for the indexes on the fields in
+# RESULT_FIELDS, matching those in state.sql.
+RESULT_INDEXES: List[Tuple[str, str]] = [
+    ('result_fixed_lintian_tags_idx',
+     'USING gin (result_fixed_lintian_tags)'),
+    ('result_applied_hint_links_idx',
+     'USING gin (result_applied_hint_links)'),
+    ('suite_result_lintian_brush_version_idx',
+     '(suite, result_lintian_brush_version)'),
+]
+
+DEFAULT_BATCH_SIZE = 1000
+
+# Give up on schema changes rather than blocking other queries while waiting
+# for a lock.
+LOCK_TIMEOUT = '10s'
+
+VIEW_RE = re.compile(
+    r'^CREATE (?:OR REPLACE )?VIEW (\w+) AS.*?;$', re.M | re.S | re.I)
+
+
+class BackfillIncomplete(Exception):
+    """Not all runs have been backfilled yet."""
+
+    def __init__(self, count):
+        self.count = count
+
+
+def _trigger_function(with_jsonb: bool) -> str:
+    assignments = []
+    if with_jsonb:
+        assignments.append('NEW.result_jsonb := NEW.result::jsonb;')
+    for name, unused_type, expr in RESULT_FIELDS:
+        assignments.append(
+            'NEW.%s := %s;' % (name, expr % 'NEW.result::jsonb'))
+    return """\
+CREATE OR REPLACE FUNCTION set_run_result_fields()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS
+$$
+BEGIN
+  %s
+  RETURN NEW;
+END;
+$$""" % '\n  '.join(assignments)
+
+
+async def _create_trigger(conn: asyncpg.Connection, with_jsonb: bool):
+    await conn.execute(_trigger_function(with_jsonb))
+    await conn.execute(
+        'DROP TRIGGER IF EXISTS set_run_result_fields_trigger ON run')
+    await conn.execute("""\
+CREATE TRIGGER set_run_result_fields_trigger
+  BEFORE INSERT OR UPDATE OF result
+  ON run
+  FOR EACH ROW
+  EXECUTE PROCEDURE set_run_result_fields()""")
+
+
+async def prepare(conn: asyncpg.Connection) -> None:
+    async with conn.transaction():
+        await conn.execute("SET LOCAL lock_timeout = '%s'" % LOCK_TIMEOUT)
+        columns = [('result_jsonb', 'jsonb')] + [
+            (name, type) for (name, type, expr) in RESULT_FIELDS]
+        # Adding a nullable column without a default doesn't rewrite the
+        # table.
+        await conn.execute('ALTER TABLE run %s' % ', '.join([
+            'ADD COLUMN IF NOT EXISTS %s %s' % column for column in columns]))
+        await _create_trigger(conn, with_jsonb=True)
+
+
+async def backfill_partition(
+        conn: asyncpg.Connection, name: str,
+        batch_size: int = DEFAULT_BATCH_SIZE, pause: float = 0.0) -> int:
+    """Backfill the new columns for the runs in a single partition.
+
+    Every batch is committed separately, so that locks are only held
+    briefly.
+
+    Returns:
+      number of runs updated
+    """
+    assignments = ['result_jsonb = batch.result'] + [
+        '%s = %s' % (field, expr % 'batch.result')
+        for (field, type, expr) in RESULT_FIELDS]
+    query = """\
+UPDATE %(table)s SET %(assignments)s FROM (
+  SELECT id, result::jsonb AS result FROM %(table)s
+  WHERE id > $1 AND result IS NOT NULL AND result_jsonb IS NULL
+  ORDER BY id LIMIT $2) AS batch
+WHERE %(table)s.id = batch.id
+RETURNING %(table)s.id
+""" % {'table': name, 'assignments': ', '.join(assignments)}
+    last_id = ''
+    total = 0
+    while True:
+        rows = await conn.fetch(query, last_id, batch_size)
+        if not rows:
+            return total
+        last_id = max(row[0] for row in rows)
+        total += len(rows)
+        if pause:
+            await asyncio.sleep(pause)
+
+
+async def backfill(
+        conn: asyncpg.Connection, batch_size: int = DEFAULT_BATCH_SIZE,
+        pause: float = 0.0) -> int:
+    total = 0
+    for name in await iter_partition_tables(conn):
+        count = await backfill_partition(conn, name, batch_size, pause)
+        note('Backfilled %d runs in %s', count, name)
+        total += count
+    return total
+
+
+def read_view_definitions(schema: str) -> List[Tuple[str, str]]:
+    """Read the view definitions from a schema file.
+
+    Returns:
+      list of (name, statement) tuples, in the order they appear
+    """
+    return [(m.group(1), m.group(0)) for m in VIEW_RE.finditer(schema)]
+
+
+async def _list_views(conn: asyncpg.Connection) -> List[str]:
+    return [row[0] for row in await conn.fetch(
+        'SELECT viewname FROM pg_views WHERE schemaname = current_schema()')]
+
+
+async def swap(conn: asyncpg.Connection, schema: str) -> List[str]:
+    """Replace the json result column with the backfilled jsonb one.
+
+    Args:
+      conn: Database connection
+      schema: Contents of state.sql, used to recreate views
+    Returns:
+      names of the views that were recreated
+    """
+    # Check this before taking any locks, since it needs to scan the table.
+    missing = await conn.fetchval(
+        'SELECT count(*) FROM run '
+        'WHERE result IS NOT NULL AND result_jsonb IS NULL')
+    if missing:
+        raise BackfillIncomplete(missing)
+    views = read_view_definitions(schema)
+    async with conn.transaction():
+        await conn.execute("SET LOCAL lock_timeout = '%s'" % LOCK_TIMEOUT)
+        before = set(await _list_views(conn))
+        # Dropping a column only updates the catalog; this also drops all
+        # (indirectly) dependent views, which are recreated below.
+        await conn.execute('ALTER TABLE run DROP COLUMN result CASCADE')
+        await conn.execute(
+            'ALTER TABLE run RENAME COLUMN result_jsonb TO result')
+        # The trigger was dropped along with the old column.
+        await _create_trigger(conn, with_jsonb=False)
+        dropped = before - set(await _list_views(conn))
+        recreated = []
+        for name, statement in views:
+            if name in dropped:
+                await conn.execute(statement)
+                recreated.append(name)
+        for name in sorted(dropped - set(recreated)):
+            warning('View %s was dropped and is not defined in the schema',
+                    name)
+    return recreated
+
+
+async def create_indexes(conn: asyncpg.Connection) -> None:
+    """Create the indexes on the result fields.
+
+    Since CREATE INDEX CONCURRENTLY is not supported for partitioned tables,
+    this creates an index on just the parent table and then creates and
+    attaches an index for each partition.
+    """
+    for suffix, definition in RESULT_INDEXES:
+        parent = 'run_%s' % suffix
+        await conn.execute(
+            'CREATE INDEX IF NOT EXISTS %s ON ONLY run %s' % (
+                parent, definition))
+        for name in await iter_partition_tables(conn):
+            child = '%s_%s' % (name, suffix)
+            note('Creating index %s', child)
+            await conn.execute(
+                'CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s %s' % (
+                    child, name, definition))
+            await conn.execute(
+                'ALTER INDEX %s ATTACH PARTITION %s' % (parent, child))
+
+
+async def main(args):
+    from .config import read_config
+    from . import state
+
+    with open(args.config, 'r') as f:
+        config = read_config(f)
+
+    db = state.Database(config.database_location)
+    async with db.acquire() as conn:
+        if args.step == 'prepare':
+            await prepare(conn)
+        elif args.step == 'backfill':
+            count = await backfill(conn, args.batch_size, args.pause)
+            note('Backfilled %d runs', count)
+        elif args.step == 'swap':
+            with open(args.schema, 'r') as f:
+                schema = f.read()
+            try:
+                recreated = await swap(conn, schema)
+            except BackfillIncomplete as e:
+                warning('%d runs have not been backfilled yet', e.count)
+                return 1
+            note('Recreated views: %s', ', '.join(recreated))
+        elif args.step == 'index':
+            await create_indexes(conn)
+    return 0
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--config', type=str, default='janitor.conf',
+        help='Path to configuration.')
+    parser.add_argument(
+        'step', choices=['prepare', 'backfill', 'swap', 'index'],
+        help='Migration step to run.')
+    parser.add_argument(
+        '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+        help='Number of runs to update per transaction when backfilling.')
+    parser.add_argument(
+        '--pause', type=float, default=0.1,
+        help='Number of seconds to wait between batches when backfilling.')
+    parser.add_argument(
+        '--schema', type=str, default='state.sql',
+        help='Path to the database schema, used to recreate views.')
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args)))
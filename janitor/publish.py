@@ -1557,7 +1557,9 @@ def main(argv=None):
     topic_publish = Topic('publish')
     loop = asyncio.get_event_loop()
     vcs_manager = LocalVcsManager(config.vcs_location)
-    db = state.Database(config.database_location)
+    db = state.Database(
+        config.database_location,
+        slow_query_threshold=(config.slow_query_threshold or None))
     if args.once:
         loop.run_until_complete(publish_pending_new(
             db, rate_limiter, dry_run=args.dry_run,
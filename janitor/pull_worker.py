@@ -48,8 +48,13 @@ from breezy.controldir import ControlDir
 from breezy.transport import Transport
 
 from silver_platter.proposal import enable_tag_pushing
+from silver_platter.utils import (
+    open_branch,
+    BranchMissing,
+    BranchUnavailable,
+    )
 
-from janitor.trace import note
+from janitor.trace import note, warning
 from janitor.vcs import (
     RemoteVcsManager,
     MirrorFailure,
@@ -69,6 +74,7 @@ DEFAULT_UPLOAD_TIMEOUT = ClientTimeout(30 * 60)
 class ResultUploadFailure(Exception):
 
     def __init__(self, reason: str) -> None:
+        super(ResultUploadFailure, self).__init__(reason)
         self.reason = reason
 
 
@@ -167,7 +173,8 @@ def run_worker(branch_url, run_id, subpath, vcs_type, env,
                cached_branch_url=None,
                resume_subworker_result=None,
                resume_branches=None,
-               possible_transports=None):
+               possible_transports=None,
+               mirror_branch_url=None):
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     with copy_output(os.path.join(output_directory, 'worker.log')):
@@ -178,7 +185,7 @@ def run_worker(branch_url, run_id, subpath, vcs_type, env,
                pre_check_command=pre_check_command,
                post_check_command=post_check_command,
                resume_branch_url=resume_branch_url,
-               cached_branch_url=cached_branch_url,
+               cached_branch_url=mirror_branch_url or cached_branch_url,
                resume_subworker_result=resume_subworker_result,
                extra_resume_branches=[
                   (role, name) for (role, name, base, revision)
@@ -209,17 +216,45 @@ def run_worker(branch_url, run_id, subpath, vcs_type, env,
                 raise WorkerFailure(
                     'result-push-failed',
                     "Failed to push result branch: %s" % e)
-            note('Pushing packaging branch cache to %s',
-                 cached_branch_url)
-            push_branch(
-                ws.local_tree.branch,
-                cached_branch_url, vcs_type=vcs_type.lower(),
-                possible_transports=possible_transports,
-                stop_revision=ws.main_branch.last_revision(),
-                overwrite=True)
+            if cached_branch_url:
+                note('Pushing packaging branch cache to %s',
+                     cached_branch_url)
+                push_branch(
+                    ws.local_tree.branch,
+                    cached_branch_url, vcs_type=vcs_type.lower(),
+                    possible_transports=possible_transports,
+                    stop_revision=ws.main_branch.last_revision(),
+                    overwrite=True)
             return result
 
 
+def mirror_branch(branch_url, cached_branch_url, target_path, vcs_type,
+                  possible_transports=None):
+    """Create a local mirror of the main branch.
+
+    This allows runs that are part of the same assignment to share a single
+    clone of the main branch.
+
+    Args:
+      branch_url: URL of the main branch
+      cached_branch_url: URL of the cached copy of the main branch, if any
+      target_path: Path to create the mirror at
+      vcs_type: VCS type of the main branch
+    """
+    # Seed from the cache, then catch up with the main branch.
+    for url in [cached_branch_url, branch_url]:
+        if not url:
+            continue
+        try:
+            branch = open_branch(url, possible_transports=possible_transports)
+        except (BranchMissing, BranchUnavailable) as e:
+            note('Unable to mirror %s: %s', url, e)
+            continue
+        push_branch(
+            branch, target_path, vcs_type=vcs_type.lower(),
+            possible_transports=possible_transports, overwrite=True)
+
+
 async def get_assignment(
         session: ClientSession, base_url: str, node_name: str,
         jenkins_metadata: Optional[Dict[str, str]]) -> Any:
@@ -274,6 +309,71 @@ async def forward_logs(ws, directory):
         watcher.close()
 
 
+def start_log_forwarder(ws, directory):
+    """Start forwarding the logs written to a directory, if possible.
+
+    Returns:
+      forwarding task, or None if aionotify is not available
+    """
+    try:
+        import aionotify  # noqa: F401
+    except ImportError:
+        return None
+    return asyncio.create_task(forward_logs(ws, directory))
+
+
+async def process_batch_run(
+        session: ClientSession, base_url: str, batch_assignment: Any,
+        *args, **kwargs) -> Any:
+    """Process a run that was bundled into another run's assignment.
+
+    The logs of the run are forwarded over a progress connection of its own.
+    """
+    ws_url = urljoin(
+        base_url, 'active-runs/%s/progress' % batch_assignment['id'])
+    async with session.ws_connect(ws_url) as ws:
+        with TemporaryDirectory() as output_directory:
+            log_forwarder = start_log_forwarder(ws, output_directory)
+            try:
+                return await process_run(
+                    session, base_url, batch_assignment, *args,
+                    output_directory=output_directory, **kwargs)
+            finally:
+                if log_forwarder is not None:
+                    log_forwarder.cancel()
+
+
+async def process_batch(
+        session: ClientSession, base_url: str, batch: List[Any],
+        *args, debug: bool = False, **kwargs) -> bool:
+    """Process the runs that were bundled into an assignment.
+
+    The bundled runs are independent of each other, so a failure in one of
+    them doesn't stop the others from being processed.
+
+    Args:
+      batch: Suite-specific parts of the bundled runs
+    Returns:
+      whether the results of all runs were uploaded
+    """
+    uploaded = True
+    for batch_assignment in batch:
+        try:
+            result = await process_batch_run(
+                session, base_url, batch_assignment, *args, **kwargs)
+        except ResultUploadFailure as e:
+            warning('Unable to upload results for run %s: %s',
+                    batch_assignment['id'], e.reason)
+            uploaded = False
+        except Exception as e:
+            warning('Processing run %s failed: %r',
+                    batch_assignment['id'], e)
+        else:
+            if debug:
+                print(result)
+    return uploaded
+
+
 async def main(argv=None):
     parser = argparse.ArgumentParser(
         prog='janitor-pull-worker',
@@ -371,100 +471,176 @@ async def main(argv=None):
             with open(desc_path, 'w') as f:
                 f.write(assignment['description'])
 
-        suite = assignment['suite']
         branch_url = assignment['branch']['url']
         vcs_type = assignment['branch']['vcs_type']
         subpath = assignment['branch'].get('subpath', '') or ''
-        if assignment['resume']:
-            resume_result = assignment['resume'].get('result')
-            resume_branch_url = assignment['resume']['branch_url'].rstrip('/')
-            resume_branches = [
-                (role, name, base.encode('utf-8'), revision.encode('utf-8'))
-                for (role, name, base, revision) in assignment['resume']['branches']]
-        else:
-            resume_result = None
-            resume_branch_url = None
-            resume_branches = None
         cached_branch_url = assignment['branch'].get('cached_url')
-        command = assignment['command']
-        build_environment = assignment['build'].get('environment', {})
 
         vcs_manager = RemoteVcsManager(assignment['vcs_manager'])
-        legacy_branch_name = assignment['legacy_branch_name']
-        run_id = assignment['id']
 
         possible_transports = []
 
         env = assignment['env']
 
         os.environ.update(env)
-        os.environ.update(build_environment)
+        base_environ = dict(os.environ)
 
-        metadata = {}
-        if jenkins_metadata:
-            metadata['jenkins'] = jenkins_metadata
+        # Other queue items for the same package that were bundled into
+        # this assignment; these share a single clone of the main branch.
+        batch = assignment.get('batch') or []
 
-        with TemporaryDirectory() as output_directory:
+        exit_code = 0
+
+        with ExitStack() as es:
+            output_directory = es.enter_context(TemporaryDirectory())
             loop = asyncio.get_running_loop()
-            try:
-                import aionotify  # noqa: F401
-            except ImportError:
-                log_forwarder = None
-            else:
-                log_forwarder = asyncio.create_task(
-                    forward_logs(ws, output_directory))
+            log_forwarder = start_log_forwarder(ws, output_directory)
 
-            metadata = {}
-            start_time = datetime.now()
-            metadata['start_time'] = start_time.isoformat()
             try:
-                result = await loop.run_in_executor(None, functools.partial(
-                    run_worker, branch_url, run_id, subpath, vcs_type,
-                    os.environ, command, output_directory, metadata,
-                    vcs_manager, legacy_branch_name, suite,
+                mirror_branch_url = None
+                if batch and vcs_type:
+                    mirror_path = os.path.join(
+                        es.enter_context(TemporaryDirectory()), 'main')
+                    try:
+                        await loop.run_in_executor(None, functools.partial(
+                            mirror_branch, branch_url, cached_branch_url,
+                            mirror_path, vcs_type,
+                            possible_transports=possible_transports))
+                    except Exception as e:
+                        # The runs can still start from the cached copy of
+                        # the main branch, or from the main branch itself.
+                        warning('Unable to mirror %s: %r', branch_url, e)
+                        mirror_branch_url = cached_branch_url
+                    else:
+                        mirror_branch_url = mirror_path
+
+                kwargs = dict(
+                    jenkins_metadata=jenkins_metadata,
                     build_command=args.build_command,
                     pre_check_command=args.pre_check,
                     post_check_command=args.post_check,
-                    resume_branch_url=resume_branch_url,
-                    resume_branches=resume_branches,
-                    cached_branch_url=cached_branch_url,
-                    resume_subworker_result=resume_result,
-                    possible_transports=possible_transports))
-            except WorkerFailure as e:
-                metadata['code'] = e.code
-                metadata['description'] = e.description
-                note('Worker failed (%s): %s', e.code, e.description)
-                # This is a failure for the worker, but returning 0 will cause
-                # jenkins to mark the job having failed, which is not really
-                # true.  We're happy if we get to successfully POST to /finish
-                return 0
-            except BaseException as e:
-                metadata['code'] = 'worker-exception'
-                metadata['description'] = str(e)
-                raise
-            else:
-                metadata['code'] = None
-                metadata.update(result.json())
-                note('%s', result.description)
-
-                return 0
-            finally:
-                finish_time = datetime.now()
-                note('Elapsed time: %s', finish_time - start_time)
-
+                    mirror_branch_url=mirror_branch_url,
+                    possible_transports=possible_transports)
                 try:
-                    result = await upload_results(
-                        session, args.base_url, assignment['id'], metadata,
-                        output_directory)
+                    result = await process_run(
+                        session, args.base_url, assignment, base_environ,
+                        branch_url, subpath, vcs_type, vcs_manager,
+                        output_directory, cached_branch_url=cached_branch_url,
+                        **kwargs)
                 except ResultUploadFailure as e:
-                    sys.stderr.write(str(e))
-                    sys.exit(1)
-
-                watchdog_petter.cancel()
+                    sys.stderr.write('%s\n' % e.reason)
+                    exit_code = 1
+                else:
+                    if args.debug:
+                        print(result)
+                finally:
+                    if log_forwarder is not None:
+                        log_forwarder.cancel()
+                    # The bundled runs are independent of the first one, so
+                    # process them even if it failed.
+                    if not await process_batch(
+                            session, args.base_url, batch, base_environ,
+                            branch_url, subpath, vcs_type, vcs_manager,
+                            debug=args.debug, **kwargs):
+                        exit_code = 1
+            finally:
                 if log_forwarder is not None:
                     log_forwarder.cancel()
-                if args.debug:
-                    print(result)
+                watchdog_petter.cancel()
+        return exit_code
+
+
+async def process_run(
+        session: ClientSession, base_url: str, run_assignment: Any,
+        environ: Dict[str, str], branch_url: str, subpath: str, vcs_type: str,
+        vcs_manager: RemoteVcsManager, output_directory: str,
+        jenkins_metadata: Optional[Dict[str, str]] = None,
+        build_command: Optional[str] = None,
+        pre_check_command: Optional[str] = None,
+        post_check_command: Optional[str] = None,
+        cached_branch_url: Optional[str] = None,
+        mirror_branch_url: Optional[str] = None,
+        possible_transports: Optional[List[Transport]] = None) -> Any:
+    """Process a single run from an assignment and upload the results.
+
+    Args:
+      run_assignment: Suite-specific part of the assignment
+      environ: Base environment to run the worker in
+    Returns:
+      JSON response from the server
+    Raises:
+      ResultUploadFailure: if the results could not be uploaded
+    """
+    os.environ.clear()
+    os.environ.update(environ)
+    os.environ.update(run_assignment['build'].get('environment', {}))
+
+    run_id = run_assignment['id']
+    suite = run_assignment['suite']
+    if run_assignment['resume']:
+        resume_result = run_assignment['resume'].get('result')
+        resume_branch_url = run_assignment['resume']['branch_url'].rstrip('/')
+        resume_branches = [
+            (role, name, base.encode('utf-8'), revision.encode('utf-8'))
+            for (role, name, base, revision)
+            in run_assignment['resume']['branches']]
+    else:
+        resume_result = None
+        resume_branch_url = None
+        resume_branches = None
+    command = run_assignment['command']
+    legacy_branch_name = run_assignment['legacy_branch_name']
+
+    loop = asyncio.get_running_loop()
+
+    metadata = {}
+    if jenkins_metadata:
+        metadata['jenkins'] = jenkins_metadata
+    start_time = datetime.now()
+    metadata['start_time'] = start_time.isoformat()
+    try:
+        result = await loop.run_in_executor(None, functools.partial(
+            run_worker, branch_url, run_id, subpath, vcs_type,
+            os.environ, command, output_directory, metadata,
+            vcs_manager, legacy_branch_name, suite,
+            build_command=build_command,
+            pre_check_command=pre_check_command,
+            post_check_command=post_check_command,
+            resume_branch_url=resume_branch_url,
+            resume_branches=resume_branches,
+            cached_branch_url=cached_branch_url,
+            resume_subworker_result=resume_result,
+            possible_transports=possible_transports,
+            mirror_branch_url=mirror_branch_url))
+    except WorkerFailure as e:
+        metadata['code'] = e.code
+        metadata['description'] = e.description
+        note('Worker failed (%s): %s', e.code, e.description)
+        # This is a failure for the worker, but returning non-zero will
+        # cause jenkins to mark the job having failed, which is not really
+        # true.  We're happy if we get to successfully POST to /finish
+    except BaseException as e:
+        metadata['code'] = 'worker-exception'
+        metadata['description'] = str(e)
+        raise
+    else:
+        metadata['code'] = None
+        metadata.update(result.json())
+        note('%s', result.description)
+    finally:
+        finish_time = datetime.now()
+        note('Elapsed time: %s', finish_time - start_time)
+
+        try:
+            response = await upload_results(
+                session, base_url, run_id, metadata, output_directory)
+        except ResultUploadFailure as e:
+            if metadata['code'] != 'worker-exception':
+                raise
+            # Don't hide the exception that made the run fail.
+            warning('Unable to upload results for run %s: %s',
+                    run_id, e.reason)
+    return response
 
 
 if __name__ == '__main__':
@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+# Copyright (C) 2021 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Maintenance of the daily rollup tables used by the stats graphs.
+
+Refreshing a rollup table recomputes the rows for the most recent days, so
+that the graphs don't have to aggregate the full history on every request.
+The runner does this periodically; running this module rebuilds the rollups
+from scratch, e.g. after creating the tables.
+"""
+
+import asyncio
+import datetime
+from typing import Optional
+
+import asyncpg
+
+from .trace import note
+
+
+# Number of days before the most recent day in a rollup table to recompute.
+# Runs are stored when they finish, so runs that started shortly before
+# midnight can still show up the next day.
+REFRESH_DAYS = 2
+
+# Queries that insert the rollup rows for all days on or after $1.
+ROLLUP_QUERIES = {
+    'run_rollup': """\
+INSERT INTO run_rollup (day, suite, result_code, duration_bucket, count)
+SELECT
+  start_time::date,
+  suite,
+  result_code,
+  (2 ^ floor(log(2, greatest(1, coalesce(
+    extract(epoch FROM finish_time - start_time), 0))::numeric)))::integer,
+  count(*)
+FROM run
+WHERE start_time >= $1
+GROUP BY 1, 2, 3, 4
+""",
+    'publish_rollup': """\
+INSERT INTO publish_rollup (day, mode, result_code, count)
+SELECT timestamp::date, mode, result_code, count(*)
+FROM publish
+WHERE timestamp >= $1
+GROUP BY 1, 2, 3
+""",
+    # A merge proposal counts as opened on the day of the first successful
+    # publish that proposed it, and as merged on the day the janitor
+    # recorded the merge: the publisher can notice a merge days after it
+    # happened, and merges before that day are no longer recomputed.
+    # Proposals merged before status_changed was tracked fall back to
+    # merged_at.
+    'merge_proposal_rollup': """\
+INSERT INTO merge_proposal_rollup (day, event, count)
+SELECT first_timestamp::date, 'opened', count(*) FROM (
+  SELECT merge_proposal_url, min(timestamp) AS first_timestamp FROM publish
+  WHERE mode = 'propose' AND result_code = 'success' AND
+  merge_proposal_url IN (
+    SELECT merge_proposal_url FROM publish
+    WHERE timestamp >= $1 AND mode = 'propose' AND result_code = 'success')
+  GROUP BY merge_proposal_url) AS opened
+WHERE first_timestamp >= $1
+GROUP BY 1
+UNION ALL
+SELECT coalesce(status_changed, merged_at)::date, 'merged', count(*)
+FROM merge_proposal
+WHERE status = 'merged' AND coalesce(status_changed, merged_at) >= $1
+GROUP BY 1
+""",
+}
+
+
+async def refresh_rollup(
+        conn: asyncpg.Connection, table: str,
+        since: Optional[datetime.date] = None) -> datetime.date:
+    """Recompute the rows in a rollup table.
+
+    Args:
+      conn: Database connection
+      table: Name of the rollup table
+      since: First day to recompute; defaults to REFRESH_DAYS before the
+        most recent day in the table, or all days if the table is empty
+    Returns:
+      first day that was recomputed
+    """
+    if since is None:
+        last_day = await conn.fetchval('SELECT max(day) FROM %s' % table)
+        if last_day is None:
+            since = datetime.date.min
+        else:
+            since = last_day - datetime.timedelta(days=REFRESH_DAYS)
+    async with conn.transaction():
+        await conn.execute('DELETE FROM %s WHERE day >= $1' % table, since)
+        await conn.execute(ROLLUP_QUERIES[table], since)
+    return since
+
+
+async def refresh_rollups(
+        conn: asyncpg.Connection,
+        since: Optional[datetime.date] = None) -> None:
+    for table in ROLLUP_QUERIES:
+        await refresh_rollup(conn, table, since)
+
+
+async def main(args):
+    from .config import read_config
+    from . import state
+
+    with open(args.config, 'r') as f:
+        config = read_config(f)
+
+    if args.since:
+        since = datetime.date.fromisoformat(args.since)
+    else:
+        since = datetime.date.min
+
+    db = state.Database(config.database_location)
+    async with db.acquire() as conn:
+        for table in ROLLUP_QUERIES:
+            note('Rebuilding %s', table)
+            await refresh_rollup(conn, table, since)
+    return 0
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--config', type=str, default='janitor.conf',
+        help='Path to configuration.')
+    parser.add_argument(
+        '--since', type=str,
+        help='First day (YYYY-MM-DD) to recompute. Defaults to all days.')
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args)))
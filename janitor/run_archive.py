@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+# Copyright (C) 2021 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Management of the monthly partitions of the run table.
+
+New partitions are created ahead of time. Partitions older than a cutoff
+are exported to a log manager (which compresses them), detached and
+dropped, leaving a summary per package/suite in archived_run_summary.
+
+Runs in an archived partition that are still referenced (e.g. because they
+are the last run for a package/suite, or have an open merge proposal) are
+kept, and end up in the default partition.
+"""
+
+import asyncio
+import datetime
+import os
+import re
+import tempfile
+from typing import List, Tuple
+
+import asyncpg
+
+from .trace import note
+
+
+ARCHIVE_PACKAGE = '_archive'
+ARCHIVE_FILENAME = 'runs.json'
+
+PARTITION_RE = re.compile(r'^run_([0-9]{4})_([0-9]{2})$')
+
+
+def add_months(month: datetime.date, n: int) -> datetime.date:
+    i = month.year * 12 + month.month - 1 + n
+    return datetime.date(i // 12, i % 12 + 1, 1)
+
+
+def partition_name(month: datetime.date) -> str:
+    return 'run_%04d_%02d' % (month.year, month.month)
+
+
+async def iter_partition_tables(conn: asyncpg.Connection) -> List[str]:
+    """List all partitions of the run table, including the default one."""
+    return [row[0] for row in await conn.fetch("""
+SELECT child.relname FROM pg_inherits
+JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+WHERE parent.relname = 'run'
+ORDER BY child.relname
+""")]
+
+
+async def iter_partitions(
+        conn: asyncpg.Connection) -> List[Tuple[str, datetime.date]]:
+    """List the monthly partitions of the run table.
+
+    Returns:
+      list of (partition name, first day of month) tuples, oldest first
+    """
+    ret = []
+    for name in await iter_partition_tables(conn):
+        m = PARTITION_RE.match(name)
+        if m:
+            ret.append(
+                (name, datetime.date(int(m.group(1)), int(m.group(2)), 1)))
+    ret.sort(key=lambda x: x[1])
+    return ret
+
+
+async def insertable_columns(conn: asyncpg.Connection) -> List[str]:
+    """List the columns of the run table that are not generated."""
+    return [row[0] for row in await conn.fetch("""
+SELECT attname FROM pg_attribute
+WHERE attrelid = 'run'::regclass AND attnum > 0 AND NOT attisdropped
+AND attgenerated = ''
+ORDER BY attnum
+""")]
+
+
+async def create_partition(
+        conn: asyncpg.Connection, month: datetime.date) -> None:
+    await conn.execute(
+        "CREATE TABLE IF NOT EXISTS %s PARTITION OF run "
+        "FOR VALUES FROM ('%s') TO ('%s')" % (
+            partition_name(month), month.isoformat(),
+            add_months(month, 1).isoformat()))
+
+
+# Runs that need to stay around, even if their partition is archived.
+RETAINED_RUNS_QUERY = """\
+SELECT run_id FROM last_run
+UNION SELECT run_id FROM last_effective_run
+UNION SELECT run_id FROM last_unabsorbed_run
+UNION SELECT run_id FROM new_result_branch rb
+  WHERE EXISTS (
+    SELECT FROM merge_proposal
+    WHERE merge_proposal.revision = rb.revision AND status = 'open')
+"""
+
+
+# Tables with per-run rows that are removed along with archived runs. All of
+# these reference run_key, so run_key rows are removed last.
+RUN_CHILD_TABLES = [
+    'new_result_branch', 'debian_build', 'run_lintian_fix',
+    'build_log_summary']
+
+
+async def export_partition(
+        conn: asyncpg.Connection, name: str, path: str) -> List[str]:
+    """Export the runs in a partition that don't need to be retained.
+
+    This only reads from the partition, so it can run while the partition is
+    still attached.
+
+    Args:
+      conn: Database connection
+      name: Name of the partition
+      path: Path of the file to write the runs to, one JSON object per line
+    Returns:
+      ids of the exported runs
+    """
+    ids = []
+    async with conn.transaction(isolation='repeatable_read', readonly=True):
+        with open(path, 'w') as f:
+            async for row in conn.cursor("""
+SELECT r.id, row_to_json(r)::text FROM (
+  SELECT p.*,
+    (SELECT json_agg(rb) FROM new_result_branch rb WHERE rb.run_id = p.id)
+      AS new_result_branch,
+    (SELECT json_agg(db) FROM debian_build db WHERE db.run_id = p.id)
+      AS debian_build,
+    (SELECT summary FROM build_log_summary bls WHERE bls.run_id = p.id)
+      AS build_log_summary
+  FROM %s p WHERE id NOT IN (%s)
+) r""" % (name, RETAINED_RUNS_QUERY)):
+                f.write(row[1] + '\n')
+                ids.append(row[0])
+    return ids
+
+
+async def archive_partition(
+        conn: asyncpg.Connection, logfile_manager, name: str) -> int:
+    """Move the runs in a partition to cold storage.
+
+    The runs are exported and uploaded before the partition is detached, so
+    that the run table is only locked for the short transaction that
+    detaches and drops the partition. Runs that became retained since the
+    export are kept (but also present in the export), as are runs that were
+    not exported at all.
+
+    Args:
+      conn: Database connection
+      logfile_manager: Log file manager to export the runs to
+      name: Name of the partition
+    Returns:
+      number of runs archived
+    """
+    if not PARTITION_RE.match(name):
+        raise ValueError('invalid partition name %r' % name)
+    with tempfile.TemporaryDirectory() as td:
+        path = os.path.join(td, ARCHIVE_FILENAME)
+        exported = await export_partition(conn, name, path)
+        await logfile_manager.import_log(ARCHIVE_PACKAGE, name, path)
+    async with conn.transaction():
+        await conn.execute('ALTER TABLE run DETACH PARTITION %s' % name)
+        await conn.execute(
+            'CREATE TEMPORARY TABLE archived_run ON COMMIT DROP AS '
+            'SELECT id FROM %s WHERE id = ANY($1::text[]) '
+            'AND id NOT IN (%s)' % (name, RETAINED_RUNS_QUERY), exported)
+        # The default partition picks these up, since there is no longer a
+        # partition covering their start time.
+        columns = ', '.join(await insertable_columns(conn))
+        await conn.execute(
+            'INSERT INTO run (%s) SELECT %s FROM %s '
+            'WHERE id NOT IN (SELECT id FROM archived_run)' % (
+                columns, columns, name))
+        await conn.execute("""
+INSERT INTO archived_run_summary (
+  package, suite, archive, run_count, success_count, first_start_time,
+  last_start_time, last_result_code)
+SELECT
+  package, suite, '%s', count(*), count(*) FILTER (
+    WHERE result_code = 'success'),
+  min(start_time), max(start_time),
+  (array_agg(result_code ORDER BY start_time DESC))[1]
+FROM %s WHERE id IN (SELECT id FROM archived_run)
+GROUP BY package, suite
+ON CONFLICT (package, suite, archive) DO NOTHING
+""" % (name, name))
+        for table in RUN_CHILD_TABLES:
+            await conn.execute(
+                'DELETE FROM %s WHERE run_id IN '
+                '(SELECT id FROM archived_run)' % table)
+        # Dropping the partition doesn't fire the triggers that maintain
+        # run_key.
+        count = int((await conn.execute(
+            'DELETE FROM run_key WHERE id IN '
+            '(SELECT id FROM archived_run)')).split()[-1])
+        await conn.execute('DROP TABLE %s' % name)
+    return count
+
+
+async def main(args):
+    from .config import read_config
+    from .logs import get_log_manager
+    from . import state
+
+    with open(args.config, 'r') as f:
+        config = read_config(f)
+
+    today = datetime.date.today()
+    this_month = datetime.date(today.year, today.month, 1)
+    if args.first_month:
+        year, month = args.first_month.split('-')
+        first_month = datetime.date(int(year), int(month), 1)
+    else:
+        first_month = this_month
+
+    db = state.Database(config.database_location)
+    async with db.acquire() as conn:
+        partitions = await iter_partitions(conn)
+        existing = set([month for (name, month) in partitions])
+        month = first_month
+        while month <= add_months(this_month, args.create_months):
+            if month not in existing:
+                note('Creating partition %s', partition_name(month))
+                if not args.dry_run:
+                    await create_partition(conn, month)
+            month = add_months(month, 1)
+
+        if args.keep_months is None:
+            return 0
+
+        logfile_manager = get_log_manager(args.archive_location)
+        cutoff = add_months(this_month, -args.keep_months)
+        for name, month in partitions:
+            if month >= cutoff:
+                continue
+            note('Archiving partition %s', name)
+            if not args.dry_run:
+                count = await archive_partition(conn, logfile_manager, name)
+                note('Archived %d runs from %s', count, name)
+    return 0
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--config', type=str, default='janitor.conf',
+        help='Path to configuration.')
+    parser.add_argument(
+        '--first-month', type=str,
+        help='First month (YYYY-MM) to create a partition for. '
+             'Defaults to the current month.')
+    parser.add_argument(
+        '--create-months', type=int, default=3,
+        help='Number of months ahead to create partitions for.')
+    parser.add_argument(
+        '--keep-months', type=int,
+        help='Archive partitions older than this number of months.')
+    parser.add_argument(
+        '--archive-location', type=str,
+        help='Location to export archived runs to; either a local '
+             'directory or a log manager location.')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help="Only report what would be done, don't change anything.")
+    args = parser.parse_args()
+    if args.keep_months is not None and not args.archive_location:
+        parser.error('--archive-location is required with --keep-months')
+    sys.exit(asyncio.run(main(args)))
@@ -81,6 +81,7 @@ from .debian import (
     NoChangesFile,
     )
 from .debian import state as debian_state
+from .debian.build_log import summarize_build_log_file
 from .logs import (
     get_log_manager,
     ServiceUnavailable,
@@ -136,6 +137,12 @@ review_status_count = Gauge(
     'review_status_count', 'Last runs by review status.',
     labelnames=('review_status',))
 
+# How often to refresh the rollup tables for the stats graphs (in seconds).
+ROLLUP_REFRESH_INTERVAL = 5 * 60
+
+# How often to delete expired site sessions (in seconds).
+SITE_SESSION_EXPIRY_INTERVAL = 60 * 60
+
 
 class DebianResult(object):
 
@@ -189,7 +196,8 @@ class JanitorResult(object):
 
     def __init__(self, pkg, log_id, branch_url, description=None,
                  code=None, worker_result=None,
-                 logfilenames=None, legacy_branch_name=None):
+                 logfilenames=None, legacy_branch_name=None,
+                 build_log_summary=None):
         self.package = pkg
         self.log_id = log_id
         self.description = description
@@ -197,6 +205,7 @@ class JanitorResult(object):
         self.code = code
         self.legacy_branch_name = legacy_branch_name
         self.logfilenames = logfilenames
+        self.build_log_summary = build_log_summary
         if worker_result:
             self.context = worker_result.context
             if self.code is None:
@@ -440,6 +449,17 @@ async def import_logs(output_directory: str,
     return logfilenames
 
 
+def summarize_build_log(output_directory: str) -> Optional[Dict[str, Any]]:
+    try:
+        return summarize_build_log_file(output_directory)
+    except Exception as e:
+        # The summary is only used to speed up the run pages; don't fail
+        # the run because of it.
+        warning('Unable to summarize build log in %s: %r',
+                output_directory, e)
+        return None
+
+
 class ActiveRun(object):
     """Tracks state of an active run."""
 
@@ -501,7 +521,8 @@ class ActiveRemoteRun(ActiveRun):
 
     def __init__(self, queue_item: state.QueueItem, worker_name: str,
                  legacy_branch_name: str,
-                 jenkins_metadata: Optional[Dict[str, str]] = None):
+                 jenkins_metadata: Optional[Dict[str, str]] = None,
+                 batch_id: Optional[str] = None):
         super(ActiveRemoteRun, self).__init__(queue_item)
         self.worker_name = worker_name
         self.log_files = {}
@@ -511,9 +532,11 @@ class ActiveRemoteRun(ActiveRun):
         self.legacy_branch_name = legacy_branch_name
         self._watch_dog = None
         self._jenkins_metadata = jenkins_metadata
+        # Id of the run whose assignment this run was bundled with, if any.
+        self.batch_id = batch_id
 
     def _extra_json(self):
-        return {'jenkins': self._jenkins_metadata}
+        return {'jenkins': self._jenkins_metadata, 'batch_id': self.batch_id}
 
     @property
     def worker_link(self):
@@ -870,6 +893,8 @@ class ActiveLocalRun(ActiveRun):
         logfilenames = await import_logs(
             self.output_directory, logfile_manager,
             backup_logfile_manager, self.queue_item.package, self.log_id)
+        build_log_summary = await asyncio.get_running_loop().run_in_executor(
+            None, summarize_build_log, self.output_directory)
 
         if retcode != 0:
             if retcode < 0:
@@ -887,7 +912,8 @@ class ActiveLocalRun(ActiveRun):
                 self.queue_item.package, log_id=self.log_id,
                 branch_url=full_branch_url(main_branch), code=code,
                 description=description,
-                logfilenames=logfilenames)
+                logfilenames=logfilenames,
+                build_log_summary=build_log_summary)
 
         json_result_path = os.path.join(self.output_directory, 'result.json')
         if os.path.exists(json_result_path):
@@ -902,7 +928,8 @@ class ActiveLocalRun(ActiveRun):
                 self.queue_item.package, log_id=self.log_id,
                 branch_url=full_branch_url(main_branch),
                 worker_result=worker_result,
-                logfilenames=logfilenames, legacy_branch_name=(
+                logfilenames=logfilenames,
+                build_log_summary=build_log_summary, legacy_branch_name=(
                     resume.legacy_branch_name
                     if resume and worker_result.code == 'nothing-to-do'
                     else None))
@@ -911,7 +938,8 @@ class ActiveLocalRun(ActiveRun):
             self.queue_item.package, log_id=self.log_id,
             branch_url=full_branch_url(main_branch),
             code='success', worker_result=worker_result,
-            logfilenames=logfilenames)
+            logfilenames=logfilenames,
+            build_log_summary=build_log_summary)
 
         try:
             result.target_result.from_directory(
@@ -930,7 +958,8 @@ class ActiveLocalRun(ActiveRun):
                 description='result branch unavailable: %s' % e,
                 code='result-branch-unavailable',
                 worker_result=worker_result,
-                logfilenames=logfilenames)
+                logfilenames=logfilenames,
+                build_log_summary=build_log_summary)
 
         enable_tag_pushing(local_branch)
 
@@ -972,6 +1001,23 @@ async def export_queue_length(db: state.Database) -> None:
         await asyncio.sleep(60)
 
 
+async def maintain_rollups(db: state.Database) -> None:
+    from .rollup import refresh_rollups
+    while True:
+        async with db.acquire() as conn:
+            await refresh_rollups(conn)
+        await asyncio.sleep(ROLLUP_REFRESH_INTERVAL)
+
+
+async def maintain_site_sessions(db: state.Database) -> None:
+    while True:
+        async with db.acquire() as conn:
+            count = await state.expire_site_sessions(conn)
+        if count:
+            note('Deleted %d expired site sessions.', count)
+        await asyncio.sleep(SITE_SESSION_EXPIRY_INTERVAL)
+
+
 async def export_stats(db: state.Database) -> None:
     while True:
         async with db.acquire() as conn:
@@ -1011,7 +1057,7 @@ class QueueProcessor(object):
             vcs_manager=None, public_vcs_manager=None, concurrency=1,
             use_cached_only=False, overall_timeout=None, committer=None,
             apt_location=None, backup_artifact_manager=None,
-            backup_logfile_manager=None):
+            backup_logfile_manager=None, batch_suites=False):
         """Create a queue processor.
 
         Args:
@@ -1019,6 +1065,8 @@ class QueueProcessor(object):
           build_command: The command used to build packages
           pre_check: Function to run prior to modifying a package
           post_check: Function to run after modifying a package
+          batch_suites: Whether to bundle queue items for the same package
+            into a single assignment for remote workers
         """
         self.database = database
         self.config = config
@@ -1041,6 +1089,7 @@ class QueueProcessor(object):
         self.apt_location = apt_location
         self.backup_artifact_manager = backup_artifact_manager
         self.backup_logfile_manager = backup_logfile_manager
+        self.batch_suites = batch_suites
 
     def status_json(self) -> Any:
         return {
@@ -1120,8 +1169,13 @@ class QueueProcessor(object):
                         conn, result.log_id, item.package,
                         result.target_result.build_version,
                         result.target_result.build_distribution)
+                if result.build_log_summary is not None:
+                    await debian_state.store_build_log_summary(
+                        conn, result.log_id, result.build_log_summary)
                 await state.drop_queue_item(conn, item.id)
-        self.topic_result.publish(result.json())
+        topic_entry = result.json()
+        topic_entry['suite'] = item.suite
+        self.topic_result.publish(topic_entry)
         del self.active_runs[active_run.log_id]
         self.topic_queue.publish(self.status_json())
         last_success_gauge.set_to_current_time()
@@ -1137,6 +1191,23 @@ class QueueProcessor(object):
                     ret.append(item)
             return ret
 
+    async def next_batch_items(
+            self, item: state.QueueItem) -> List[state.QueueItem]:
+        """Find other unassigned queue items for the same package."""
+        ret: List[state.QueueItem] = []
+        async with self.database.acquire() as conn:
+            async for other in state.iter_queue(conn, package=item.package):
+                if other.id == item.id or self.queue_item_assigned(other):
+                    continue
+                ret.append(other)
+        return ret
+
+    def batch_runs(self, batch_id: str) -> List[ActiveRun]:
+        """Return the active runs that were bundled with a run."""
+        return [
+            active_run for active_run in self.active_runs.values()
+            if getattr(active_run, 'batch_id', None) == batch_id]
+
     async def process(self) -> None:
         todo = set([
             self.process_queue_item(item)
@@ -1219,22 +1290,27 @@ async def handle_progress_ws(request):
         if msg.type == WSMsgType.BINARY:
             (run_id_bytes, rest) = msg.data.split(b'\0', 1)
             run_id = run_id_bytes.decode('utf-8')
-            try:
-                active_run = queue_processor.active_runs[run_id]
-            except KeyError:
+            active_run = queue_processor.active_runs.get(run_id)
+            # Runs that were bundled into the same assignment share the
+            # progress connection of the first run.
+            batch_runs = queue_processor.batch_runs(run_id)
+            if active_run is None and not batch_runs:
                 warning('No such current run: %s' % run_id)
                 continue
             if rest.startswith(b'log\0'):
                 (unused_kind, logname, data) = rest.split(b'\0', 2)
-                if active_run.append_log(logname.decode('utf-8'), data):
+                if active_run is not None and active_run.append_log(
+                        logname.decode('utf-8'), data):
                     # Make sure everybody is aware of the new log file.
                     queue_processor.topic_queue.publish(
                         queue_processor.status_json())
-                active_run.reset_keepalive()
-            elif rest == b'keepalive':
-                active_run.reset_keepalive()
-            else:
+            elif rest != b'keepalive':
                 warning('Unknown progress message %r for %s', rest, run_id)
+                continue
+            if active_run is not None:
+                active_run.reset_keepalive()
+            for batch_run in batch_runs:
+                batch_run.reset_keepalive()
 
     return ws
 
@@ -1269,6 +1345,60 @@ async def handle_log(request):
     return response
 
 
+async def suite_assignment(
+        conn, queue_processor, active_run, suite_config, main_branch,
+        vcs_type, possible_hosters=None):
+    """Create the suite-specific part of an assignment.
+
+    Args:
+      conn: Database connection
+      queue_processor: Queue processor
+      active_run: Active run to create the assignment for
+      suite_config: Configuration for the suite of the run
+      main_branch: Main branch, if it could be opened
+      vcs_type: VCS type of the main branch
+      possible_hosters: Hosters to reuse
+    Returns:
+      dictionary with assignment details
+    """
+    item = active_run.queue_item
+
+    # This is simple for now, since we only support one distribution.
+    distro_config = queue_processor.config.distribution
+
+    last_build_version = await debian_state.get_last_build_version(
+        conn, item.package, item.suite)
+
+    if main_branch is not None and not item.refresh:
+        resume_branch = await open_resume_branch(
+            main_branch, suite_config.branch_name,
+            possible_hosters=possible_hosters)
+    else:
+        resume_branch = None
+
+    if resume_branch is None and not item.refresh:
+        resume_branch = queue_processor.public_vcs_manager.get_branch(
+            item.package, suite_config.branch_name, vcs_type)
+
+    resume = await check_resume_result(conn, item.suite, resume_branch)
+
+    return {
+        'id': active_run.log_id,
+        'description': '%s on %s' % (item.suite, item.package),
+        'queue_id': item.id,
+        'resume': resume.json() if resume else None,
+        'build': {
+            'environment':
+                suite_build_env(
+                    distro_config, suite_config, queue_processor.apt_location,
+                    last_build_version),
+        },
+        'command': item.command,
+        'suite': item.suite,
+        'legacy_branch_name': active_run.legacy_branch_name,
+    }
+
+
 async def handle_assign(request):
     json = await request.json()
     worker = json['worker']
@@ -1287,7 +1417,14 @@ async def handle_assign(request):
             await state.drop_queue_item(conn, active_run.queue_item.id)
 
     queue_processor = request.app.queue_processor
-    [item] = await queue_processor.next_queue_item(1)
+    # Queue items are registered before anything else is awaited, since
+    # another request could otherwise be assigned the same item. The queue is
+    # read asynchronously, so an item may have been assigned since it was
+    # found.
+    while True:
+        [item] = await queue_processor.next_queue_item(1)
+        if not queue_processor.queue_item_assigned(item):
+            break
 
     suite_config = get_suite_config(queue_processor.config, item.suite)
 
@@ -1298,38 +1435,55 @@ async def handle_assign(request):
 
     queue_processor.register_run(active_run)
 
-    # This is simple for now, since we only support one distribution.
-    distro_config = queue_processor.config.distribution
+    if queue_processor.batch_suites:
+        batch_items = await queue_processor.next_batch_items(item)
+    else:
+        batch_items = []
 
-    async with queue_processor.database.acquire() as conn:
-        last_build_version = await debian_state.get_last_build_version(
-            conn, item.package, item.suite)
+    batch_runs = []
+    for batch_item in batch_items:
+        if queue_processor.queue_item_assigned(batch_item):
+            continue
+        try:
+            batch_suite_config = get_suite_config(
+                queue_processor.config, batch_item.suite)
+        except KeyError:
+            warning('Not batching %s on %s: unknown suite',
+                    batch_item.suite, batch_item.package)
+            continue
+        batch_run = ActiveRemoteRun(
+            worker_name=worker, queue_item=batch_item,
+            legacy_branch_name=batch_suite_config.branch_name,
+            jenkins_metadata=json.get('jenkins'),
+            batch_id=active_run.log_id)
+        queue_processor.register_run(batch_run)
+        batch_runs.append((batch_run, batch_suite_config))
 
+    async with queue_processor.database.acquire() as conn:
         try:
             main_branch = await open_canonical_main_branch(
                 conn, item,
                 possible_transports=possible_transports)
         except BranchOpenFailure:
-            resume_branch = None
+            main_branch = None
             vcs_type = item.vcs_type
         else:
             active_run.main_branch_url = full_branch_url(main_branch)
             vcs_type = get_vcs_abbreviation(main_branch.repository)
-            if not item.refresh:
-                resume_branch = await open_resume_branch(
-                    main_branch, suite_config.branch_name,
-                    possible_hosters=possible_hosters)
-            else:
-                resume_branch = None
 
         if vcs_type is not None:
             vcs_type = vcs_type.lower()
 
-        if resume_branch is None and not item.refresh:
-            resume_branch = queue_processor.public_vcs_manager.get_branch(
-                item.package, suite_config.branch_name, vcs_type)
+        assignment = await suite_assignment(
+            conn, queue_processor, active_run, suite_config, main_branch,
+            vcs_type, possible_hosters=possible_hosters)
 
-        resume = await check_resume_result(conn, item.suite, resume_branch)
+        batch = []
+        for (batch_run, batch_suite_config) in batch_runs:
+            batch_run.main_branch_url = active_run.main_branch_url
+            batch.append(await suite_assignment(
+                conn, queue_processor, batch_run, batch_suite_config,
+                main_branch, vcs_type, possible_hosters=possible_hosters))
 
     try:
         cached_branch_url = queue_processor.public_vcs_manager.get_branch_url(
@@ -1345,31 +1499,22 @@ async def handle_assign(request):
     if item.upstream_branch_url:
         env['UPSTREAM_BRANCH_URL'] = item.upstream_branch_url
 
-    assignment = {
-        'id': active_run.log_id,
-        'description': '%s on %s' % (item.suite, item.package),
-        'queue_id': item.id,
+    assignment.update({
         'branch': {
             'url': active_run.main_branch_url,
             'subpath': item.subpath,
             'vcs_type': item.vcs_type,
             'cached_url': cached_branch_url,
         },
-        'resume': resume.json() if resume else None,
-        'build': {
-            'environment':
-                suite_build_env(
-                    distro_config, suite_config, queue_processor.apt_location,
-                    last_build_version),
-        },
         'env': env,
-        'command': item.command,
-        'suite': item.suite,
-        'legacy_branch_name': active_run.legacy_branch_name,
         'vcs_manager': queue_processor.public_vcs_manager.base_url,
-    }
+    })
+    if batch:
+        assignment['batch'] = batch
 
     active_run.start_watchdog(queue_processor)
+    for (batch_run, batch_suite_config) in batch_runs:
+        batch_run.start_watchdog(queue_processor)
     return web.json_response(assignment, status=201)
 
 
@@ -1413,13 +1558,16 @@ async def handle_finish(request):
             output_directory, queue_processor.logfile_manager,
             queue_processor.backup_logfile_manager,
             active_run.queue_item.package, run_id)
+        build_log_summary = await asyncio.get_running_loop().run_in_executor(
+            None, summarize_build_log, output_directory)
 
         if worker_result.code is not None:
             result = JanitorResult(
                 active_run.queue_item.package, log_id=run_id,
                 branch_url=active_run.main_branch_url,
                 worker_result=worker_result,
-                logfilenames=logfilenames, legacy_branch_name=(
+                logfilenames=logfilenames,
+                build_log_summary=build_log_summary, legacy_branch_name=(
                     active_run.resume_branch_name
                     if worker_result.code == 'nothing-to-do' else None))
         else:
@@ -1428,6 +1576,7 @@ async def handle_finish(request):
                 branch_url=active_run.main_branch_url,
                 code='success', worker_result=worker_result,
                 logfilenames=logfilenames,
+                build_log_summary=build_log_summary,
                 legacy_branch_name=active_run.legacy_branch_name)
 
             try:
@@ -1521,6 +1670,11 @@ def main(argv=None):
     parser.add_argument(
         '--public-vcs-location', type=str,
         default='https://janitor.debian.net/')
+    parser.add_argument(
+        '--batch-suites', action='store_true',
+        help=('Bundle queue items for the same package into a single '
+              'assignment for remote workers, which then share a clone of '
+              'the main branch.'))
 
     args = parser.parse_args()
 
@@ -1557,7 +1711,9 @@ def main(argv=None):
     else:
         backup_artifact_manager = None
         backup_logfile_manager = None
-    db = state.Database(config.database_location)
+    db = state.Database(
+        config.database_location,
+        slow_query_threshold=(config.slow_query_threshold or None))
     queue_processor = QueueProcessor(
         db,
         config,
@@ -1575,14 +1731,18 @@ def main(argv=None):
         committer=config.committer,
         apt_location=config.apt_location,
         backup_artifact_manager=backup_artifact_manager,
-        backup_logfile_manager=backup_logfile_manager)
+        backup_logfile_manager=backup_logfile_manager,
+        batch_suites=args.batch_suites)
 
     async def run():
+        await db.warm_up()
         async with artifact_manager:
             return await asyncio.gather(
                 loop.create_task(queue_processor.process()),
                 loop.create_task(export_queue_length(db)),
                 loop.create_task(export_stats(db)),
+                loop.create_task(maintain_rollups(db)),
+                loop.create_task(maintain_site_sessions(db)),
                 loop.create_task(run_web_server(
                     args.listen_address, args.port, queue_processor)),
                 )
@@ -153,7 +153,10 @@ async def estimate_success_probability(
         same_context_multiplier = 0.5
     else:
         same_context_multiplier = 1.0
-    async for run in state.iter_previous_runs(conn, package, suite):
+    async for run in state.iter_previous_runs(
+            conn, package, suite,
+            fields=['times', 'result_code', 'instigated_context', 'context',
+                    'description']):
         try:
             ignore_checker = IGNORE_RESULT_CODE[run.result_code]
         except KeyError:
@@ -17,15 +17,35 @@
 
 import aiohttp
 from aiohttp import ClientConnectorError, web, BasicAuth
-from jinja2 import Environment, PackageLoader, select_autoescape
-from typing import Optional
+import asyncio
+import asyncpg
+import hashlib
+import hmac
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    PackageLoader,
+    TemplateError,
+    select_autoescape,
+    )
+import os
+import time
+from typing import Dict, Optional
 import urllib.parse
 from yarl import URL
 
 from janitor import state
 from janitor.config import Config
 from janitor.schedule import TRANSIENT_ERROR_RESULT_CODES
-from janitor.vcs import RemoteVcsManager
+from janitor.trace import note, warning
+
+
+# How long (in seconds) to cache verified worker credentials for.
+WORKER_CREDENTIALS_TTL = 5 * 60
+
+# How long (in seconds) to wait before reconnecting when listening for
+# changes to the worker table fails.
+WORKER_CHANGE_LISTEN_RETRY_INTERVAL = 30
 
 
 def json_chart_data(max_age=None):
@@ -44,6 +64,8 @@ def json_chart_data(max_age=None):
 
 
 def update_vars_from_request(vs, request):
+    # janitor.vcs pulls in breezy, so only import it once it's needed.
+    from janitor.vcs import RemoteVcsManager
     vs['is_admin'] = is_admin(request)
     vs['is_qa_reviewer'] = is_qa_reviewer(request)
     vs['user'] = request.user
@@ -59,6 +81,30 @@ def update_vars_from_request(vs, request):
         vs['vcs_manager'] = RemoteVcsManager(str(request.url.with_path('/')))
 
 
+def update_vars_for_anonymous(
+        vs, config: Config, external_url: Optional[URL], rel_url: URL,
+        openid_configured: bool = False):
+    """Set the common template variables for a page for anonymous visitors.
+
+    This is the equivalent of update_vars_from_request for pages that are
+    rendered outside of a request, see janitor.site.prerender.
+    """
+    from janitor.vcs import RemoteVcsManager
+    vs['is_admin'] = False
+    vs['is_qa_reviewer'] = False
+    vs['user'] = None
+    vs['rel_url'] = rel_url
+    vs['suites'] = config.suite
+    vs['site_name'] = config.instance_name or 'Debian Janitor'
+    vs['openid_configured'] = openid_configured
+    if external_url is not None:
+        vs['url'] = external_url.join(rel_url)
+        vs['vcs_manager'] = RemoteVcsManager(str(external_url))
+    else:
+        vs['url'] = rel_url
+        vs['vcs_manager'] = RemoteVcsManager('/')
+
+
 async def render_template_for_request(templatename, request, vs):
     update_vars_from_request(vs, request)
     template = env.get_template(templatename)
@@ -103,10 +149,13 @@ def format_timestamp(ts):
     return ts.isoformat(timespec='minutes')
 
 
-async def get_vcs_type(client, vcs_store_url, package):
+async def get_vcs_type(client, vcs_store_url, package, timeout=None):
     url = urllib.parse.urljoin(vcs_store_url, 'vcs-type/%s' % package)
+    kwargs = {}
+    if timeout is not None:
+        kwargs['timeout'] = aiohttp.ClientTimeout(timeout)
     try:
-        async with client.get(url) as resp:
+        async with client.get(url, **kwargs) as resp:
             if resp.status == 200:
                 ret = (await resp.read()).decode('utf-8', 'replace')
                 if ret == "":
@@ -116,6 +165,9 @@ async def get_vcs_type(client, vcs_store_url, package):
         return ret
     except ClientConnectorError as e:
         return 'Unable to retrieve diff; error %s' % e
+    except asyncio.TimeoutError:
+        warning('Timeout retrieving VCS type for %s', package)
+        return None
 
 
 env = Environment(
@@ -148,6 +200,39 @@ env.globals.update(classify_result_code=classify_result_code)
 env.globals.update(URL=URL)
 
 
+def setup_template_cache(directory: str) -> None:
+    """Store compiled templates in a directory.
+
+    The cache is shared between processes and survives restarts, so that
+    templates only have to be compiled again when they change.
+    """
+    os.makedirs(directory, exist_ok=True)
+    env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+
+def precompile_templates() -> int:
+    """Load (and if necessary, compile) all templates.
+
+    This is done at startup, so that the first requests for each page don't
+    have to wait for its templates to be compiled.
+
+    Returns:
+      number of templates loaded
+    """
+    start = time.monotonic()
+    names = env.list_templates()
+    loaded = 0
+    for name in names:
+        try:
+            env.get_template(name)
+        except TemplateError as e:
+            warning('Unable to compile template %s: %s', name, e)
+        else:
+            loaded += 1
+    note('Loaded %d templates in %.2fs.', loaded, time.monotonic() - start)
+    return loaded
+
+
 class DebdiffRetrievalError(Exception):
     """Error occurred while retrieving debdiff."""
 
@@ -160,7 +245,8 @@ class BuildDiffUnavailable(Exception):
 
 
 async def get_archive_diff(client, differ_url, run, unchanged_run,
-                           kind, accept=None, filter_boring=False):
+                           kind, accept=None, filter_boring=False,
+                           timeout=None):
     if not unchanged_run.has_artifacts():
         raise DebdiffRetrievalError('unchanged run not successful')
     if not run.has_artifacts():
@@ -181,8 +267,12 @@ async def get_archive_diff(client, differ_url, run, unchanged_run,
             ', '.join(accept)
             if isinstance(accept, list)
             else accept)
+    kwargs = {}
+    if timeout is not None:
+        kwargs['timeout'] = aiohttp.ClientTimeout(timeout)
     try:
-        async with client.get(url, params=params, headers=headers) as resp:
+        async with client.get(
+                url, params=params, headers=headers, **kwargs) as resp:
             if resp.status == 200:
                 return await resp.read(), resp.content_type
             elif resp.status == 404:
@@ -195,6 +285,8 @@ async def get_archive_diff(client, differ_url, run, unchanged_run,
                     'Unable to get debdiff: %s' % await resp.text())
     except ClientConnectorError as e:
         raise DebdiffRetrievalError(str(e))
+    except asyncio.TimeoutError:
+        raise DebdiffRetrievalError('Timeout retrieving %s' % kind)
 
 
 def is_admin(request: web.Request) -> bool:
@@ -225,23 +317,123 @@ def check_admin(request: web.Request) -> None:
         raise web.HTTPUnauthorized()
 
 
-async def is_worker(db, request: web.Request) -> Optional[str]:
+class WorkerCredentialCache(object):
+    """Cache of worker credentials that have been verified.
+
+    Workers send their credentials with every request, and checking them
+    against the (crypted) passwords in the database is relatively
+    expensive. Credentials are only cached while listening for changes to
+    the worker table, so that changed or removed credentials stop working
+    immediately.
+
+    Credentials are stored as keyed hashes (with a key that is generated
+    for each process), never in plain text.
+    """
+
+    def __init__(self, db: state.Database,
+                 ttl: float = WORKER_CREDENTIALS_TTL):
+        self.db = db
+        self.ttl = ttl
+        self.listening = False
+        self._key = os.urandom(32)
+        self._verified: Dict[bytes, float] = {}
+        self._generation = 0
+        self._listener = None
+
+    def _hash(self, login: str, password: str) -> bytes:
+        return hmac.new(
+            self._key, b'\0'.join(
+                [login.encode('utf-8'), password.encode('utf-8')]),
+            hashlib.sha256).digest()
+
+    def invalidate(self) -> None:
+        self._generation += 1
+        self._verified.clear()
+
+    async def check(self, login: str, password: str) -> bool:
+        key = self._hash(login, password)
+        expiry = self._verified.get(key)
+        if expiry is not None and expiry > time.monotonic():
+            return True
+        # Don't cache the result if the worker table changed while it was
+        # being checked.
+        generation = self._generation
+        async with self.db.acquire() as conn:
+            if not await state.check_worker_credentials(
+                    conn, login, password):
+                self._verified.pop(key, None)
+                return False
+        if self.listening and generation == self._generation:
+            self._verified[key] = time.monotonic() + self.ttl
+        return True
+
+    def _on_change(self, conn, pid, channel, payload):
+        self.invalidate()
+
+    async def listen(self) -> None:
+        """Listen for changes to the worker table.
+
+        This keeps reconnecting until cancelled.
+        """
+        while True:
+            try:
+                conn = await asyncpg.connect(self.db.url)
+            except (OSError, asyncpg.PostgresError) as e:
+                warning('Unable to listen for worker changes: %s', e)
+                await asyncio.sleep(WORKER_CHANGE_LISTEN_RETRY_INTERVAL)
+                continue
+            terminated = asyncio.Event()
+            conn.add_termination_listener(lambda conn: terminated.set())
+            try:
+                await conn.add_listener(
+                    state.WORKER_CHANGE_CHANNEL, self._on_change)
+                # Changes may have been missed while not listening.
+                self.invalidate()
+                self.listening = True
+                await terminated.wait()
+                warning('Lost connection while listening for worker '
+                        'changes; reconnecting.')
+            except (OSError, asyncpg.PostgresError) as e:
+                warning('Error listening for worker changes: %s', e)
+            finally:
+                self.listening = False
+                self.invalidate()
+                if not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(WORKER_CHANGE_LISTEN_RETRY_INTERVAL)
+
+    async def start(self, app=None) -> None:
+        self._listener = asyncio.create_task(self.listen())
+
+    async def stop(self, app=None) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+
+
+async def is_worker(
+        worker_credentials: WorkerCredentialCache,
+        request: web.Request) -> Optional[str]:
     auth_header = request.headers.get(aiohttp.hdrs.AUTHORIZATION)
     if not auth_header:
         return None
     auth = BasicAuth.decode(auth_header=auth_header)
-    async with db.acquire() as conn:
-        if await state.check_worker_credentials(
-                conn, auth.login, auth.password):
-            return auth.login
+    if await worker_credentials.check(auth.login, auth.password):
+        return auth.login
     return None
 
 
-async def check_worker_creds(db, request: web.Request) -> Optional[str]:
+async def check_worker_creds(
+        worker_credentials: WorkerCredentialCache,
+        request: web.Request) -> Optional[str]:
     auth_header = request.headers.get(aiohttp.hdrs.AUTHORIZATION)
     if not auth_header:
         raise web.HTTPUnauthorized(body='worker login required')
-    login = await is_worker(db, request)
+    login = await is_worker(worker_credentials, request)
     if not login:
         raise web.HTTPUnauthorized(body='worker login required')
     return login
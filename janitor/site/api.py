@@ -3,7 +3,6 @@
 import aiohttp
 from aiohttp import (
     web,
-    ClientSession,
     ContentTypeError,
     ClientConnectorError,
     ClientOSError,
@@ -18,6 +17,7 @@ from yarl import URL
 
 from janitor import state, SUITE_REGEX
 from janitor.config import Config
+from janitor.http_client import HttpClient
 from janitor.trace import warning
 from . import (
     check_admin,
@@ -30,6 +30,7 @@ from . import (
     render_template_for_request,
     BuildDiffUnavailable,
     DebdiffRetrievalError,
+    WorkerCredentialCache,
     )
 from ..debian import state as debian_state
 from ..policy_pb2 import PolicyConfig
@@ -184,7 +185,7 @@ async def handle_webhook(request):
         return web.Response(
             content_type='text/html', text=text,
             headers={'Cache-Control': 'max-age=600'})
-    return await process_webhook(request, request.app.db)
+    return await process_webhook(request, request.app.db.primary)
 
 
 
@@ -198,7 +199,7 @@ async def handle_schedule(request):
     except ValueError:
         return web.json_response(
             {'error': 'invalid boolean for refresh'}, status=400)
-    async with request.app.db.acquire() as conn:
+    async with request.app.db.primary.acquire() as conn:
         package = await debian_state.get_package(conn, package)
         if package is None:
             return web.json_response(
@@ -243,7 +244,7 @@ async def handle_schedule_control(request):
     except ValueError:
         return web.json_response(
             {'error': 'invalid boolean for refresh'}, status=400)
-    async with request.app.db.acquire() as conn:
+    async with request.app.db.primary.acquire() as conn:
         run = await state.get_run(conn, run_id)
         if run is None:
             return web.json_response(
@@ -329,22 +330,39 @@ async def handle_refresh_proposal_status(request):
         return web.Response(text=(await resp.text()), status=resp.status)
 
 
+def next_page_headers(request, headers, cursor):
+    """Add a Link header for the next page of a paginated response."""
+    if cursor is not None:
+        headers['Link'] = '<%s>; rel="next"' % (
+            request.rel_url.update_query(after=cursor))
+    return headers
+
+
 async def handle_queue(request):
     limit = request.query.get('limit')
     if limit is not None:
         limit = int(limit)
     response_obj = []
+    entry = None
     async with request.app.db.acquire() as conn:
-        async for entry in state.iter_queue(
-                conn, limit=limit):
-            response_obj.append({
-                'queue_id': entry.id,
-                'branch_url': entry.branch_url,
-                'package': entry.package,
-                'context': entry.context,
-                'command': entry.command})
+        try:
+            async for entry in state.iter_queue(
+                    conn, limit=limit, after=request.query.get('after')):
+                response_obj.append({
+                    'queue_id': entry.id,
+                    'branch_url': entry.branch_url,
+                    'package': entry.package,
+                    'context': entry.context,
+                    'command': entry.command})
+        except ValueError:
+            raise web.HTTPBadRequest(text='invalid cursor')
+    if limit and len(response_obj) == limit:
+        cursor = state.queue_cursor(entry.bucket, entry.priority, entry.id)
+    else:
+        cursor = None
     return web.json_response(
-        response_obj, headers={'Cache-Control': 'max-age=60'})
+        response_obj, headers=next_page_headers(
+            request, {'Cache-Control': 'max-age=60'}, cursor))
 
 
 async def handle_diff(request):
@@ -481,7 +499,7 @@ async def handle_run_post(request):
     review_status = post.get('review-status')
     review_comment = post.get('review-comment')
     if review_status:
-        async with request.app.db.acquire() as conn:
+        async with request.app.db.primary.acquire() as conn:
             review_status = review_status.lower()
             if review_status == 'reschedule':
                 run = await state.get_run(conn, run_id)
@@ -502,8 +520,13 @@ async def handle_run(request):
     if limit is not None:
         limit = int(limit)
     response_obj = []
-    async for run in state.iter_runs(
-                request.app.db, package, run_id=run_id, limit=limit):
+    try:
+        runs = [run async for run in state.iter_runs(
+            request.app.db, package, run_id=run_id, limit=limit,
+            after=request.query.get('after'))]
+    except ValueError:
+        raise web.HTTPBadRequest(text='invalid cursor')
+    for run in runs:
         if run.build_version:
             build_info = {
                 'version': str(run.build_version),
@@ -521,8 +544,13 @@ async def handle_run(request):
             'build_info': build_info,
             'result_code': run.result_code,
             })
+    if limit and len(runs) == limit:
+        cursor = state.run_cursor(runs[-1])
+    else:
+        cursor = None
     return web.json_response(
-        response_obj, headers={'Cache-Control': 'max-age=600'})
+        response_obj, headers=next_page_headers(
+            request, {'Cache-Control': 'max-age=600'}, cursor))
 
 
 async def handle_publish_scan(request):
@@ -741,7 +769,8 @@ async def handle_publish_ready(request):
 
 
 async def handle_run_progress(request):
-    worker_name = await check_worker_creds(request.app.db, request)
+    worker_name = await check_worker_creds(
+        request.app.worker_credentials, request)
 
     run_id = request.match_info['run_id'].encode()
 
@@ -772,7 +801,8 @@ async def handle_run_progress(request):
 
 
 async def handle_run_assign(request):
-    worker_name = await check_worker_creds(request.app.db, request)
+    worker_name = await check_worker_creds(
+        request.app.worker_credentials, request)
     url = urllib.parse.urljoin(request.app.runner_url, 'assign')
     try:
         async with request.app.http_client_session.post(
@@ -795,7 +825,8 @@ async def handle_run_assign(request):
 
 
 async def handle_run_finish(request: web.Request) -> web.Response:
-    worker_name = await check_worker_creds(request.app.db, request)
+    worker_name = await check_worker_creds(
+        request.app.worker_credentials, request)
     run_id = request.match_info['run_id']
     reader = await request.multipart()
     result = None
@@ -884,13 +915,27 @@ def create_app(
         vcs_store_url: str, differ_url: str, config: Config,
         policy_config: PolicyConfig,
         enable_external_workers: bool = True,
-        external_url: Optional[URL] = None) -> web.Application:
+        external_url: Optional[URL] = None,
+        worker_credentials: Optional[WorkerCredentialCache] = None,
+        http_client: Optional[HttpClient] = None
+        ) -> web.Application:
     trailing_slash_redirect = normalize_path_middleware(append_slash=True)
     app = web.Application(middlewares=[trailing_slash_redirect])
-    app.http_client_session = ClientSession()
+    if http_client is None:
+        http_client = HttpClient()
+
+        async def close_http_client(app):
+            await http_client.close()
+        app.on_cleanup.append(close_http_client)
+    app.http_client_session = http_client
     app.config = config
     app.jinja_env = env
     app.db = db
+    if worker_credentials is None:
+        worker_credentials = WorkerCredentialCache(db.primary)
+        app.on_startup.append(worker_credentials.start)
+        app.on_cleanup.append(worker_credentials.stop)
+    app.worker_credentials = worker_credentials
     app.external_url = external_url
     app.policy_config = policy_config
     app.publisher_url = publisher_url
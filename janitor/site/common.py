@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
-from aiohttp import ClientConnectorError
+from aiohttp import ClientConnectorError, ClientTimeout
+import asyncio
 from functools import partial
 import urllib.parse
 
@@ -15,79 +16,96 @@ from janitor.site import (
     )
 
 
-async def generate_pkg_context(db, config, suite, policy, client, differ_url,
-                               vcs_store_url, package, run_id=None):
-    async with db.acquire() as conn:
-        package = await debian_state.get_package(conn, name=package)
-        if package is None:
-            raise KeyError(package)
-        if run_id is not None:
-            run = await state.get_run(conn, run_id)
-            if not run:
-                raise KeyError(run_id)
-            merge_proposals = []
-        else:
-            run = await state.get_last_unabsorbed_run(
-                conn, package.name, suite)
-            merge_proposals = [
-                (url, status) for (unused_package, url, status) in
-                await state.iter_proposals(conn, package.name, suite=suite)]
-        (publish_policy, changelog_policy,
-         unused_command) = await state.get_publish_policy(
-             conn, package.name, suite)
-        if run is None:
-            # No runs recorded
-            command = None
-            build_version = None
-            result_code = None
-            context = None
-            start_time = None
-            finish_time = None
-            run_id = None
-            result = None
-            branch_url = None
-            unchanged_run = None
-        else:
-            command = run.command
-            build_version = run.build_version
-            result_code = run.result_code
-            context = run.context
-            start_time = run.times[0]
-            finish_time = run.times[1]
-            run_id = run.id
-            result = run.result
-            branch_url = run.branch_url
-            if run.main_branch_revision:
-                unchanged_run = await state.get_unchanged_run(
-                    conn, run.package, run.main_branch_revision)
-            else:
-                unchanged_run = None
-
-        candidate = await debian_state.get_candidate(conn, package.name, suite)
-        if candidate is not None:
-            (candidate_context, candidate_value,
-             candidate_success_chance) = candidate
-        else:
-            candidate_context = None
-            candidate_value = None
-            candidate_success_chance = None
-        previous_runs = [
-            x async for x in
-            state.iter_previous_runs(conn, package.name, suite)]
-        (queue_position, queue_wait_time) = await state.get_queue_position(
-            conn, suite, package.name)
+# Maximum time (in seconds) to wait for the VCS store and the differ when
+# rendering a package page. If they take longer, the page is rendered
+# without the diffs (or VCS type) rather than waiting on them.
+VCS_STORE_TIMEOUT = 10
+DIFFER_TIMEOUT = 20
 
-    async def show_diff(role):
+# Maximum number of database connections a single package page uses at the
+# same time, so that a few concurrent page views can't exhaust the pool.
+MAX_PAGE_CONNECTIONS = 3
+
+
+async def _iter_merge_proposals(conn, package, suite):
+    return [
+        (url, status) for (unused_package, url, status) in
+        await state.iter_proposals(conn, package, suite=suite)]
+
+
+async def _iter_previous_runs(conn, package, suite):
+    return [x async for x in state.iter_previous_runs(conn, package, suite)]
+
+
+def _retrieve_exception(task):
+    # Tasks that are started early may never be awaited; retrieve their
+    # exception so that it isn't logged as never retrieved.
+    if not task.cancelled():
+        task.exception()
+
+
+def _memoize(fn):
+    """Run a coroutine function at most once for every set of arguments.
+
+    The call runs as a task, so it can be started before its result is
+    needed.
+    """
+    tasks = {}
+
+    def wrapper(*args):
         try:
-            (remote_name, base_revid, revid) = run.get_result_branch(role)
+            return tasks[args]
         except KeyError:
-            return 'no result branch with role %s' % role
+            task = tasks[args] = asyncio.ensure_future(fn(*args))
+            task.add_done_callback(_retrieve_exception)
+            return task
+    return wrapper
+
+
+async def generate_pkg_context(db, config, suite, policy, client, differ_url,
+                               vcs_store_url, package, run_id=None):
+    # The queries are independent, so run them concurrently (on a few
+    # connections); the page then takes about as long as the slowest of them,
+    # rather than the sum.
+    connections = asyncio.Semaphore(MAX_PAGE_CONNECTIONS)
+
+    async def fetch(fn, *args, **kwargs):
+        async with connections, db.acquire() as conn:
+            return await fn(conn, *args, **kwargs)
+
+    async def no_merge_proposals():
+        return []
+
+    if run_id is not None:
+        get_run = fetch(state.get_run, run_id)
+        get_merge_proposals = no_merge_proposals()
+    else:
+        get_run = fetch(state.get_last_unabsorbed_run, package, suite)
+        get_merge_proposals = fetch(_iter_merge_proposals, package, suite)
+    name = package
+    (package, run, merge_proposals, policies, candidate,
+     previous_runs, position) = await asyncio.gather(
+        fetch(debian_state.get_package, name=name),
+        get_run,
+        get_merge_proposals,
+        fetch(state.get_publish_policy, name, suite),
+        fetch(debian_state.get_candidate, name, suite),
+        fetch(_iter_previous_runs, name, suite),
+        fetch(state.get_queue_position, suite, name))
+    if package is None:
+        raise KeyError(name)
+    if run_id is not None and not run:
+        raise KeyError(run_id)
+
+    async def retrieve_diff(role):
+        (remote_name, base_revid, revid) = run.get_result_branch(role)
         if base_revid == revid:
             return ''
         url = urllib.parse.urljoin(
                 vcs_store_url, 'diff/%s/%s' % (run.id, role))
         try:
-            async with client.get(url) as resp:
+            async with client.get(
+                    url, timeout=ClientTimeout(VCS_STORE_TIMEOUT)) as resp:
                 if resp.status == 200:
                     return (await resp.read()).decode('utf-8', 'replace')
                 else:
@@ -95,24 +113,91 @@ async def generate_pkg_context(db, config, suite, policy, client, differ_url,
                         'Unable to retrieve diff; error %d' % resp.status)
         except ClientConnectorError as e:
             return 'Unable to retrieve diff; error %s' % e
+        except asyncio.TimeoutError:
+            return 'Timeout while retrieving diff'
 
-    async def show_debdiff():
-        if not run.build_version:
-            return ''
-        if not unchanged_run or not unchanged_run.build_version:
-            return ''
+    async def retrieve_debdiff():
         try:
             debdiff, content_type = await get_archive_diff(
                 client, differ_url, run, unchanged_run,
-                kind='debdiff', filter_boring=True, accept='text/html')
+                kind='debdiff', filter_boring=True, accept='text/html',
+                timeout=DIFFER_TIMEOUT)
             return debdiff.decode('utf-8', 'replace')
         except BuildDiffUnavailable:
             return ''
         except DebdiffRetrievalError as e:
             return 'Error retrieving debdiff: %s' % e
 
+    # The diffs and VCS type are retrieved at most once, by the first caller.
+    @_memoize
+    async def show_diff(role):
+        if run is None or role not in [
+                entry[0] for entry in run.result_branches or []]:
+            return 'no result branch with role %s' % role
+        return await retrieve_diff(role)
+
+    @_memoize
+    async def show_debdiff():
+        if (run is None or not run.build_version or
+                unchanged_run is None or not unchanged_run.build_version):
+            return ''
+        return await retrieve_debdiff()
+
+    @_memoize
     async def vcs_type():
-        return await get_vcs_type(client, vcs_store_url, run.package)
+        if run is None:
+            return None
+        return await get_vcs_type(
+            client, vcs_store_url, run.package, timeout=VCS_STORE_TIMEOUT)
+
+    # Start retrieving the diffs and VCS type now, so that they are
+    # retrieved concurrently (and while the remaining queries run) rather
+    # than one at a time as the template renders.
+    if run is not None:
+        vcs_type()
+        for entry in run.result_branches or []:
+            show_diff(entry[0])
+
+    if run is None:
+        # No runs recorded
+        command = None
+        build_version = None
+        result_code = None
+        context = None
+        start_time = None
+        finish_time = None
+        run_id = None
+        result = None
+        branch_url = None
+        unchanged_run = None
+    else:
+        command = run.command
+        build_version = run.build_version
+        result_code = run.result_code
+        context = run.context
+        start_time = run.times[0]
+        finish_time = run.times[1]
+        run_id = run.id
+        result = run.result
+        branch_url = run.branch_url
+        if run.main_branch_revision:
+            unchanged_run = await fetch(
+                state.get_unchanged_run, run.package,
+                run.main_branch_revision)
+        else:
+            unchanged_run = None
+        if run.build_version:
+            show_debdiff()
+
+    (publish_policy, changelog_policy, unused_command) = policies
+    (queue_position, queue_wait_time) = position
+    if candidate is not None:
+        (candidate_context, candidate_value,
+         candidate_success_chance) = candidate
+    else:
+        candidate_context = None
+        candidate_value = None
+        candidate_success_chance = None
 
     return {
         'package': package.name,
@@ -1,12 +1,9 @@
 #!/usr/bin/python3
 
 import asyncpg
+from functools import lru_cache
 from typing import List, Dict
 from .common import generate_pkg_context
-from silver_platter.debian.lintian import (
-    available_lintian_fixers,
-    )
-from lintian_brush.lintian_overrides import load_renamed_tags
 
 from .. import state
 from ..debian import state as debian_state
@@ -14,7 +11,22 @@ from ..debian import state as debian_state
 
 SUITE = 'lintian-fixes'
 
-renamed_tags = load_renamed_tags()
+
+# Loading the fixer metadata is slow, so only do it when (and the first time)
+# a page needs it rather than when the site starts.
+@lru_cache(maxsize=None)
+def get_renamed_tags() -> Dict[str, str]:
+    from lintian_brush.lintian_overrides import load_renamed_tags
+    return load_renamed_tags()
+
+
+@lru_cache(maxsize=None)
+def get_supported_tags():
+    from silver_platter.debian.lintian import available_lintian_fixers
+    supported_tags = set()
+    for fixer in available_lintian_fixers():
+        supported_tags.update(fixer.lintian_tags)
+    return frozenset(supported_tags)
 
 
 async def generate_pkg_file(
@@ -43,23 +55,18 @@ async def generate_pkg_file(
 
 async def iter_lintian_tags(conn):
     return await conn.fetch("""
-select tag, count(tag) from (
-    select
-      json_array_elements(
-        json_array_elements(
-          result->'applied')->'fixed_lintian_tags') #>> '{}' as tag
-    from
-      last_runs
-    where
-      build_distribution = 'lintian-fixes'
-   ) as bypackage group by 1 order by 2
- desc
-""")
+select tag, count(tag) from run_lintian_fix
+inner join last_run on last_run.run_id = run_lintian_fix.run_id
+inner join package on package.name = last_run.package
+where last_run.suite = $1 and not package.removed
+group by 1 order by 2 desc
+""", SUITE)
 
 
 async def generate_tag_list(conn: asyncpg.Connection):
     tags = []
     oldnames = {}  # type: Dict[str, List[str]]
+    renamed_tags = get_renamed_tags()
     for tag in await iter_lintian_tags(conn):
         try:
             newname = renamed_tags[tag]
@@ -74,30 +81,29 @@ async def generate_tag_list(conn: asyncpg.Connection):
 async def iter_last_successes_by_lintian_tag(
         conn: asyncpg.Connection, tags: List[str]):
     return await conn.fetch("""
-select distinct on (package) * from (
-select
-  package,
-  command,
-  build_version,
-  result_code,
-  context,
-  start_time,
-  id,
-  (json_array_elements(
-     json_array_elements(
-       result->'applied')->'fixed_lintian_tags') #>> '{}') as tag
+select distinct on (run.package)
+  run.package,
+  run.command,
+  run.build_version,
+  run.result_code,
+  run.context,
+  run.start_time,
+  run.id,
+  run_lintian_fix.tag
 from
-  run
+  run_lintian_fix
+inner join run on run.id = run_lintian_fix.run_id
 where
-  build_distribution  = 'lintian-fixes' and
-  result_code = 'success'
-) as package where tag = ANY($1::text[]) order by package, start_time desc
+  run_lintian_fix.tag = ANY($1::text[]) and
+  run.build_distribution = 'lintian-fixes' and
+  run.result_code = 'success'
+order by run.package, run.start_time desc
 """, tags)
 
 
 async def generate_tag_page(db, tag):
     oldnames = []
-    for oldname, newname in renamed_tags.items():
+    for oldname, newname in get_renamed_tags().items():
         if newname == tag:
             oldnames.append(oldname)
     async with db.acquire() as conn:
@@ -111,9 +117,7 @@ async def generate_tag_page(db, tag):
 
 
 async def generate_candidates(db):
-    supported_tags = set()
-    for fixer in available_lintian_fixers():
-        supported_tags.update(fixer.lintian_tags)
+    supported_tags = get_supported_tags()
     async with db.acquire() as conn:
         candidates = [(package.name, context.split(' '), value) for
                       (package, suite, context, value, success_chance) in
@@ -144,6 +148,12 @@ async def generate_developer_table_page(db, developer):
         async for run in state.iter_last_unabsorbed_runs(
                 conn, suite=SUITE, packages=packages):
             runs[run.package] = run
+        fixed_tags = {}
+        for run_id, tag in await conn.fetch(
+                'SELECT run_id, tag FROM run_lintian_fix '
+                'WHERE run_id = ANY($1::text[])',
+                [run.id for run in runs.values()]):
+            fixed_tags.setdefault(run_id, set()).add(tag)
         queue_data = {
             package: (position, duration)
             for (package, position, duration) in
@@ -152,15 +162,8 @@ async def generate_developer_table_page(db, developer):
     by_package = {}
     for package in packages:
         run = runs.get(package)
-        fixed = set()
+        fixed = set(fixed_tags.get(run.id, [])) if run else set()
         unfixed = set()
-        if run and run.result:
-            applied = run.result.get('applied')
-            if isinstance(applied, dict):
-                applied = [applied]
-            for applied in applied:
-                for tag in applied.get('fixed_lintian_tags', []):
-                    fixed.add(tag)
         if run and run.instigated_context:
             for tag in run.instigated_context.split(' '):
                 unfixed.add(tag)
@@ -197,7 +200,7 @@ async def iter_lintian_brush_fixer_failures(conn: asyncpg.Connection, fixer):
     query = """
 select id, finish_time, package, result->'failed'->$1 FROM last_runs
 where
-  suite = 'lintian-fixes' and (result->'failed')::jsonb?$1
+  suite = 'lintian-fixes' and result->'failed' ? $1
 order by finish_time desc
 """
     return await conn.fetch(query, fixer)
@@ -212,10 +215,10 @@ async def generate_failing_fixer(db, fixer):
 
 async def iter_failed_lintian_fixers(db):
     query = """
-select json_object_keys((result->'failed')::json), count(*) from last_runs
+select jsonb_object_keys(result->'failed'), count(*) from last_runs
 where
   suite = 'lintian-fixes' and
-  json_typeof((result->'failed')::json) = 'object' group by 1 order by 2 desc
+  jsonb_typeof(result->'failed') = 'object' group by 1 order by 2 desc
 """
     async with db.acquire() as conn:
         for row in await conn.fetch(query):
@@ -246,6 +249,7 @@ async def generate_regressions_list(db):
 
 
 async def iter_lintian_fixes_counts(conn):
+    renamed_tags = get_renamed_tags()
     per_tag = {}
     for (tag, absorbed, unabsorbed, total) in await conn.fetch("""
 SELECT
@@ -287,7 +291,7 @@ select coalesce(c, 0), count(*) from (
 """)}
         lintian_brush_versions = {
             (c or 'unknown'): nr for (c, nr) in await conn.fetch("""
-select result#>>'{versions,lintian-brush}', count(*) from run
+select result_lintian_brush_version, count(*) from run
 where result_code = 'success' and suite = 'lintian-fixes'
 group by 1 order by 1 desc
 """)}
@@ -24,8 +24,7 @@ async def iter_hint_links(conn):
     return await conn.fetch("""
 select hint, count(hint) from (
     select
-        json_array_elements(
-          result->'applied-hints')->'link' #>> '{}' as hint
+        jsonb_array_elements_text(result_applied_hint_links) as hint
     from
       last_runs
     where
@@ -52,8 +51,7 @@ select
   context,
   start_time,
   id,
-  json_array_elements(
-     result->'applied-hints')->'link' #>> '{}' as hint
+  jsonb_array_elements_text(result_applied_hint_links) as hint
 from
   run
 where
@@ -87,7 +85,7 @@ async def generate_candidates(db):
 async def generate_stats(db):
     async with db.acquire() as conn:
         hints_per_run = {(c or 0): nr for (c, nr) in await conn.fetch("""\
-select json_array_length(result->'applied-hints'), count(*) from run
+select jsonb_array_length(result_applied_hint_links), count(*) from run
 where result_code = 'success' and suite = 'multiarch-fixes' group by 1
 """)}
         per_kind = {h: nr for (h, nr) in await conn.fetch("""\
@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
 from aiohttp import ClientConnectorError
+import asyncio
 from functools import partial
 from io import BytesIO
 from typing import Optional
@@ -8,14 +9,10 @@ import urllib.parse
 
 from janitor import state
 from janitor.debian import state as debian_state
-from buildlog_consultant.sbuild import (
-    parse_sbuild_log,
-    find_failed_stage,
-    find_build_failure_description,
-    find_install_deps_failure_description,
-    SBUILD_FOCUS_SECTION,
-    strip_useless_build_tail,
-)
+from janitor.debian.build_log import (
+    BUILD_LOG_NAME,
+    summarize_build_log,
+    )
 from janitor.logs import LogRetrievalError
 from janitor.site import (
     get_archive_diff,
@@ -25,56 +22,11 @@ from janitor.site import (
     tracker_url,
 )
 
-FAIL_BUILD_LOG_LEN = 15
-
-BUILD_LOG_NAME = 'build.log'
 WORKER_LOG_NAME = 'worker.log'
 
-
-def find_build_log_failure(logf, length):
-    offsets = {}
-    linecount = 0
-    paragraphs = {}
-    for title, offset, lines in parse_sbuild_log(logf):
-        if title is not None:
-            title = title.lower()
-        paragraphs[title] = lines
-        linecount = max(offset[1], linecount)
-        offsets[title] = offset
-    highlight_lines = []
-    include_lines = None
-    failed_stage = find_failed_stage(paragraphs.get('summary', []))
-    focus_section = SBUILD_FOCUS_SECTION.get(failed_stage)
-    if focus_section not in paragraphs:
-        focus_section = None
-    if failed_stage == 'install-deps':
-        (focus_section, offset, line,
-         error) = find_install_deps_failure_description(paragraphs)
-        if offset is not None:
-            abs_offset = offsets[focus_section][0] + offset
-            include_lines = (
-                max(1, abs_offset - length//2),
-                abs_offset + min(length//2, len(lines)))
-            highlight_lines = [abs_offset]
-            return (linecount, include_lines, highlight_lines)
-
-    if focus_section:
-        include_lines = (max(1, offsets[focus_section][1]-length),
-                         offsets[focus_section][1])
-    elif length < linecount:
-        include_lines = (linecount-length, None)
-    else:
-        include_lines = (1, linecount)
-    if focus_section == 'build':
-        lines = paragraphs.get(focus_section, [])
-        lines = strip_useless_build_tail(lines)
-        include_lines = (max(1, offsets[focus_section][0] + len(lines)-length),
-                         offsets[focus_section][0] + len(lines))
-        offset, unused_line, unused_err = find_build_failure_description(lines)
-        if offset is not None:
-            highlight_lines = [offsets[focus_section][0] + offset]
-
-    return (linecount, include_lines, highlight_lines)
+# Number of bytes before the build log excerpt to fetch when the user asks
+# for more context.
+BUILD_LOG_CONTEXT_BYTES = 16 * 1024
 
 
 def in_line_boundaries(i, boundaries):
@@ -113,6 +65,11 @@ async def generate_run_file(
         (queue_position, queue_wait_time) = await state.get_queue_position(
             conn, run.suite, run.package)
         package = await debian_state.get_package(conn, run.package)
+        if BUILD_LOG_NAME in run.logfilenames:
+            build_log_summary = await debian_state.get_build_log_summary(
+                conn, run.id)
+        else:
+            build_log_summary = None
         if run.revision and run.result_code in (
                 'success', 'nothing-new-to-do'):
             publish_history = await state.get_publish_history(
@@ -207,12 +164,21 @@ async def generate_run_file(
             kwargs['earlier_build_log_names'].append((i, log_name))
             i += 1
 
-        logf = await get_log(BUILD_LOG_NAME)
-        line_count, include_lines, highlight_lines = find_build_log_failure(
-            logf, FAIL_BUILD_LOG_LEN)
-        kwargs['build_log_line_count'] = line_count
-        kwargs['build_log_include_lines'] = include_lines
-        kwargs['build_log_highlight_lines'] = highlight_lines
+        if build_log_summary is None:
+            # Runs from before the runner stored build log summaries.
+            loop = asyncio.get_running_loop()
+            build_log_summary = await loop.run_in_executor(
+                None, summarize_build_log, await get_log(BUILD_LOG_NAME))
+        kwargs['build_log_line_count'] = build_log_summary['line_count']
+        kwargs['build_log_include_lines'] = (
+            build_log_summary['include_lines'])
+        kwargs['build_log_highlight_lines'] = (
+            build_log_summary['highlight_lines'])
+        kwargs['build_log_excerpt'] = build_log_summary['excerpt']
+        # Summaries stored before the offsets were recorded lack them.
+        kwargs['build_log_include_bytes'] = build_log_summary.get(
+            'include_bytes')
+        kwargs['build_log_context_bytes'] = BUILD_LOG_CONTEXT_BYTES
 
     if has_log(WORKER_LOG_NAME):
         kwargs['worker_log_name'] = WORKER_LOG_NAME
@@ -236,6 +202,8 @@ async def generate_pkg_file(db, config, package, merge_proposals, runs):
             suite: (context, value, success_chance)
             for (package, suite, context, value, success_chance) in
             await debian_state.iter_candidates(conn, packages=[package.name])}
+        kwargs['archived_runs'] = await state.iter_archived_run_summaries(
+            conn, package.name)
     return kwargs
 
 
@@ -0,0 +1,299 @@
+#!/usr/bin/python3
+# Copyright (C) 2021 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Pre-rendering of expensive pages that are the same for every visitor.
+
+The renderer regenerates the pages from iter_pages periodically, and
+shortly after runs finish, and writes them to a directory. The site serves
+these files to anonymous visitors for as long as they are no older than
+MAX_AGE, and renders the pages itself otherwise (e.g. when the renderer
+isn't running).
+"""
+
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiohttp import ClientSession
+from prometheus_client import Counter, Histogram
+from yarl import URL
+
+from . import env, update_vars_for_anonymous
+from .. import state
+from ..config import Config
+from ..trace import note, warning
+
+
+# How often to render all pages (in seconds).
+DEFAULT_INTERVAL = 15 * 60
+
+# Minimum time between renders (in seconds), when triggered by runs
+# finishing.
+MIN_INTERVAL = 60
+
+# Pre-rendered pages older than this (in seconds) are ignored by the site.
+MAX_AGE = 45 * 60
+
+# Suites that have their own candidates page, rather than the generic one.
+SPECIAL_CANDIDATE_SUITES = [
+    'lintian-fixes', 'multiarch-fixes', 'fresh-releases', 'fresh-snapshots',
+    'orphan']
+
+render_duration = Histogram(
+    'prerender_duration_seconds', 'Time spent rendering a page.',
+    labelnames=('path', ))
+render_failures = Counter(
+    'prerender_failures_total', 'Number of pages that failed to render.',
+    labelnames=('path', ))
+
+PageGenerator = Callable[[Any, Config], Awaitable[Dict[str, Any]]]
+
+
+async def _result_codes(db, config):
+    from .result_codes import generate_result_code_page
+    async with db.acquire() as conn:
+        return await generate_result_code_page(
+            conn, None, [s.name for s in config.suite])
+
+
+async def _never_processed(db, config):
+    async with db.acquire() as conn:
+        return {'never_processed': await state.get_never_processed(conn)}
+
+
+async def _maintainer_stats(db, config):
+    from .stats import write_maintainer_stats
+    async with db.acquire() as conn:
+        return await write_maintainer_stats(conn)
+
+
+async def _lintian_fixes_tag_list(db, config):
+    from .lintian_fixes import generate_tag_list
+    async with db.acquire() as conn:
+        return await generate_tag_list(conn)
+
+
+async def _multiarch_fixes_hint_list(db, config):
+    from .multiarch_hints import generate_hint_list
+    async with db.acquire() as conn:
+        return await generate_hint_list(conn)
+
+
+async def _lintian_fixes_candidates(db, config):
+    from .lintian_fixes import generate_candidates
+    return await generate_candidates(db)
+
+
+async def _multiarch_fixes_candidates(db, config):
+    from .multiarch_hints import generate_candidates
+    return await generate_candidates(db)
+
+
+async def _orphan_candidates(db, config):
+    from .orphan import generate_candidates
+    return await generate_candidates(db)
+
+
+def _new_upstream_candidates(suite):
+    async def generate(db, config):
+        from .new_upstream import generate_candidates
+        return await generate_candidates(db, suite)
+    return generate
+
+
+def _generic_candidates(suite):
+    async def generate(db, config):
+        from .common import generate_candidates
+        return await generate_candidates(db, suite=suite)
+    return generate
+
+
+def iter_pages(config: Config) -> List[Tuple[str, str, PageGenerator]]:
+    """List the pages to pre-render.
+
+    Returns:
+      list of (path, template name, generator) tuples
+    """
+    pages = [
+        ('/cupboard/result-codes/', 'result-code-index.html',
+         _result_codes),
+        ('/cupboard/never-processed', 'never-processed.html',
+         _never_processed),
+        ('/cupboard/maintainer-stats', 'maintainer-stats.html',
+         _maintainer_stats),
+        ('/lintian-fixes/by-tag/', 'lintian-fixes-tag-list.html',
+         _lintian_fixes_tag_list),
+        ('/multiarch-fixes/by-hint/', 'multiarch-fixes-hint-list.html',
+         _multiarch_fixes_hint_list),
+        ('/lintian-fixes/candidates', 'lintian-fixes-candidates.html',
+         _lintian_fixes_candidates),
+        ('/multiarch-fixes/candidates', 'multiarch-fixes-candidates.html',
+         _multiarch_fixes_candidates),
+        ('/orphan/candidates', 'orphan-candidates.html',
+         _orphan_candidates),
+    ]
+    for suite in ['fresh-releases', 'fresh-snapshots']:
+        pages.append(
+            ('/%s/candidates' % suite, 'new-upstream-candidates.html',
+             _new_upstream_candidates(suite)))
+    for suite in config.suite:
+        if suite.name not in SPECIAL_CANDIDATE_SUITES:
+            pages.append(
+                ('/%s/candidates' % suite.name, 'generic-candidates.html',
+                 _generic_candidates(suite.name)))
+    return pages
+
+
+def page_filename(directory: str, path: str) -> str:
+    """Determine the file name for a pre-rendered page."""
+    if path.endswith('/'):
+        return os.path.join(directory, path.strip('/'), 'index.html')
+    return os.path.join(directory, path.strip('/') + '.html')
+
+
+def iter_page_filenames(config: Config, directory: str) -> Dict[str, str]:
+    """Map the paths of pre-rendered pages to their file names."""
+    return {
+        path: page_filename(directory, path)
+        for (path, template_name, generator) in iter_pages(config)}
+
+
+async def render_page(
+        db, config: Config, directory: str, path: str, template_name: str,
+        generator: PageGenerator, external_url: Optional[URL] = None,
+        openid_configured: bool = False) -> None:
+    vs = await generator(db, config)
+    update_vars_for_anonymous(
+        vs, config, external_url, URL(path),
+        openid_configured=openid_configured)
+    text = await env.get_template(template_name).render_async(**vs)
+    filename = page_filename(directory, path)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # Write to a temporary file first, so that the site never serves a
+    # partially written page.
+    with open(filename + '.tmp', 'w') as f:
+        f.write(text)
+    os.rename(filename + '.tmp', filename)
+
+
+async def render_pages(
+        db, config: Config, directory: str,
+        external_url: Optional[URL] = None,
+        openid_configured: bool = False) -> int:
+    """Render all pages.
+
+    Returns:
+      number of pages that failed to render
+    """
+    failed = 0
+    for path, template_name, generator in iter_pages(config):
+        start = time.perf_counter()
+        try:
+            await render_page(
+                db, config, directory, path, template_name, generator,
+                external_url=external_url,
+                openid_configured=openid_configured)
+        except Exception as e:
+            warning('Failed to render %s: %r', path, e)
+            render_failures.labels(path=path).inc()
+            failed += 1
+        else:
+            render_duration.labels(path=path).observe(
+                time.perf_counter() - start)
+    return failed
+
+
+async def listen_to_runner(runner_url: str, changed: asyncio.Event) -> None:
+    from ..pubsub import pubsub_reader
+    url = URL(runner_url).join(URL('ws/result'))
+    async with ClientSession() as session:
+        async for msg in pubsub_reader(session, str(url)):
+            changed.set()
+
+
+async def render_loop(
+        db, config: Config, directory: str, changed: asyncio.Event,
+        interval: float = DEFAULT_INTERVAL,
+        min_interval: float = MIN_INTERVAL, **kwargs) -> None:
+    while True:
+        start = time.monotonic()
+        changed.clear()
+        failed = await render_pages(db, config, directory, **kwargs)
+        note('Rendered pages in %.1fs (%d failures).',
+             time.monotonic() - start, failed)
+        try:
+            await asyncio.wait_for(
+                changed.wait(),
+                timeout=max(0, start + interval - time.monotonic()))
+        except asyncio.TimeoutError:
+            pass
+        await asyncio.sleep(max(0, start + min_interval - time.monotonic()))
+
+
+async def main(args):
+    from ..config import read_config
+    from ..prometheus import run_prometheus_server
+
+    with open(args.config, 'r') as f:
+        config = read_config(f)
+
+    db = state.Database(
+        config.database_location,
+        replica_url=(config.database_replica_location or None)).readonly()
+    changed = asyncio.Event()
+    tasks = [
+        render_loop(
+            db, config, args.directory, changed, interval=args.interval,
+            external_url=(
+                URL(args.external_url) if args.external_url else None),
+            openid_configured=bool(
+                config.oauth2_provider and
+                config.oauth2_provider.base_url)),
+        run_prometheus_server(args.listen_address, args.port)]
+    if args.runner_url:
+        tasks.append(listen_to_runner(args.runner_url, changed))
+    await asyncio.gather(*tasks)
+    return 0
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--config', type=str, default='janitor.conf',
+        help='Path to configuration.')
+    parser.add_argument(
+        'directory', type=str, help='Directory to write pages to.')
+    parser.add_argument(
+        '--interval', type=int, default=DEFAULT_INTERVAL,
+        help='Seconds between renders.')
+    parser.add_argument(
+        '--runner-url', type=str, default=None,
+        help='URL of the runner; pages are re-rendered when runs finish.')
+    parser.add_argument(
+        '--external-url', type=str, default=None,
+        help='External URL of the site.')
+    parser.add_argument(
+        '--listen-address', type=str, default='localhost',
+        help='Address to serve metrics on.')
+    parser.add_argument(
+        '--port', type=int, default=9925,
+        help='Port to serve metrics on.')
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args)))
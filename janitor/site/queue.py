@@ -18,7 +18,8 @@
 from datetime import datetime, timedelta
 
 import shlex
-from typing import AsyncIterator, Tuple, Optional, Dict, Any, Iterator
+from typing import (
+    AsyncIterator, Tuple, Optional, Dict, Any, Iterator, List)
 
 from janitor import state
 from janitor.worker import changer_subcommand
@@ -47,11 +48,14 @@ def get_processing(answer: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
 
 async def iter_queue_with_last_run(
         db: state.Database,
-        limit: Optional[int] = None
+        limit: Optional[int] = None,
+        after: Optional[str] = None
         ) -> AsyncIterator[
                 Tuple[state.QueueItem, Optional[str], Optional[str]]]:
     query = """
 SELECT
+      queue.bucket AS bucket,
+      queue.priority AS priority,
       queue.package AS package,
       queue.command AS command,
       queue.context AS context,
@@ -71,6 +75,11 @@ SELECT
           SELECT id FROM run WHERE
             package = queue.package AND run.suite = queue.suite
           ORDER BY run.start_time desc LIMIT 1)
+"""
+    args: List[Any] = []
+    if after is not None:
+        query += " WHERE " + state.queue_cursor_condition(after, args)
+    query += """
   ORDER BY
   queue.bucket ASC,
   queue.priority ASC,
@@ -79,18 +88,16 @@ SELECT
     if limit:
         query += " LIMIT %d" % limit
     async with db.acquire() as conn:
-        for row in await conn.fetch(query):
+        for row in await conn.fetch(query, *args):
             yield row
 
 
-async def get_queue(
-        db: state.Database,
-        only_command: Optional[str] = None,
-        limit: Optional[int] = None) -> AsyncIterator[
+def get_queue(
+        rows: List[Any],
+        only_command: Optional[str] = None) -> Iterator[
             Tuple[int, str, Optional[str], str, str,
                   Optional[timedelta], Optional[str], Optional[str]]]:
-    async for row in (
-            iter_queue_with_last_run(db, limit=limit)):
+    for row in rows:
         command = shlex.split(row['command'])
         if only_command is not None and command != only_command:
             continue
@@ -130,7 +137,7 @@ async def get_queue(
 async def write_queue(client, db: state.Database,
                       only_command=None, limit=None,
                       is_admin=False,
-                      queue_status=None):
+                      queue_status=None, after=None):
     if queue_status:
         processing = get_processing(queue_status)
         active_queue_ids = set(
@@ -138,8 +145,16 @@ async def write_queue(client, db: state.Database,
     else:
         processing = iter([])
         active_queue_ids = set()
+    rows = [row async for row in iter_queue_with_last_run(
+        db, limit=limit, after=after)]
+    if limit and len(rows) == limit:
+        next_cursor = state.queue_cursor(
+            rows[-1]['bucket'], rows[-1]['priority'], rows[-1]['id'])
+    else:
+        next_cursor = None
     return {
-        'queue': get_queue(db, only_command, limit),
+        'queue': get_queue(rows, only_command),
+        'next_cursor': next_cursor,
         'active_queue_ids': active_queue_ids,
         'processing': processing,
         }
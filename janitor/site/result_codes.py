@@ -2,6 +2,8 @@
 
 import operator
 
+from .. import state
+
 
 async def generate_result_code_index(
         by_code, never_processed, suite, all_suites):
@@ -11,3 +13,12 @@ async def generate_result_code_index(
             sorted(by_code, key=operator.itemgetter(1), reverse=True)]
     data.append(('never-processed', never_processed))
     return {'result_codes': data, 'suite': suite, 'all_suites': all_suites}
+
+
+async def generate_result_code_page(conn, suite, all_suites):
+    stats = await state.stats_by_result_codes(conn, suite=suite)
+    never_processed = sum(dict(
+        await state.get_never_processed_count(
+            conn, [suite] if suite else None)).values())
+    return await generate_result_code_index(
+        stats, never_processed, suite, all_suites=all_suites)
@@ -18,7 +18,10 @@
 """Serve the janitor site."""
 
 import asyncio
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import hashlib
+from typing import Dict, Hashable, List, Optional, Set, Tuple
 import uuid
 from aiohttp.web_urldispatcher import (
     PrefixResource,
@@ -26,26 +29,515 @@ from aiohttp.web_urldispatcher import (
     URL,
     UrlMappingMatchInfo,
     )
-from aiohttp import ClientTimeout
+from aiohttp import ClientTimeout, hdrs, web
 from aiohttp.web import middleware
 from ..config import get_suite_config
-import gpg
+import os
+from prometheus_client import Counter, Gauge
 import re
 import shutil
 import tempfile
 import time
+import urllib.parse
 
+from .. import state
 from ..trace import note, warning
 from . import (
     is_worker,
     html_template,
     render_template_for_request,
+    WorkerCredentialCache,
     )
 from ..debian import state as debian_state
 
 
 FORWARD_CLIENT_TIMEOUT = 30 * 60
 
+# Maximum number of bytes to return for a single range request on a log
+# file. Ranges are served from the decompressed log, so they can not be
+# served without reading (and buffering) part of it.
+MAX_RANGE_LENGTH = 8 * 1024 * 1024
+
+# Maximum number of responses to keep in the response cache.
+RESPONSE_CACHE_SIZE = 5000
+
+# Maximum time (in seconds) to cache a response for. Not all changes are
+# announced on the pubsub topics (e.g. new candidates or queue positions).
+RESPONSE_CACHE_MAX_AGE = 10 * 60
+
+# Routes whose responses are cached for anonymous users, with the tags
+# for their cache entries. Tags are formatted with the route's match info.
+#
+# Cache entries are invalidated by the notifications from the runner and
+# publisher (see invalidate_response_cache):
+#  package:<name>: a run or publish for the package, or a change to one of
+#    its merge proposals
+#  suite:<name>: a run or publish in the suite
+#  runs: any run
+#  publish: any publish
+#  merge-proposals: any change to a merge proposal
+CACHED_ROUTES: Dict[str, List[str]] = {
+    'cupboard-package': ['package:{pkg}'],
+    'cupboard-run': ['package:{pkg}'],
+    'generic-package': ['package:{pkg}'],
+    'lintian-fixes-package': ['package:{pkg}'],
+    'lintian-fixes-package-run': ['package:{pkg}'],
+    'multiarch-fixes-package': ['package:{pkg}'],
+    'multiarch-fixes-package-run': ['package:{pkg}'],
+    'new-upstream-package': ['package:{pkg}'],
+    'new-upstream-run': ['package:{pkg}'],
+    'package-list': [],
+    'suite-package-list': [],
+    'suite-merge-proposals': ['suite:{suite}', 'merge-proposals'],
+    'suite-ready': ['suite:{suite}', 'publish'],
+    'lintian-fixes-stats': ['suite:lintian-fixes'],
+    'lintian-fixes-tag-list': ['suite:lintian-fixes'],
+    'lintian-fixes-tag': ['suite:lintian-fixes'],
+    'multiarch-fixes-stats': ['suite:multiarch-fixes'],
+    'multiarch-fixes-hint-list': ['suite:multiarch-fixes'],
+    'multiarch-fixes-hint': ['suite:multiarch-fixes'],
+    'result-code-list': ['runs'],
+    'result-code': ['runs'],
+    'never-processed': ['runs'],
+    'history': ['runs'],
+    'cupboard-maintainer-stats': ['runs'],
+    'cupboard-ready': ['runs', 'publish'],
+    'publish-history': ['publish'],
+    'broken-mps': ['merge-proposals'],
+    'failed-lintian-brush-fixer-list': ['runs'],
+    'failed-lintian-brush-fixer': ['runs'],
+    'lintian-brush-regressions': ['runs'],
+    'vcs-regressions': ['runs'],
+}
+
+# Cache-Control policies for responses that support conditional requests.
+# Clients can revalidate these cheaply, since they mostly get a 304 back.
+REVALIDATE = 'no-cache'
+# Aggregate pages change slowly and are expensive to render, so clients can
+# use them for a while without revalidating.
+REVALIDATE_AFTER_10_MINUTES = 'max-age=600'
+# Responses that never change once they exist.
+IMMUTABLE = 'max-age=86400'
+
+# Maximum time (in seconds) for which the ETag of a response that also
+# depends on data that isn't versioned (e.g. queue positions, or debdiffs,
+# which the differ calculates after the run has finished) stays the same.
+UNVERSIONED_MAX_AGE = 10 * 60
+
+# Minimum age (in seconds) of the last modification before a response gets a
+# Last-Modified header. HTTP dates have a resolution of seconds, and changes
+# only become visible when they are committed (or, on a replica, replicated),
+# which can be some time after the modification time they record. Until
+# then, clients have to use the ETag.
+LAST_MODIFIED_MIN_AGE = 60
+
+
+class ConditionalRoute(object):
+    """Support for conditional requests for a route.
+
+    Args:
+      versions: Names of the data versions that responses depend on (see the
+        data_version table), formatted with the route's match info
+      cache_control: Cache-Control header for responses
+      unversioned: Whether responses also depend on data that isn't versioned
+    """
+
+    def __init__(self, versions: List[str], cache_control: str,
+                 unversioned: bool = False):
+        self.versions = versions
+        self.cache_control = cache_control
+        self.unversioned = unversioned
+
+
+PACKAGE_PAGE = ConditionalRoute(
+    ['package:{pkg}'], REVALIDATE, unversioned=True)
+
+# Routes (of the site and the API) that support conditional requests for
+# anonymous users. Their responses have ETags derived from the versions of
+# the data they show, so that requests with a matching If-None-Match (or
+# If-Modified-Since) header can be answered without rendering the response.
+CONDITIONAL_ROUTES: Dict[str, ConditionalRoute] = {
+    'cupboard-package': PACKAGE_PAGE,
+    'cupboard-run': PACKAGE_PAGE,
+    'generic-package': PACKAGE_PAGE,
+    'lintian-fixes-package': PACKAGE_PAGE,
+    'lintian-fixes-package-run': PACKAGE_PAGE,
+    'multiarch-fixes-package': PACKAGE_PAGE,
+    'multiarch-fixes-package-run': PACKAGE_PAGE,
+    'new-upstream-package': PACKAGE_PAGE,
+    'new-upstream-run': PACKAGE_PAGE,
+    'package-list': ConditionalRoute(
+        ['packages'], REVALIDATE_AFTER_10_MINUTES),
+    'suite-package-list': ConditionalRoute(
+        ['packages'], REVALIDATE_AFTER_10_MINUTES),
+    'suite-merge-proposals': ConditionalRoute(
+        ['suite:{suite}', 'merge-proposals'], REVALIDATE),
+    'suite-ready': ConditionalRoute(['suite:{suite}', 'publish'], REVALIDATE),
+    'lintian-fixes-candidates': ConditionalRoute(
+        ['suite:lintian-fixes'], REVALIDATE_AFTER_10_MINUTES),
+    'lintian-fixes-stats': ConditionalRoute(
+        ['suite:lintian-fixes'], REVALIDATE_AFTER_10_MINUTES),
+    'lintian-fixes-tag-list': ConditionalRoute(
+        ['suite:lintian-fixes'], REVALIDATE_AFTER_10_MINUTES),
+    'lintian-fixes-tag': ConditionalRoute(
+        ['suite:lintian-fixes'], REVALIDATE_AFTER_10_MINUTES),
+    'multiarch-fixes-candidates': ConditionalRoute(
+        ['suite:multiarch-fixes'], REVALIDATE_AFTER_10_MINUTES),
+    'multiarch-fixes-stats': ConditionalRoute(
+        ['suite:multiarch-fixes'], REVALIDATE_AFTER_10_MINUTES),
+    'multiarch-fixes-hint-list': ConditionalRoute(
+        ['suite:multiarch-fixes'], REVALIDATE_AFTER_10_MINUTES),
+    'multiarch-fixes-hint': ConditionalRoute(
+        ['suite:multiarch-fixes'], REVALIDATE_AFTER_10_MINUTES),
+    'new-upstream-candidates': ConditionalRoute(
+        ['suite:{suite}'], REVALIDATE_AFTER_10_MINUTES),
+    'orphan-candidates': ConditionalRoute(
+        ['suite:orphan'], REVALIDATE_AFTER_10_MINUTES),
+    'generic-candidates': ConditionalRoute(
+        ['suite:{suite}'], REVALIDATE_AFTER_10_MINUTES),
+    'result-code-list': ConditionalRoute(
+        ['runs'], REVALIDATE_AFTER_10_MINUTES),
+    'result-code': ConditionalRoute(['runs'], REVALIDATE_AFTER_10_MINUTES),
+    'never-processed': ConditionalRoute(
+        ['runs', 'candidates'], REVALIDATE_AFTER_10_MINUTES),
+    'cupboard-maintainer-stats': ConditionalRoute(
+        ['runs', 'packages'], REVALIDATE_AFTER_10_MINUTES),
+    'failed-lintian-brush-fixer-list': ConditionalRoute(
+        ['runs'], REVALIDATE_AFTER_10_MINUTES),
+    'failed-lintian-brush-fixer': ConditionalRoute(
+        ['runs'], REVALIDATE_AFTER_10_MINUTES),
+    'lintian-brush-regressions': ConditionalRoute(
+        ['runs'], REVALIDATE_AFTER_10_MINUTES),
+    'vcs-regressions': ConditionalRoute(
+        ['runs'], REVALIDATE_AFTER_10_MINUTES),
+    'history': ConditionalRoute(['runs'], REVALIDATE),
+    'publish-history': ConditionalRoute(['publish'], REVALIDATE),
+    'cupboard-ready': ConditionalRoute(['runs', 'publish'], REVALIDATE),
+    'broken-mps': ConditionalRoute(['merge-proposals'], REVALIDATE),
+    # The API
+    'api-package-names': ConditionalRoute(['packages'], REVALIDATE),
+    'api-package-list': ConditionalRoute(['packages'], REVALIDATE),
+    'api-package': ConditionalRoute(['package:{package}'], REVALIDATE),
+    'api-package-merge-proposals': ConditionalRoute(
+        ['package:{package}'], REVALIDATE),
+    'api-package-policy': ConditionalRoute(['package:{package}'], REVALIDATE),
+    'api-package-diff': ConditionalRoute(['package:{package}'], REVALIDATE),
+    'api-merge-proposals': ConditionalRoute(['merge-proposals'], REVALIDATE),
+    'api-queue': ConditionalRoute(['queue'], REVALIDATE),
+    'api-run-list': ConditionalRoute(['runs'], REVALIDATE),
+    'api-run': ConditionalRoute(['runs'], REVALIDATE),
+    'api-package-run-list': ConditionalRoute(
+        ['package:{package}'], REVALIDATE),
+    'api-package-run': ConditionalRoute(['package:{package}'], REVALIDATE),
+    # The diff for a run doesn't change.
+    'api-run-diff': ConditionalRoute([], IMMUTABLE),
+    'api-package-run-diff': ConditionalRoute([], IMMUTABLE),
+    'api-publish-ready': ConditionalRoute(['runs', 'publish'], REVALIDATE),
+    'api-publish-ready-suite': ConditionalRoute(
+        ['suite:{suite}', 'publish'], REVALIDATE),
+    'api-published-packages': ConditionalRoute(
+        ['suite:{suite}', 'publish'], REVALIDATE),
+    'publish-details': ConditionalRoute(['publish'], REVALIDATE),
+}
+
+conditional_requests = Counter(
+    'conditional_requests_total',
+    'Requests for routes that support conditional requests, by whether '
+    'they were answered with a 304.',
+    labelnames=('route', 'result'))
+
+response_cache_requests = Counter(
+    'response_cache_requests_total',
+    'Requests for cacheable pages, by whether they were served from cache.',
+    labelnames=('route', 'result'))
+response_cache_invalidations = Counter(
+    'response_cache_invalidations_total',
+    'Cached responses that were invalidated.',
+    labelnames=('reason', ))
+response_cache_entries = Gauge(
+    'response_cache_entries', 'Number of responses in the response cache.')
+
+
+class CachedResponse(object):
+
+    def __init__(self, expiry: float, tags: Set[str], body: bytes,
+                 headers: Dict[str, str]):
+        self.expiry = expiry
+        self.tags = tags
+        self.body = body
+        self.headers = headers
+
+    def response(self) -> web.Response:
+        return web.Response(body=self.body, headers=self.headers)
+
+
+class ResponseCache(object):
+    """In-memory cache of rendered pages, invalidated by tag.
+
+    Least recently used entries are evicted when the cache is full.
+    """
+
+    def __init__(self, max_size: int = RESPONSE_CACHE_SIZE,
+                 max_age: float = RESPONSE_CACHE_MAX_AGE):
+        self.max_size = max_size
+        self.max_age = max_age
+        # Incremented on every invalidation, so that responses that were
+        # rendered while an invalidation happened aren't stored.
+        self.generation = 0
+        self._entries: Dict[Hashable, CachedResponse] = OrderedDict()
+        self._by_tag: Dict[str, Set[Hashable]] = {}
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expiry < time.monotonic():
+            self._remove(key)
+            response_cache_invalidations.labels(reason='expired').inc()
+            return None
+        self._entries.move_to_end(key)  # type: ignore
+        return entry
+
+    def put(self, key: Hashable, tags: Set[str],
+            response: web.Response) -> None:
+        if key in self._entries:
+            self._remove(key)
+        headers = {
+            k: v for (k, v) in response.headers.items()
+            if k != hdrs.CONTENT_LENGTH}
+        self._entries[key] = CachedResponse(
+            time.monotonic() + self.max_age, tags, response.body, headers)
+        for tag in tags:
+            self._by_tag.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+            response_cache_invalidations.labels(reason='evicted').inc()
+        response_cache_entries.set(len(self._entries))
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self._entries.pop(key)
+        for tag in entry.tags:
+            keys = self._by_tag[tag]
+            keys.discard(key)
+            if not keys:
+                del self._by_tag[tag]
+        response_cache_entries.set(len(self._entries))
+
+    def invalidate(self, tags: List[str]) -> int:
+        """Remove all entries with any of the specified tags.
+
+        Returns:
+          number of entries removed
+        """
+        self.generation += 1
+        keys: Set[Hashable] = set()
+        for tag in tags:
+            keys.update(self._by_tag.get(tag, ()))
+        for key in keys:
+            self._remove(key)
+        response_cache_invalidations.labels(reason='changed').inc(len(keys))
+        return len(keys)
+
+
+def invalidate_response_cache(
+        cache: ResponseCache, topic: str, msg: Dict) -> None:
+    """Invalidate cached responses affected by a pubsub notification.
+
+    Args:
+      cache: Response cache
+      topic: Name of the topic ('result', 'publish' or 'merge-proposal')
+      msg: Notification
+    """
+    tags = {
+        'result': ['runs'],
+        'publish': ['publish'],
+        'merge-proposal': ['merge-proposals'],
+        }[topic]
+    if msg.get('package'):
+        tags.append('package:%s' % msg['package'])
+    if msg.get('suite'):
+        tags.append('suite:%s' % msg['suite'])
+    cache.invalidate(tags)
+
+
+@middleware
+async def prerendered_middleware(request, handler):
+    """Serve pages pre-rendered by janitor.site.prerender, if fresh."""
+    filename = request.app.prerendered_pages.get(request.path)
+    if (filename is None or request.method != 'GET' or request.query_string
+            or getattr(request, 'user', None)):
+        return await handler(request)
+    from .prerender import MAX_AGE
+    try:
+        mtime = os.stat(filename).st_mtime
+    except FileNotFoundError:
+        return await handler(request)
+    if mtime < time.time() - MAX_AGE:
+        return await handler(request)
+    return web.FileResponse(
+        filename, headers={'Cache-Control': 'max-age=60'})
+
+
+def compute_site_version() -> str:
+    """Compute a version for the code and templates of the site.
+
+    This is part of every ETag, so that responses rendered by a different
+    version of the site don't match.
+    """
+    from janitor import version_string
+    h = hashlib.sha256(version_string.encode())
+    directory = os.path.dirname(__file__)
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(('.py', '.html')):
+                path = os.path.join(root, name)
+                h.update(os.path.relpath(path, directory).encode())
+                with open(path, 'rb') as f:
+                    h.update(f.read())
+    return h.hexdigest()
+
+
+def compute_etag(
+        site_version: str, key: List[str],
+        versions: Dict[str, Tuple[int, datetime]], weak: bool = False) -> str:
+    """Compute an ETag.
+
+    Args:
+      site_version: Version of the site, see compute_site_version
+      key: Strings that identify the response, e.g. the route and URL
+      versions: Versions of the data the response depends on, as returned by
+        state.get_data_versions
+      weak: Whether to return a weak ETag, for responses that can change
+        without the ETag changing
+    """
+    h = hashlib.sha256(site_version.encode())
+    for value in key:
+        h.update(b'\0' + value.encode('utf-8'))
+    for name, (version, modified) in sorted(versions.items()):
+        h.update(('\0%s=%d' % (name, version)).encode('utf-8'))
+    return '%s"%s"' % ('W/' if weak else '', h.hexdigest()[:32])
+
+
+def _strip_weak(etag: str) -> str:
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Check whether an If-None-Match header matches an ETag.
+
+    If-None-Match uses the weak comparison, i.e. W/ prefixes are ignored.
+    """
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if _strip_weak(candidate) == _strip_weak(etag):
+            return True
+    return False
+
+
+def is_not_modified(
+        request, etag: str, last_modified: Optional[datetime]) -> bool:
+    """Check whether a request can be answered with a 304."""
+    if_none_match = request.headers.get(hdrs.IF_NONE_MATCH)
+    # If-Modified-Since is ignored if there is an If-None-Match header.
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = request.if_modified_since
+    if if_modified_since is None or last_modified is None:
+        return False
+    # HTTP dates only have a resolution of seconds.
+    return last_modified.replace(microsecond=0) <= if_modified_since
+
+
+def set_conditional_headers(resp, conditional, etag, last_modified):
+    resp.headers[hdrs.ETAG] = etag
+    if last_modified is not None:
+        resp.last_modified = last_modified
+    resp.headers[hdrs.CACHE_CONTROL] = conditional.cache_control
+    vary = [v.strip() for v in resp.headers.get(hdrs.VARY, '').split(',')
+            if v.strip()]
+    for header in ['Cookie', hdrs.ACCEPT_ENCODING]:
+        if header not in vary:
+            vary.append(header)
+    resp.headers[hdrs.VARY] = ', '.join(vary)
+
+
+@middleware
+async def conditional_middleware(request, handler):
+    route = request.match_info.route.name
+    conditional = CONDITIONAL_ROUTES.get(route)
+    # Pages for logged in users can contain user-specific content.
+    if (conditional is None or
+            request.method not in (hdrs.METH_GET, hdrs.METH_HEAD) or
+            getattr(request, 'user', None)):
+        return await handler(request)
+    names = [v.format(**request.match_info) for v in conditional.versions]
+    if names:
+        async with request.app.database.acquire() as conn:
+            versions = await state.get_data_versions(conn, names)
+    else:
+        versions = {}
+    modified = [m for (v, m) in versions.values()]
+    key = [route, str(request.rel_url),
+           request.headers.get(hdrs.ACCEPT, ''),
+           request.headers.get(hdrs.ACCEPT_ENCODING, '')]
+    if conditional.unversioned:
+        period = int(time.time() // UNVERSIONED_MAX_AGE)
+        key.append(str(period))
+        modified.append(datetime.fromtimestamp(
+            period * UNVERSIONED_MAX_AGE, timezone.utc))
+    modified.append(request.app.started)
+    # Responses that depend on unversioned data can change within a period,
+    # so they only get a weak ETag.
+    etag = compute_etag(
+        request.app.site_version, key, versions,
+        weak=conditional.unversioned)
+    last_modified: Optional[datetime] = max(modified)
+    if (datetime.now(timezone.utc) - last_modified <
+            timedelta(seconds=LAST_MODIFIED_MIN_AGE)):
+        last_modified = None
+    if is_not_modified(request, etag, last_modified):
+        conditional_requests.labels(route=route, result='not-modified').inc()
+        resp = web.Response(status=304)
+        set_conditional_headers(resp, conditional, etag, last_modified)
+        return resp
+    conditional_requests.labels(route=route, result='modified').inc()
+    # The response cache is keyed on the ETag, so that it never returns a
+    # response older than the ETag claims.
+    request['etag'] = etag
+    resp = await handler(request)
+    if resp.status == 200 and not resp.prepared:
+        set_conditional_headers(resp, conditional, etag, last_modified)
+    return resp
+
+
+@middleware
+async def response_cache_middleware(request, handler):
+    route = request.match_info.route.name
+    tag_templates = CACHED_ROUTES.get(route)
+    # Pages for logged in users can contain user-specific content.
+    if (tag_templates is None or request.method != 'GET' or
+            getattr(request, 'user', None)):
+        return await handler(request)
+    cache = request.app.response_cache
+    key = (route, str(request.rel_url), request.get('etag'))
+    entry = cache.get(key)
+    if entry is not None:
+        response_cache_requests.labels(route=route, result='hit').inc()
+        return entry.response()
+    response_cache_requests.labels(route=route, result='miss').inc()
+    generation = cache.generation
+    resp = await handler(request)
+    if (type(resp) is web.Response and resp.status == 200 and
+            isinstance(resp.body, bytes) and
+            generation == cache.generation):
+        cache.put(
+            key, {t.format(**request.match_info) for t in tag_templates},
+            resp)
+    return resp
+
 
 class ForwardedResource(PrefixResource):
 
@@ -115,14 +607,16 @@ class ForwardedResource(PrefixResource):
         service = request.query.get('service')
         if service:
             params['service'] = service
-        if await is_worker(request.app.database, request):
+        if await is_worker(request.app.worker_credentials, request):
             params['allow_writes'] = '1'
         note('Forwarding: method: %s, url: %s, params: %r, headers: %r',
              request.method, url, params, headers)
+        # Forwarded requests can stream for a long time, so they don't count
+        # towards the backend's concurrency limit.
         async with request.app.http_client_session.request(
                 request.method, url, params=params, headers=headers,
                 data=request.content,
-                timeout=ClientTimeout(FORWARD_CLIENT_TIMEOUT)
+                timeout=ClientTimeout(FORWARD_CLIENT_TIMEOUT), limit=False
                 ) as client_response:
             status = client_response.status
 
@@ -180,7 +674,9 @@ class ForwardedResource(PrefixResource):
 async def openid_middleware(request, handler):
     session_id = request.cookies.get('session_id')
     if session_id is not None:
-        async with request.app.database.acquire() as conn:
+        # Sessions are created on the primary; don't wait for them to be
+        # replicated.
+        async with request.app.database.primary.acquire() as conn:
             row = await state.get_site_session(conn, session_id)
             if row is not None:
                 (userinfo, ) = row
@@ -203,6 +699,123 @@ def iter_accept(request):
         h.strip() for h in request.headers.get('Accept', '*/*').split(',')]
 
 
+def accepts_gzip(request):
+    for entry in request.headers.get(hdrs.ACCEPT_ENCODING, '').split(','):
+        coding, _, params = entry.partition(';')
+        if coding.strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        params = params.replace(' ', '')
+        return not re.match('^q=0(\\.0*)?$', params)
+    return False
+
+
+async def read_range(chunks, start, stop, limit=MAX_RANGE_LENGTH):
+    """Read a byte range from a stream.
+
+    Args:
+      chunks: async iterator over the chunks of the stream
+      start: offset of the range; negative for the last -start bytes
+      stop: end of the range (exclusive), or None for the end of the stream
+      limit: maximum number of bytes to return
+    Returns:
+      tuple with offset of the returned data, the data and the length of
+      the stream (or None if the stream was not read until the end)
+    """
+    offset = 0
+    data = bytearray()
+    if start < 0:
+        keep = min(-start, limit)
+        async for chunk in chunks:
+            offset += len(chunk)
+            data += chunk
+            if len(data) > keep:
+                del data[:len(data) - keep]
+        return offset - len(data), bytes(data), offset
+    if stop is None or stop - start > limit:
+        stop = start + limit
+    async for chunk in chunks:
+        if offset + len(chunk) > start:
+            data += chunk[max(0, start - offset):stop - offset]
+        offset += len(chunk)
+        if offset >= stop:
+            return start, bytes(data), None
+    return start, bytes(data), offset
+
+
+async def write_chunks(request, resp, chunks):
+    await resp.prepare(request)
+    if request.method != hdrs.METH_HEAD:
+        async for chunk in chunks:
+            await resp.write(chunk)
+    await resp.write_eof()
+    return resp
+
+
+async def stream_log(request, logfile_manager, pkg, run_id, filename):
+    """Stream a log file.
+
+    Logs are stored gzipped; if the client accepts gzip, the stored data is
+    passed through as is. Otherwise, it is decompressed while streaming.
+    Range requests are served from the decompressed log.
+    """
+    from ..logs import gunzip_chunks
+    try:
+        encoding, raw_chunks = await logfile_manager.iter_log_chunks(
+            pkg, run_id, filename)
+    except FileNotFoundError:
+        raise web.HTTPNotFound(
+            text='No log file %s for run %s' % (filename, run_id))
+    headers = {
+        'Cache-Control': 'max-age=3600',
+        hdrs.ACCEPT_RANGES: 'bytes',
+        hdrs.VARY: hdrs.ACCEPT_ENCODING,
+        }
+    try:
+        try:
+            http_range = request.http_range
+        except ValueError:
+            # Unsupported (e.g. multiple) ranges; serve the whole log.
+            http_range = slice(None, None)
+        chunks = raw_chunks
+        if encoding == 'gzip':
+            if http_range.start is None and accepts_gzip(request):
+                headers[hdrs.CONTENT_ENCODING] = 'gzip'
+            else:
+                chunks = gunzip_chunks(raw_chunks)
+        if http_range.start is not None:
+            start, data, length = await read_range(
+                chunks, http_range.start, http_range.stop)
+            if not data:
+                headers[hdrs.CONTENT_RANGE] = 'bytes */%d' % length
+                raise web.HTTPRequestRangeNotSatisfiable(headers=headers)
+            headers[hdrs.CONTENT_RANGE] = 'bytes %d-%d/%s' % (
+                start, start + len(data) - 1,
+                '*' if length is None else length)
+            return web.Response(
+                status=206, body=data, content_type='text/plain',
+                charset='utf-8', headers=headers)
+        resp = web.StreamResponse(headers=headers)
+        resp.content_type = 'text/plain'
+        resp.charset = 'utf-8'
+        return await write_chunks(request, resp, chunks)
+    finally:
+        await raw_chunks.aclose()
+
+
+async def stream_artifact(request, artifact_manager, run_id, filename):
+    try:
+        chunks = await artifact_manager.iter_artifact_chunks(
+            run_id, filename)
+    except FileNotFoundError:
+        raise web.HTTPNotFound(
+            text='No artifact %s for run %s' % (filename, run_id))
+    try:
+        resp = web.StreamResponse(headers={'Cache-Control': 'max-age=3600'})
+        return await write_chunks(request, resp, chunks)
+    finally:
+        await chunks.aclose()
+
+
 async def get_credentials(session, publisher_url):
     url = urllib.parse.urljoin(publisher_url, 'credentials')
     async with session.get(url=url) as resp:
@@ -211,72 +824,46 @@ async def get_credentials(session, publisher_url):
         return await resp.json()
 
 
-if __name__ == '__main__':
-    import argparse
+def create_app(
+        config, policy_config, publisher_url: str, runner_url: str,
+        archiver_url: str, vcs_store_url: str, differ_url: str,
+        external_url: Optional[str] = None, debug: bool = False,
+        enable_external_workers: bool = True,
+        prerender_directory: Optional[str] = None,
+        template_cache_directory: Optional[str] = None) -> web.Application:
+    """Create the web application for the site.
+
+    This doesn't connect to anything; databases and other services are
+    only contacted once the application starts.
+
+    Args:
+      config: Janitor configuration
+      policy_config: Policy configuration
+      publisher_url: URL of the publisher
+      runner_url: URL of the runner
+      archiver_url: URL of the archiver
+      vcs_store_url: URL of the VCS store
+      differ_url: URL of the differ
+      external_url: External URL of the site, if known
+      debug: Whether to enable debugging mode (e.g. use unminified JS)
+      enable_external_workers: Whether to support external workers
+      prerender_directory: Directory with prerendered pages
+      template_cache_directory: Directory to store compiled templates in
+    Returns:
+      an aiohttp application
+    """
     import functools
-    import os
-    import re
-    from janitor import state
-    from janitor.config import read_config
     from janitor.logs import get_log_manager
-    from janitor.policy import read_policy
     from janitor.prometheus import setup_metrics
-    from aiohttp import web, ClientSession
+    from janitor.http_client import HttpClient
     from aiohttp.web_middlewares import normalize_path_middleware
     from ..pubsub import pubsub_reader, pubsub_handler, Topic
-    import urllib.parse
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--host', type=str, help='Host to listen on')
-    parser.add_argument(
-        '--port',
-        type=int, help='Port to listen on', default=8080)
-    parser.add_argument(
-        '--publisher-url', type=str,
-        default='http://localhost:9912/',
-        help='URL for publisher.')
-    parser.add_argument(
-        '--vcs-store-url', type=str,
-        default='http://localhost:9921/',
-        help='URL for VCS store.')
-    parser.add_argument(
-        '--runner-url', type=str,
-        default='http://localhost:9911/',
-        help='URL for runner.')
-    parser.add_argument(
-        '--archiver-url', type=str,
-        default='http://localhost:9914/',
-        help='URL for runner.')
-    parser.add_argument(
-        '--differ-url', type=str,
-        default='http://localhost:9920/',
-        help='URL for differ.')
-    parser.add_argument(
-        "--policy",
-        help="Policy file to read.", type=str,
-        default=os.path.join(
-            os.path.dirname(__file__), '..', '..', 'policy.conf'))
-    parser.add_argument(
-        '--config', type=str, default='janitor.conf',
-        help='Path to configuration.')
-    parser.add_argument(
-        '--debug', action='store_true',
-        help='Enable debugging mode. For example, avoid minified JS.')
-    parser.add_argument(
-        '--no-external-workers', action='store_true', default=False,
-        help='Disable support for external workers.')
-    parser.add_argument(
-        '--external-url', type=str, default=None, help='External URL')
-
-    args = parser.parse_args()
 
-    if args.debug:
+    if debug:
         minified = ''
     else:
         minified = 'min.'
 
-    with open(args.config, 'r') as f:
-        config = read_config(f)
-
     logfile_manager = get_log_manager(config.logs_location)
 
     async def handle_simple(templatename, request):
@@ -386,14 +973,33 @@ if __name__ == '__main__':
     async def handle_history(request):
         limit = int(request.query.get('limit', '100'))
         worker = request.query.get('worker', None)
+        days = request.query.get('days', None)
+        if days is not None:
+            try:
+                since = datetime.now() - timedelta(days=int(days))
+            except (ValueError, OverflowError):
+                raise web.HTTPBadRequest(text='invalid number of days')
+        else:
+            since = None
+        try:
+            history = [run async for run in state.iter_runs(
+                request.app.database, worker=worker, limit=limit,
+                since=since, after=request.query.get('after'))]
+        except ValueError:
+            raise web.HTTPBadRequest(text='invalid cursor')
+        if limit and len(history) == limit:
+            next_cursor = state.run_cursor(history[-1])
+        else:
+            next_cursor = None
         return {
             'count': limit,
-            'history': state.iter_runs(
-                request.app.database, worker=worker, limit=limit)}
+            'history': history,
+            'next_cursor': next_cursor}
 
     @html_template(
         'credentials.html', headers={'Cache-Control': 'max-age=10'})
     async def handle_credentials(request):
+        import gpg
         credentials = await get_credentials(
             request.app.http_client_session,
             request.app.publisher_url)
@@ -460,9 +1066,13 @@ if __name__ == '__main__':
     async def handle_queue(request):
         limit = int(request.query.get('limit', '100'))
         from .queue import write_queue
-        return await write_queue(
-            request.app.http_client_session, request.app.database,
-            queue_status=app.runner_status, limit=limit)
+        try:
+            return await write_queue(
+                request.app.http_client_session, request.app.database,
+                queue_status=app.runner_status, limit=limit,
+                after=request.query.get('after'))
+        except ValueError:
+            raise web.HTTPBadRequest(text='invalid cursor')
 
     @html_template(
         'maintainer-stats.html',
@@ -492,7 +1102,7 @@ if __name__ == '__main__':
             return {'never_processed': never_processed}
 
     async def handle_result_codes(request):
-        from .result_codes import generate_result_code_index
+        from .result_codes import generate_result_code_page
         suite = request.query.get('suite')
         if suite is not None and suite.lower() == '_all':
             suite = None
@@ -500,27 +1110,29 @@ if __name__ == '__main__':
         all_suites = [s.name for s in config.suite]
         async with request.app.database.acquire() as conn:
             if not code:
-                stats = await state.stats_by_result_codes(conn, suite=suite)
-                if suite:
-                    suites = [suite]
-                else:
-                    suites = None
-                never_processed = sum(dict(
-                    await state.get_never_processed_count(conn, suites)
-                    ).values())
-
-                vs = await generate_result_code_index(
-                    stats, never_processed, suite, all_suites=all_suites)
+                vs = await generate_result_code_page(conn, suite, all_suites)
                 text = await render_template_for_request(
                     'result-code-index.html', request, vs)
             else:
-                runs = [run async for run in state.iter_last_runs(
-                    conn, code, suite=suite)]
+                limit = request.query.get('limit')
+                if limit is not None:
+                    limit = int(limit)
+                try:
+                    runs = [run async for run in state.iter_last_runs(
+                        conn, code, suite=suite, limit=limit,
+                        after=request.query.get('after'))]
+                except ValueError:
+                    raise web.HTTPBadRequest(text='invalid cursor')
+                if limit and len(runs) == limit:
+                    next_cursor = state.run_cursor(runs[-1])
+                else:
+                    next_cursor = None
 
                 text = await render_template_for_request(
                     'result-code.html', request, {
                         'code': code, 'runs': runs, 'suite': suite,
-                        'all_suites': all_suites})
+                        'all_suites': all_suites,
+                        'next_cursor': next_cursor})
         return web.Response(
             content_type='text/html', text=text,
             headers={'Cache-Control': 'max-age=600'})
@@ -701,28 +1313,11 @@ order by url, last_run.finish_time desc
             if not re.match('^[+a-z0-9\\.]+$', filename) or len(filename) < 3:
                 raise web.HTTPNotFound(
                     text='No log file %s for run %s' % (filename, run_id))
-
-            try:
-                logfile = await logfile_manager.get_log(pkg, run_id, filename)
-            except FileNotFoundError:
-                raise web.HTTPNotFound(
-                    text='No log file %s for run %s' % (filename, run_id))
-            else:
-                with logfile as f:
-                    text = f.read().decode('utf-8', 'replace')
-            return web.Response(
-                content_type='text/plain', text=text,
-                headers={'Cache-Control': 'max-age=3600'})
+            return await stream_log(
+                request, logfile_manager, pkg, run_id, filename)
         else:
-            try:
-                artifact = await request.app.artifact_manager.get_artifact(
-                    run_id, filename)
-            except FileNotFoundError:
-                raise web.HTTPNotFound(
-                    'No artifact %s for run %s' % (filename, run_id))
-            with artifact as f:
-                return web.Response(
-                    body=f.read(), headers={'Cache-Control': 'max-age=3600'})
+            return await stream_artifact(
+                request, request.app.artifact_manager, run_id, filename)
 
     @html_template(
         'ready-list.html',
@@ -899,7 +1494,7 @@ order by url, last_run.finish_time desc
     async def handle_review_post(request):
         from .review import generate_review
         post = await request.post()
-        async with request.app.database.acquire() as conn:
+        async with request.app.database.primary.acquire() as conn:
             run = await state.get_run(conn, post['run_id'])
             review_status = post['review_status'].lower()
             if review_status == 'reschedule':
@@ -972,7 +1567,7 @@ order by url, last_run.finish_time desc
                     resp.status, await resp.read()))
             userinfo = await resp.json()
         session_id = str(uuid.uuid4())
-        async with request.app.database.acquire() as conn:
+        async with request.app.database.primary.acquire() as conn:
             await state.store_site_session(conn, session_id, userinfo)
 
         # TODO(jelmer): Store access token / refresh token?
@@ -986,6 +1581,7 @@ order by url, last_run.finish_time desc
         return resp
 
     async def start_gpg_context(app):
+        import gpg
         gpg_home = tempfile.TemporaryDirectory()
         gpg_context = gpg.Context(home_dir=gpg_home.name)
         app.gpg = gpg_context.__enter__()
@@ -1012,11 +1608,14 @@ order by url, last_run.finish_time desc
         async def listen_to_publisher_publish(app):
             url = urllib.parse.urljoin(app.publisher_url, 'ws/publish')
             async for msg in pubsub_reader(app.http_client_session, url):
+                invalidate_response_cache(app.response_cache, 'publish', msg)
                 app.topic_notifications.publish(['publish', msg])
 
         async def listen_to_publisher_mp(app):
             url = urllib.parse.urljoin(app.publisher_url, 'ws/merge-proposal')
             async for msg in pubsub_reader(app.http_client_session, url):
+                invalidate_response_cache(
+                    app.response_cache, 'merge-proposal', msg)
                 app.topic_notifications.publish(['merge-proposal', msg])
 
         app.runner_status = None
@@ -1027,8 +1626,13 @@ order by url, last_run.finish_time desc
                 app.runner_status = msg
                 app.topic_notifications.publish(['queue', msg])
 
+        async def listen_to_runner_results(app):
+            url = urllib.parse.urljoin(app.runner_url, 'ws/result')
+            async for msg in pubsub_reader(app.http_client_session, url):
+                invalidate_response_cache(app.response_cache, 'result', msg)
+
         for cb in [listen_to_publisher_publish, listen_to_publisher_mp,
-                   listen_to_runner]:
+                   listen_to_runner, listen_to_runner_results]:
             listener = app.loop.create_task(cb(app))
 
             async def stop_listener(app):
@@ -1097,13 +1701,13 @@ order by url, last_run.finish_time desc
         '/{suite:%s}/pkg/' % SUITE_REGEX, handle_pkg_list,
         name='suite-package-list')
     app.router.register_resource(
-        ForwardedResource('dists', args.archiver_url.rstrip('/') + '/dists'))
+        ForwardedResource('dists', archiver_url.rstrip('/') + '/dists'))
     app.router.register_resource(
         ForwardedResource(
-            'bzr', args.vcs_store_url.rstrip('/') + '/bzr'))
+            'bzr', vcs_store_url.rstrip('/') + '/bzr'))
     app.router.register_resource(
         ForwardedResource(
-            'git', args.vcs_store_url.rstrip('/') + '/git'))
+            'git', vcs_store_url.rstrip('/') + '/git'))
     app.router.add_get(
         '/multiarch-fixes/pkg/{pkg}/', handle_multiarch_fixes_pkg,
         name='multiarch-fixes-package')
@@ -1252,9 +1856,10 @@ order by url, last_run.finish_time desc
         app.router.add_get(
             '/_static/%s' % entry.name,
             functools.partial(handle_static_file, entry.path))
-    app.router.add_static(
-        '/_static/images/datatables',
-        '/usr/share/javascript/jquery-datatables/images')
+    if os.path.isdir('/usr/share/javascript/jquery-datatables/images'):
+        app.router.add_static(
+            '/_static/images/datatables',
+            '/usr/share/javascript/jquery-datatables/images')
     for (name, kind, basepath) in [
             ('chart', 'js', '/usr/share/javascript/chart.js/Chart'),
             ('chart', 'css', '/usr/share/javascript/chart.js/Chart'),
@@ -1277,39 +1882,66 @@ order by url, last_run.finish_time desc
         name='oauth2-callback')
 
     from .api import create_app as create_api_app, process_webhook
-    with open(args.policy, 'r') as f:
-        policy_config = read_policy(f)
 
     async def handle_post_root(request):
         if ('X-Gitlab-Event' in request.headers or
                 'X-GitHub-Event' in request.headers):
-            return await process_webhook(request, request.app.database)
+            return await process_webhook(
+                request, request.app.database.primary)
         return web.HTTPMethodNotAllowed(text='Not a supported webhook')
 
-    app.http_client_session = ClientSession()
+    app.http_client_session = HttpClient()
+
+    async def close_http_client(app):
+        await app.http_client_session.close()
+    app.on_cleanup.append(close_http_client)
     app.topic_notifications = Topic('notifications')
-    app.runner_url = args.runner_url
-    app.archiver_url = args.archiver_url
-    app.differ_url = args.differ_url
+    app.runner_url = runner_url
+    app.archiver_url = archiver_url
+    app.differ_url = differ_url
     app.policy = policy_config
-    app.publisher_url = args.publisher_url
-    app.vcs_store_url = args.vcs_store_url
+    app.publisher_url = publisher_url
+    app.vcs_store_url = vcs_store_url
     if config.oauth2_provider and config.oauth2_provider.base_url:
         app.on_startup.append(discover_openid_config)
     app.on_startup.append(start_pubsub_forwarder)
     app.on_startup.append(start_gpg_context)
-    if args.external_url:
-        app.external_url = URL(args.external_url)
+    if external_url:
+        app.external_url = URL(external_url)
     else:
         app.external_url = None
-    database = state.Database(config.database_location)
+    # Most of the site only reads, so route it to the replica (if there is
+    # one). Handlers that write use app.database.primary.
+    database = state.Database(
+        config.database_location,
+        slow_query_threshold=(config.slow_query_threshold or None),
+        replica_url=(config.database_replica_location or None),
+        max_replica_lag=(
+            config.database_replica_max_lag or
+            state.DEFAULT_MAX_REPLICA_LAG)).readonly()
     app.database = database
+    app.worker_credentials = WorkerCredentialCache(database.primary)
+    app.on_startup.append(app.worker_credentials.start)
+    app.on_cleanup.append(app.worker_credentials.stop)
+
+    async def warm_up_database(app):
+        await app.database.warm_up()
+
+    app.on_startup.append(warm_up_database)
     from .stats import stats_app
     app.add_subapp(
         '/cupboard/stats', stats_app(database, config, app.external_url))
     app.config = config
-    from janitor.site import env, is_admin
+    from janitor.site import (
+        env, is_admin, precompile_templates, setup_template_cache)
+    if template_cache_directory:
+        setup_template_cache(template_cache_directory)
     app.jinja_env = env
+
+    async def load_templates(app):
+        precompile_templates()
+
+    app.on_startup.append(load_templates)
     from janitor.artifacts import get_artifact_manager
     app.artifact_manager = get_artifact_manager(config.artifact_location)
 
@@ -1318,6 +1950,18 @@ order by url, last_run.finish_time desc
 
     app.on_startup.append(startup_artifact_manager)
     setup_debsso(app)
+    if prerender_directory:
+        from .prerender import iter_page_filenames
+        app.prerendered_pages = iter_page_filenames(
+            config, prerender_directory)
+    else:
+        app.prerendered_pages = {}
+    app.middlewares.append(prerendered_middleware)
+    app.site_version = compute_site_version()
+    app.started = datetime.now(timezone.utc)
+    app.middlewares.append(conditional_middleware)
+    app.response_cache = ResponseCache()
+    app.middlewares.append(response_cache_middleware)
     setup_metrics(app)
     app.router.add_post(
         '/',
@@ -1330,11 +1974,89 @@ order by url, last_run.finish_time desc
         name='ws-notifications')
     app.add_subapp(
         '/api', create_api_app(
-            app.database, args.publisher_url, args.runner_url,  # type: ignore
-            args.archiver_url, args.vcs_store_url,
-            args.differ_url, config, policy_config,
-            enable_external_workers=(not args.no_external_workers),
+            app.database, publisher_url, runner_url,  # type: ignore
+            archiver_url, vcs_store_url,
+            differ_url, config, policy_config,
+            enable_external_workers=enable_external_workers,
             external_url=(
-                app.external_url.join(URL('api')
-                if app.external_url else None))))
+                app.external_url.join(URL('api'))
+                if app.external_url else None),
+            worker_credentials=app.worker_credentials,
+            http_client=app.http_client_session))
+    return app
+
+
+def main(argv=None):
+    import argparse
+    from janitor.config import read_config
+    from janitor.policy import read_policy
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, help='Host to listen on')
+    parser.add_argument(
+        '--port',
+        type=int, help='Port to listen on', default=8080)
+    parser.add_argument(
+        '--publisher-url', type=str,
+        default='http://localhost:9912/',
+        help='URL for publisher.')
+    parser.add_argument(
+        '--vcs-store-url', type=str,
+        default='http://localhost:9921/',
+        help='URL for VCS store.')
+    parser.add_argument(
+        '--runner-url', type=str,
+        default='http://localhost:9911/',
+        help='URL for runner.')
+    parser.add_argument(
+        '--archiver-url', type=str,
+        default='http://localhost:9914/',
+        help='URL for runner.')
+    parser.add_argument(
+        '--differ-url', type=str,
+        default='http://localhost:9920/',
+        help='URL for differ.')
+    parser.add_argument(
+        "--policy",
+        help="Policy file to read.", type=str,
+        default=os.path.join(
+            os.path.dirname(__file__), '..', '..', 'policy.conf'))
+    parser.add_argument(
+        '--config', type=str, default='janitor.conf',
+        help='Path to configuration.')
+    parser.add_argument(
+        '--debug', action='store_true',
+        help='Enable debugging mode. For example, avoid minified JS.')
+    parser.add_argument(
+        '--no-external-workers', action='store_true', default=False,
+        help='Disable support for external workers.')
+    parser.add_argument(
+        '--external-url', type=str, default=None, help='External URL')
+    parser.add_argument(
+        '--prerender-directory', type=str, default=None,
+        help='Directory with pages rendered by janitor.site.prerender.')
+    parser.add_argument(
+        '--template-cache-directory', type=str,
+        default=os.environ.get('JANITOR_TEMPLATE_CACHE'),
+        help='Directory to store compiled templates in.')
+
+    args = parser.parse_args(argv)
+
+    with open(args.config, 'r') as f:
+        config = read_config(f)
+
+    with open(args.policy, 'r') as f:
+        policy_config = read_policy(f)
+
+    app = create_app(
+        config, policy_config, args.publisher_url, args.runner_url,
+        args.archiver_url, args.vcs_store_url, args.differ_url,
+        external_url=args.external_url, debug=args.debug,
+        enable_external_workers=(not args.no_external_workers),
+        prerender_directory=args.prerender_directory,
+        template_cache_directory=args.template_cache_directory)
     web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv[1:]))
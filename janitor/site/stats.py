@@ -50,13 +50,14 @@ async def write_maintainer_overview(conn, maintainer):
 async def handle_graph_pushes_over_time(request, conn):
     labels = []
     counts = []
-    for (timestamp, count) in await conn.fetch(
-            'SELECT timestamp, '
-            'sum(count(*)) over (order by timestamp asc rows '
-            'between unbounded preceding and current row) FROM publish '
+    for (day, count) in await conn.fetch(
+            'SELECT day, '
+            'sum(sum(count)) over (order by day asc rows '
+            'between unbounded preceding and current row) '
+            'FROM publish_rollup '
             'WHERE mode = \'push\' and result_code = \'success\' '
-            'group by 1 order by timestamp'):
-        labels.append(timestamp.isoformat())
+            'group by 1 order by day'):
+        labels.append(day.isoformat())
         counts.append(int(count))
     return {
         'labels': labels,
@@ -82,26 +83,42 @@ async def handle_stats(request):
 
 @json_chart_data(max_age=60)
 async def handle_graph_merges_over_time(request, conn):
-    return {
-        'opened': {timestamp.isoformat(): int(count)
-                   for (timestamp, count) in await conn.fetch("""
-select
-  timestamp,
-  sum(count(*)) over (order by timestamp asc rows
-                      between unbounded preceding and current row) as open
-from
-    (select distinct on (merge_proposal_url) timestamp from
-     publish where mode = 'propose' and result_code = 'success'
-     group by merge_proposal_url, timestamp
-     order by merge_proposal_url, timestamp)
-as i group by 1""")},
-        'merged': {timestamp.isoformat(): int(count)
-                   for (timestamp, count) in await conn.fetch("""
-select merged_at, sum(count(*)) over (
-    order by merged_at asc rows between unbounded preceding and current row)
-as merged from merge_proposal
-where status = 'merged' and merged_at is not null group by 1""")}
-        }
+    ret = {}
+    for event in ['opened', 'merged']:
+        ret[event] = {
+            day.isoformat(): int(count)
+            for (day, count) in await conn.fetch("""
+select day, sum(count) over (
+    order by day asc rows between unbounded preceding and current row)
+from merge_proposal_rollup where event = $1
+""", event)}
+    return ret
+
+
+@json_chart_data(max_age=60)
+async def handle_graph_result_codes(request, conn):
+    query = "select result_code, sum(count) from run_rollup"
+    args = []
+    suite = request.query.get('suite')
+    if suite is not None:
+        query += " where suite = $1"
+        args.append(suite)
+    query += " group by 1 order by 2 desc"
+    return [(result_code, int(count))
+            for (result_code, count) in await conn.fetch(query, *args)]
+
+
+@json_chart_data(max_age=60)
+async def handle_graph_duration(request, conn):
+    query = "select duration_bucket, sum(count) from run_rollup"
+    args = []
+    suite = request.query.get('suite')
+    if suite is not None:
+        query += " where suite = $1"
+        args.append(suite)
+    query += " group by 1 order by 1"
+    return [(bucket, int(count))
+            for (bucket, count) in await conn.fetch(query, *args)]
 
 
 @json_chart_data(max_age=60)
@@ -229,6 +246,12 @@ def stats_app(database, config, external_url):
     app.router.add_get(
         '/+chart/merges-over-time', handle_graph_merges_over_time,
         name='graph-merges-over-time')
+    app.router.add_get(
+        '/+chart/result-codes', handle_graph_result_codes,
+        name='graph-result-codes')
+    app.router.add_get(
+        '/+chart/duration', handle_graph_duration,
+        name='graph-duration')
     app.router.add_get(
         '/+chart/time-to-merge', handle_graph_time_to_merge,
         name='graph-time-to-merge')
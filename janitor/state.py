@@ -15,12 +15,22 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import asyncio
+import base64
+import binascii
+import contextvars
 import datetime
 from debian.changelog import Version
+import functools
+import hashlib
+import inspect
 import json
+import os
 import shlex
+import sys
+import time
 import asyncpg
-from contextlib import asynccontextmanager
+from contextlib import AsyncExitStack, asynccontextmanager
 from typing import (
     Optional,
     Tuple,
@@ -33,36 +43,399 @@ from typing import (
     Dict
     )
 from breezy import urlutils
-from breezy.trace import warning
+from breezy.trace import note, warning
+from prometheus_client import Counter, Gauge, Histogram
+
+
+# Name of the service, used to label the database metrics.
+SERVICE_NAME = (
+    os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'unknown')
+
+query_duration = Histogram(
+    'db_query_duration_seconds', 'Time spent in database functions',
+    ['service', 'query'])
+
+slow_query_count = Counter(
+    'db_slow_query_total', 'Number of queries exceeding the slow query '
+    'threshold', ['service', 'query'])
+
+pool_wait_duration = Histogram(
+    'db_pool_wait_seconds', 'Time spent waiting for a pooled connection',
+    ['service', 'pool'])
+
+connections_in_use = Gauge(
+    'db_connections_in_use', 'Number of pooled connections in use',
+    ['service', 'pool'])
+
+replica_lag = Gauge(
+    'db_replica_lag_seconds', 'Replication lag of the read replica',
+    ['service'])
+
+# Name of the database function that is currently running, used to
+# attribute slow queries.
+_current_query: contextvars.ContextVar[str] = contextvars.ContextVar(
+    'current_query', default='unknown')
+
+# Only EXPLAIN a particular slow query this often (in seconds).
+SLOW_QUERY_EXPLAIN_INTERVAL = 600
+
+
+# Maximum number of prepared statements asyncpg caches per connection. Most
+# of our queries are built from a few dozen templates, but the optional
+# filters and column projections multiply that; the asyncpg default of 100
+# is easily exhausted by the site alone.
+STATEMENT_CACHE_SIZE = 512
+
+# Prepared statements are invalidated by asyncpg on schema changes, so there
+# is no need to expire them after a fixed period.
+MAX_CACHED_STATEMENT_LIFETIME = 0
+
+# Default maximum replication lag (in seconds) before read-only queries are
+# sent to the primary rather than the replica.
+DEFAULT_MAX_REPLICA_LAG = 30
+
+# How often to check the replication lag (in seconds).
+REPLICA_LAG_CHECK_INTERVAL = 5
+
+# Errors that indicate that the replica is unreachable (rather than a problem
+# with a particular query).
+REPLICA_CONNECTION_ERRORS = (
+    OSError, asyncio.TimeoutError, asyncpg.PostgresConnectionError,
+    asyncpg.ConnectionDoesNotExistError)
+
+# How long site sessions are valid for.
+SITE_SESSION_EXPIRY = datetime.timedelta(weeks=1)
+
+# Maximum number of expired site sessions to delete per transaction.
+SITE_SESSION_EXPIRY_BATCH_SIZE = 1000
+
+REPLICA_LAG_QUERY = """\
+SELECT CASE
+  WHEN NOT pg_is_in_recovery() THEN 0
+  WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+  ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+
+
+async def init_connection(conn: asyncpg.Connection) -> None:
+    """Prepare a new connection for use.
+
+    This is called once for every physical connection in the pool, rather
+    than every time a connection is acquired.
+    """
+    await conn.set_type_codec(
+                'json',
+                encoder=json.dumps,
+                decoder=json.loads,
+                schema='pg_catalog'
+            )
+    await conn.set_type_codec(
+                'jsonb',
+                encoder=json.dumps,
+                decoder=json.loads,
+                schema='pg_catalog'
+            )
+    await conn.set_type_codec(
+        'debversion', format='text', encoder=str, decoder=Version)
 
 
 class Database(object):
 
-    def __init__(self, url):
+    def __init__(self, url, min_size=10, max_size=10,
+                 statement_cache_size=STATEMENT_CACHE_SIZE,
+                 slow_query_threshold=None, replica_url=None,
+                 max_replica_lag=DEFAULT_MAX_REPLICA_LAG):
+        """Create a new database.
+
+        Args:
+          url: PostgreSQL URL to connect to
+          min_size: Number of connections to open when creating the pool
+          max_size: Maximum number of connections in the pool
+          statement_cache_size: Size of the per-connection statement cache
+          slow_query_threshold: Log queries that take longer than this
+            number of seconds, along with their query plan (None to disable)
+          replica_url: PostgreSQL URL of a read replica, used by
+            acquire_readonly (None to always use the primary)
+          max_replica_lag: Maximum replication lag (in seconds) for the
+            replica to be used
+        """
         self.url = url
         self.pool = None
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_cache_size = statement_cache_size
+        self.slow_query_threshold = slow_query_threshold
+        self._last_explained: Dict[str, float] = {}
+        self.replica_url = replica_url
+        self.replica_pool = None
+        self.max_replica_lag = max_replica_lag
+        self._replica_lag: Optional[float] = None
+        self._replica_lag_checked = 0.0
+
+    @property
+    def primary(self) -> 'Database':
+        return self
+
+    def readonly(self) -> 'ReadOnlyDatabase':
+        """Return a view of this database for read-only queries."""
+        return ReadOnlyDatabase(self)
+
+    async def _init_connection(self, conn):
+        await init_connection(conn)
+        if self.slow_query_threshold is not None:
+            # Query loggers are only available in asyncpg >= 0.29.
+            if hasattr(conn, 'add_query_logger'):
+                conn.add_query_logger(self._log_query)
+
+    def _log_query(self, record):
+        if record.elapsed < self.slow_query_threshold:
+            return
+        verb = record.query.lstrip()[:7].upper()
+        if verb.startswith('EXPLAIN'):
+            return
+        name = _current_query.get()
+        slow_query_count.labels(SERVICE_NAME, name).inc()
+        fingerprint = hashlib.sha1(
+            repr(record.args).encode('utf-8')).hexdigest()[:12]
+        warning('Slow query in %s (%.3fs, args %s): %s',
+                name, record.elapsed, fingerprint,
+                ' '.join(record.query.split()))
+        # Only explain queries issued by one of the database functions;
+        # this excludes e.g. the queries asyncpg issues itself.
+        if name == 'unknown' or not verb.startswith(
+                ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')):
+            return
+        if ';' in record.query.strip().rstrip(';'):
+            return
+        now = time.monotonic()
+        if (now - self._last_explained.get(record.query, 0) <
+                SLOW_QUERY_EXPLAIN_INTERVAL):
+            return
+        self._last_explained[record.query] = now
+        asyncio.ensure_future(
+            self._explain_query(name, fingerprint, record.query, record.args))
+
+    async def _explain_query(self, name, fingerprint, query, args):
+        # This task inherited the context of the slow query; don't attribute
+        # the queries made here to it.
+        _current_query.set('unknown')
+        try:
+            async with self.pool.acquire() as conn:
+                plan = await conn.fetch('EXPLAIN ' + query, *args)
+        except asyncpg.PostgresError as e:
+            warning('Unable to explain slow query in %s: %s', name, e)
+        else:
+            note('Query plan for %s (args %s):\n%s', name, fingerprint,
+                 '\n'.join(row[0] for row in plan))
+
+    async def _create_pool(self, url):
+        return await asyncpg.create_pool(
+            url, min_size=self.min_size, max_size=self.max_size,
+            init=self._init_connection,
+            statement_cache_size=self.statement_cache_size,
+            max_cached_statement_lifetime=MAX_CACHED_STATEMENT_LIFETIME)
+
+    async def _get_pool(self):
+        if self.pool is None:
+            pool = await self._create_pool(self.url)
+            # Another task may have created a pool while we were waiting.
+            if self.pool is None:
+                self.pool = pool
+            else:
+                await pool.close()
+        return self.pool
+
+    async def _get_replica_pool(self):
+        if self.replica_pool is None:
+            pool = await self._create_pool(self.replica_url)
+            if self.replica_pool is None:
+                self.replica_pool = pool
+            else:
+                await pool.close()
+        return self.replica_pool
+
+    async def _check_replica(self) -> Optional[asyncpg.pool.Pool]:
+        """Return the replica pool, if the replica is fresh enough."""
+        now = time.monotonic()
+        if now - self._replica_lag_checked >= REPLICA_LAG_CHECK_INTERVAL:
+            # Set this first, so concurrent callers don't all check.
+            self._replica_lag_checked = now
+            try:
+                pool = await self._get_replica_pool()
+                async with pool.acquire() as conn:
+                    lag = await conn.fetchval(REPLICA_LAG_QUERY)
+            except REPLICA_CONNECTION_ERRORS + (asyncpg.PostgresError, ) as e:
+                warning('Unable to check replica, using primary: %s', e)
+                self._replica_lag = None
+            else:
+                self._replica_lag = float(lag) if lag is not None else None
+                replica_lag.labels(SERVICE_NAME).set(
+                    self._replica_lag
+                    if self._replica_lag is not None else float('inf'))
+        if (self._replica_lag is None or
+                self._replica_lag > self.max_replica_lag):
+            return None
+        return self.replica_pool
+
+    def _replica_failed(self, e: Exception) -> None:
+        """Stop using the replica until the next successful check."""
+        if self._replica_lag is not None:
+            warning('Lost connection to replica, using primary: %s', e)
+        self._replica_lag = None
+        self._replica_lag_checked = time.monotonic()
+
+    async def warm_up(self):
+        """Create the pool and open its initial connections.
+
+        Services call this on startup, so that the first requests don't pay
+        for connection setup.
+        """
+        await self._get_pool()
+        if self.replica_url is not None:
+            await self._check_replica()
+
+    @asynccontextmanager
+    async def _acquire_from(self, pool, name):
+        start = time.perf_counter()
+        async with pool.acquire() as conn:
+            pool_wait_duration.labels(SERVICE_NAME, name).observe(
+                time.perf_counter() - start)
+            in_use = connections_in_use.labels(SERVICE_NAME, name)
+            in_use.inc()
+            try:
+                yield conn
+            finally:
+                in_use.dec()
 
     @asynccontextmanager
     async def acquire(self):
-        if self.pool is None:
-            self.pool = await asyncpg.create_pool(self.url)
-        async with self.pool.acquire() as conn:
-            await conn.set_type_codec(
-                        'json',
-                        encoder=json.dumps,
-                        decoder=json.loads,
-                        schema='pg_catalog'
-                    )
-            await conn.set_type_codec(
-                        'jsonb',
-                        encoder=json.dumps,
-                        decoder=json.loads,
-                        schema='pg_catalog'
-                    )
-            await conn.set_type_codec(
-                'debversion', format='text', encoder=str, decoder=Version)
+        pool = await self._get_pool()
+        async with self._acquire_from(pool, 'primary') as conn:
             yield conn
 
+    @asynccontextmanager
+    async def acquire_readonly(self):
+        """Acquire a connection for read-only queries.
+
+        This uses the replica if one is configured and its replication lag
+        is within bounds, and the primary otherwise. Callers should be
+        prepared to see slightly stale data.
+
+        If the replica can't be reached, this falls back to the primary and
+        stops using the replica until it has been checked again.
+        """
+        pool = None
+        if self.replica_url is not None:
+            pool = await self._check_replica()
+        async with AsyncExitStack() as stack:
+            conn = None
+            if pool is not None:
+                try:
+                    conn = await stack.enter_async_context(
+                        self._acquire_from(pool, 'replica'))
+                except REPLICA_CONNECTION_ERRORS as e:
+                    self._replica_failed(e)
+            if conn is None:
+                conn = await stack.enter_async_context(self.acquire())
+                yield conn
+            else:
+                try:
+                    yield conn
+                except REPLICA_CONNECTION_ERRORS as e:
+                    # It's too late to retry on the primary, but at least
+                    # don't send any further queries to the replica.
+                    self._replica_failed(e)
+                    raise
+
+
+class ReadOnlyDatabase(object):
+    """View of a Database that prefers the read replica.
+
+    The primary is still available as the 'primary' attribute, for the
+    (few) queries that write or need up-to-date data.
+    """
+
+    def __init__(self, primary: Database):
+        self.primary = primary
+
+    def acquire(self):
+        return self.primary.acquire_readonly()
+
+    def readonly(self) -> 'ReadOnlyDatabase':
+        return self
+
+    async def warm_up(self):
+        await self.primary.warm_up()
+
+
+def _instrument_coroutine_function(name, fn):
+    histogram = query_duration.labels(SERVICE_NAME, name)
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        token = _current_query.set(name)
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+            _current_query.reset(token)
+    return wrapper
+
+
+def _instrument_asyncgen_function(name, fn):
+    histogram = query_duration.labels(SERVICE_NAME, name)
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        # Only count the time spent in the generator itself, not the time
+        # the caller spends processing the items.
+        elapsed = 0.0
+        gen = fn(*args, **kwargs)
+        try:
+            while True:
+                token = _current_query.set(name)
+                start = time.perf_counter()
+                try:
+                    item = await gen.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - start
+                    _current_query.reset(token)
+                yield item
+        finally:
+            await gen.aclose()
+            histogram.observe(elapsed)
+    return wrapper
+
+
+def instrument_queries(module) -> None:
+    """Record metrics for all database functions in a module.
+
+    This wraps every coroutine (or async generator) function defined in
+    the module that takes a connection as its first argument.
+
+    Args:
+      module: Module to instrument
+    """
+    for name, fn in list(vars(module).items()):
+        if getattr(fn, '__module__', None) != module.__name__:
+            continue
+        if not (inspect.iscoroutinefunction(fn) or
+                inspect.isasyncgenfunction(fn)):
+            continue
+        params = list(inspect.signature(fn).parameters)
+        if not params or params[0] != 'conn':
+            continue
+        query_name = '%s.%s' % (module.__name__.split('.', 1)[-1], name)
+        if inspect.isasyncgenfunction(fn):
+            wrapper = _instrument_asyncgen_function(query_name, fn)
+        else:
+            wrapper = _instrument_coroutine_function(query_name, fn)
+        setattr(module, name, wrapper)
+
 
 async def store_run(
         conn: asyncpg.Connection,
@@ -145,6 +518,18 @@ async def store_run(
                         r.decode('utf-8'))
                     for (role, remote_name, br, r) in result_branches])
 
+        if subworker_result and result_code == 'success':
+            await _store_lintian_fixes(conn, run_id)
+
+
+async def _store_lintian_fixes(conn: asyncpg.Connection, run_id: str) -> None:
+    await conn.execute(
+        'INSERT INTO run_lintian_fix (run_id, package, tag) '
+        'SELECT id, package, '
+        'jsonb_array_elements_text(result_fixed_lintian_tags) '
+        'FROM run WHERE ' + run_id_condition(1) + ' '
+        'ON CONFLICT DO NOTHING', run_id)
+
 
 async def store_publish(conn: asyncpg.Connection,
                         package, branch_name, main_branch_revision,
@@ -178,6 +563,138 @@ class Codebase(object):
     branch_url: str
 
 
+def _decode_result(result):
+    if isinstance(result, str):
+        return json.loads(result)
+    return result
+
+
+def _decode_result_branches(result_branches):
+    if result_branches is None:
+        return None
+    return [
+        (role, name, br.encode('utf-8') if br else None,
+         r.encode('utf-8') if r else None)
+        for (role, name, br, r) in result_branches]
+
+
+def _decode_result_tags(result_tags):
+    if result_tags is None:
+        return None
+    return [(name, r.encode('utf-8')) for (name, r) in result_tags]
+
+
+# SQL expressions to retrieve each of the fields of a Run, in the order
+# expected by Run.from_row. JSON is retrieved as text, and only decoded when
+# it is first accessed.
+RUN_FIELD_COLUMNS: Dict[str, List[str]] = {
+    'id': ['id'],
+    'command': ['command'],
+    'times': ['start_time', 'finish_time'],
+    'description': ['description'],
+    'package': ['package'],
+    'build_version': ['build_version'],
+    'build_distribution': ['build_distribution'],
+    'result_code': ['result_code'],
+    'branch_name': ['branch_name'],
+    'main_branch_revision': ['main_branch_revision'],
+    'revision': ['revision'],
+    'context': ['context'],
+    'result': ['result::text'],
+    'suite': ['suite'],
+    'instigated_context': ['instigated_context'],
+    'branch_url': ['branch_url'],
+    'logfilenames': ['logfilenames'],
+    'review_status': ['review_status'],
+    'review_comment': ['review_comment'],
+    'worker_name': ['worker'],
+    'result_branches': [
+        'array(SELECT row(role, remote_name, base_revision, revision) '
+        'FROM new_result_branch WHERE run_id = id)'],
+    'result_tags': ['result_tags'],
+}
+
+
+def run_columns(fields: Optional[List[str]] = None) -> str:
+    """Return the SQL select list for (a subset of) the fields of a Run.
+
+    Args:
+      fields: Names of the Run fields to retrieve (None for all)
+    Returns:
+      SQL fragment
+    """
+    if fields is None:
+        fields = list(RUN_FIELD_COLUMNS)
+    try:
+        return ', '.join(
+            column for field in fields for column in RUN_FIELD_COLUMNS[field])
+    except KeyError as e:
+        raise ValueError('unknown run field %s' % e.args[0])
+
+
+def run_id_condition(argno: int) -> str:
+    """Return a SQL condition that matches the run with a particular id.
+
+    The start time is looked up in run_key, so that PostgreSQL only has to
+    look at the partition of run that contains the run.
+
+    Args:
+      argno: Number of the query argument with the run id
+    Returns:
+      SQL fragment
+    """
+    return (
+        "id = $%d AND start_time = "
+        "(SELECT start_time FROM run_key WHERE id = $%d)" % (argno, argno))
+
+
+def _run_from_row(fields: Optional[List[str]], row) -> 'Run':
+    if fields is None:
+        return Run.from_row(row)
+    return Run.from_partial_row(fields, row)
+
+
+def encode_cursor(key: List[Any]) -> str:
+    """Encode a pagination cursor.
+
+    Args:
+      key: Sort key of the last item on a page
+    Returns:
+      opaque string, suitable for use in URLs
+    """
+    return base64.urlsafe_b64encode(
+        json.dumps(key).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    """Decode a pagination cursor created by encode_cursor.
+
+    Raises:
+      ValueError: if the cursor is invalid
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError('invalid cursor: %s' % e)
+    if not isinstance(key, list):
+        raise ValueError('invalid cursor')
+    return key
+
+
+def run_cursor(run: 'Run') -> str:
+    """Return a cursor for the runs following a run, newest first."""
+    return encode_cursor([run.times[0].isoformat(), run.id])
+
+
+def _decode_run_cursor(cursor: str) -> Tuple[datetime.datetime, str]:
+    try:
+        (start_time, run_id) = decode_cursor(cursor)
+        return datetime.datetime.fromisoformat(start_time), str(run_id)
+    except TypeError:
+        raise ValueError('invalid cursor')
+
+
 class Run(object):
 
     id: str
@@ -192,7 +709,6 @@ class Run(object):
     main_branch_revision: Optional[bytes]
     revision: Optional[bytes]
     context: Optional[str]
-    result: Optional[Any]
     suite: str
     instigated_context: Optional[str]
     branch_url: str
@@ -200,10 +716,9 @@ class Run(object):
     review_status: str
     review_comment: Optional[str]
     worker_name: Optional[str]
-    result_branches: Optional[List[Tuple[str, str, bytes, bytes]]]
-    result_tags: Optional[List[Tuple[str, bytes]]]
 
-    __slots__ = [
+    # Public fields, in the order used for indexing.
+    fields = [
             'id', 'times', 'command', 'description', 'package',
             'build_version',
             'build_distribution', 'result_code', 'branch_name',
@@ -212,6 +727,18 @@ class Run(object):
             'review_status', 'review_comment', 'worker_name',
             'result_branches', 'result_tags']
 
+    # The result, result_branches and result_tags fields are decoded on
+    # first access; the *_raw slots hold their undecoded values until then.
+    __slots__ = [
+            'id', 'times', 'command', 'description', 'package',
+            'build_version',
+            'build_distribution', 'result_code', 'branch_name',
+            'main_branch_revision', 'revision', 'context',
+            'suite', 'instigated_context', 'branch_url', 'logfilenames',
+            'review_status', 'review_comment', 'worker_name',
+            '_result', '_result_raw', '_result_branches',
+            '_result_branches_raw', '_result_tags', '_result_tags_raw']
+
     def __init__(self, run_id, times, command, description, package,
                  build_version,
                  build_distribution, result_code, branch_name,
@@ -231,7 +758,6 @@ class Run(object):
         self.main_branch_revision = main_branch_revision
         self.revision = revision
         self.context = context
-        self.result = result
         self.suite = suite
         self.instigated_context = instigated_context
         self.branch_url = branch_url
@@ -239,18 +765,37 @@ class Run(object):
         self.review_status = review_status
         self.review_comment = review_comment
         self.worker_name = worker_name
-        if result_branches is None:
-            self.result_branches = None
-        else:
-            self.result_branches = [
-                (role, name, br.encode('utf-8') if br else None,
-                 r.encode('utf-8') if r else None)
-                for (role, name, br, r) in result_branches]
-        if result_tags is None:
-            self.result_tags = result_tags
-        else:
-            self.result_tags = [
-                (name, r.encode('utf-8')) for (name, r) in result_tags]
+        self._result_raw = result
+        self._result_branches_raw = result_branches
+        self._result_tags_raw = result_tags
+
+    def _decode(self, name, decode):
+        try:
+            return getattr(self, '_' + name)
+        except AttributeError:
+            pass
+        try:
+            raw = getattr(self, '_%s_raw' % name)
+        except AttributeError:
+            # The field was not retrieved at all.
+            raise AttributeError(name)
+        value = decode(raw)
+        setattr(self, '_' + name, value)
+        delattr(self, '_%s_raw' % name)
+        return value
+
+    @property
+    def result(self) -> Optional[Any]:
+        return self._decode('result', _decode_result)
+
+    @property
+    def result_branches(self) -> Optional[
+            List[Tuple[str, str, bytes, bytes]]]:
+        return self._decode('result_branches', _decode_result_branches)
+
+    @property
+    def result_tags(self) -> Optional[List[Tuple[str, bytes]]]:
+        return self._decode('result_tags', _decode_result_tags)
 
     @property
     def duration(self) -> datetime.timedelta:
@@ -287,8 +832,37 @@ class Run(object):
                    review_comment=row[19], worker_name=row[20],
                    result_branches=row[21], result_tags=row[22])
 
+    @classmethod
+    def from_partial_row(cls, fields: List[str], row) -> 'Run':
+        """Create a Run with only some of its fields set.
+
+        Accessing any of the other fields raises AttributeError.
+
+        Args:
+          fields: Names of the fields, as passed to run_columns
+          row: Row with the columns returned by run_columns(fields)
+        """
+        self = cls.__new__(cls)
+        i = 0
+        for field in fields:
+            if field == 'times':
+                self.times = (row[i], row[i + 1])
+                i += 2
+                continue
+            value = row[i]
+            i += 1
+            if field in ('result', 'result_branches', 'result_tags'):
+                setattr(self, '_%s_raw' % field, value)
+                continue
+            if field in ('main_branch_revision', 'revision'):
+                value = value.encode('utf-8') if value else None
+            elif field == 'build_version':
+                value = Version(value) if value else None
+            setattr(self, field, value)
+        return self
+
     def __len__(self) -> int:
-        return len(self.__slots__)
+        return len(self.fields)
 
     def __tuple__(self):
         return (self.id, self.times, self.command, self.description,
@@ -315,7 +889,7 @@ class Run(object):
     def __getitem__(self, i):
         if isinstance(i, slice):
             return tuple(self).__getitem__(i)
-        return getattr(self, self.__slots__[i])
+        return getattr(self, self.fields[i])
 
 
 async def get_unchanged_run(conn: asyncpg.Connection, package,
@@ -350,11 +924,14 @@ async def iter_runs(db: Database,
                     package: Optional[str] = None,
                     run_id: Optional[str] = None,
                     worker: Optional[str] = None,
-                    limit: Optional[int] = None):
+                    limit: Optional[int] = None,
+                    fields: Optional[List[str]] = None,
+                    since: Optional[datetime.datetime] = None,
+                    after: Optional[str] = None):
     async with db.acquire() as conn:
         async for run in _iter_runs(
                 conn, package=package, run_id=run_id, worker=worker,
-                limit=limit):
+                limit=limit, fields=fields, since=since, after=after):
             yield run
 
 
@@ -363,27 +940,26 @@ async def _iter_runs(conn: asyncpg.Connection,
                      run_id: Optional[str] = None,
                      worker: Optional[str] = None,
                      suite: Optional[str] = None,
-                     limit: Optional[int] = None):
-    """Iterate over runs.
+                     limit: Optional[int] = None,
+                     fields: Optional[List[str]] = None,
+                     since: Optional[datetime.datetime] = None,
+                     after: Optional[str] = None):
+    """Iterate over runs, newest first.
 
     Args:
       package: package to restrict to
+      fields: Run fields to retrieve (None for all); see Run.from_partial_row
+      since: Only include runs started after this time. This allows
+        PostgreSQL to skip the partitions with older runs.
+      after: Cursor (see run_cursor) of the last run on the previous page
+    Raises:
+      ValueError: if the cursor is invalid
     Returns:
       iterator over Run objects
     """
     query = """
-SELECT
-    id, command, start_time, finish_time, description, package,
-    build_version, build_distribution, result_code,
-    branch_name, main_branch_revision, revision, context, result, suite,
-    instigated_context, branch_url, logfilenames, review_status,
-    review_comment, worker,
-    array(SELECT row(role, remote_name, base_revision,
-     revision) FROM new_result_branch WHERE run_id = id),
-    result_tags
-FROM
-    run
-"""
+SELECT %s FROM run
+""" % run_columns(fields)
     conditions = []
     args = []
     if package is not None:
@@ -391,20 +967,27 @@ FROM
         conditions.append("package = $%d" % len(args))
     if run_id is not None:
         args.append(run_id)
-        conditions.append("id = $%d" % len(args))
+        conditions.append(run_id_condition(len(args)))
     if worker is not None:
         args.append(worker)
         conditions.append("worker = $%d" % len(args))
     if suite is not None:
         args.append(suite)
         conditions.append("suite = $%d" % len(args))
+    if since is not None:
+        args.append(since)
+        conditions.append("start_time >= $%d" % len(args))
+    if after is not None:
+        args.extend(_decode_run_cursor(after))
+        conditions.append(
+            "(start_time, id) < ($%d, $%d)" % (len(args) - 1, len(args)))
     if conditions:
         query += " WHERE " + " AND ".join(conditions)
-    query += "ORDER BY start_time DESC"
+    query += " ORDER BY start_time DESC, id DESC"
     if limit:
         query += " LIMIT %d" % limit
     for row in await conn.fetch(query, *args):
-        yield Run.from_row(row)
+        yield _run_from_row(fields, row)
 
 
 async def get_run(conn: asyncpg.Connection, run_id, package=None):
@@ -414,6 +997,30 @@ async def get_run(conn: asyncpg.Connection, run_id, package=None):
         return None
 
 
+async def iter_archived_run_summaries(
+        conn: asyncpg.Connection, package: str) -> List[asyncpg.Record]:
+    """Retrieve summaries of the runs for a package that have been archived.
+
+    Args:
+      package: Package name
+    Returns:
+      list of records with suite, run_count, success_count, first_start_time,
+      last_start_time and last_result_code
+    """
+    return await conn.fetch("""
+SELECT
+  suite, sum(run_count) AS run_count, sum(success_count) AS success_count,
+  min(first_start_time) AS first_start_time,
+  max(last_start_time) AS last_start_time,
+  (array_agg(last_result_code ORDER BY last_start_time DESC))[1]
+    AS last_result_code
+FROM archived_run_summary
+WHERE package = $1
+GROUP BY suite
+ORDER BY suite
+""", package)
+
+
 async def iter_proposals(conn: asyncpg.Connection, package=None, suite=None):
     args = []
     query = """
@@ -508,12 +1115,15 @@ class QueueItem(object):
 
     __slots__ = ['id', 'branch_url', 'subpath', 'package', 'context',
                  'command', 'estimated_duration', 'suite', 'refresh',
-                 'requestor', 'vcs_type', 'upstream_branch_url']
+                 'requestor', 'vcs_type', 'upstream_branch_url', 'bucket',
+                 'priority']
 
     def __init__(self, id, branch_url, subpath, package, context, command,
                  estimated_duration, suite, refresh, requestor, vcs_type,
-                 upstream_branch_url):
+                 upstream_branch_url, bucket=None, priority=None):
         self.id = id
+        self.bucket = bucket
+        self.priority = priority
         self.package = package
         self.branch_url = branch_url
         self.subpath = subpath
@@ -531,14 +1141,15 @@ class QueueItem(object):
         (branch_url, subpath, package,
             command, context, queue_id, estimated_duration,
             suite, refresh, requestor, vcs_type,
-            upstream_branch_url) = row
+            upstream_branch_url, bucket, priority) = row
         return cls(
                 id=queue_id, branch_url=branch_url,
                 subpath=subpath, package=package, context=context,
                 command=shlex.split(command),
                 estimated_duration=estimated_duration,
                 suite=suite, refresh=refresh, requestor=requestor,
-                vcs_type=vcs_type, upstream_branch_url=upstream_branch_url)
+                vcs_type=vcs_type, upstream_branch_url=upstream_branch_url,
+                bucket=bucket, priority=priority)
 
     def _tuple(self):
         return (self.id, self.branch_url, self.subpath, self.package,
@@ -566,14 +1177,85 @@ async def get_queue_position(conn: asyncpg.Connection, suite, package):
 
 
 async def get_queue_positions(conn: asyncpg.Connection, suite, packages):
+    """Get the positions of packages in the queue.
 
-    query = (
-        "SELECT package, position, wait_time FROM queue_positions "
-        "WHERE package = ANY($1::text[]) AND suite = $2")
+    Items never move relative to each other in the queue, so rather than
+    numbering the whole queue (like the queue_positions view), this only
+    scans the (bucket, priority, id) index up to the last of the requested
+    items.
+
+    Args:
+      conn: Database connection
+      suite: Suite name
+      packages: Package names
+    Returns:
+      list of package, position and estimated wait time tuples for the
+      packages that are in the queue
+    """
+    query = """
+WITH last_item AS (
+  SELECT bucket, priority, id FROM queue
+  WHERE package = ANY($1::text[]) AND suite = $2
+  ORDER BY bucket DESC, priority DESC, id DESC LIMIT 1
+), ahead AS (
+  SELECT
+    package, suite,
+    row_number() OVER w AS position,
+    SUM(estimated_duration) OVER w
+      - coalesce(estimated_duration, interval '0') AS wait_time
+  FROM queue
+  WHERE (bucket, priority, id) <= (SELECT bucket, priority, id FROM last_item)
+  WINDOW w AS (ORDER BY bucket ASC, priority ASC, id ASC)
+)
+SELECT package, position, wait_time FROM ahead
+WHERE package = ANY($1::text[]) AND suite = $2
+"""
     return await conn.fetch(query, packages, suite)
 
 
-async def iter_queue(conn: asyncpg.Connection, limit=None):
+# Values of the queue_bucket enum in state.sql.
+QUEUE_BUCKETS = (
+    'update-existing-mp', 'webhook', 'manual', 'reschedule', 'control',
+    'update-new-mp', 'default')
+
+
+def queue_cursor(bucket: str, priority: int, queue_id: int) -> str:
+    """Return a cursor for the queue items following a queue item."""
+    return encode_cursor([bucket, priority, queue_id])
+
+
+def queue_cursor_condition(cursor: str, args: List[Any]) -> str:
+    """Return a SQL condition for the queue items following a cursor.
+
+    Args:
+      cursor: Cursor created by queue_cursor
+      args: Query arguments; the cursor values are appended
+    Raises:
+      ValueError: if the cursor is invalid
+    """
+    try:
+        (bucket, priority, queue_id) = decode_cursor(cursor)
+        priority = int(priority)
+        queue_id = int(queue_id)
+    except (TypeError, OverflowError):
+        raise ValueError('invalid cursor')
+    # Anything that doesn't fit the column types would make the query fail
+    # rather than the request.
+    if bucket not in QUEUE_BUCKETS:
+        raise ValueError('invalid cursor: unknown bucket %r' % bucket)
+    if not -2 ** 63 <= priority < 2 ** 63:
+        raise ValueError('invalid cursor: priority out of range')
+    if not -2 ** 31 <= queue_id < 2 ** 31:
+        raise ValueError('invalid cursor: id out of range')
+    args.extend([bucket, priority, queue_id])
+    return (
+        "(queue.bucket, queue.priority, queue.id) > "
+        "($%d::queue_bucket, $%d, $%d)" % (
+            len(args) - 2, len(args) - 1, len(args)))
+
+
+async def iter_queue(conn: asyncpg.Connection, limit=None, package=None,
+                     after=None):
     query = """
 SELECT
     package.branch_url,
@@ -587,11 +1269,24 @@ SELECT
     queue.refresh,
     queue.requestor,
     package.vcs_type,
-    upstream.upstream_branch_url
+    upstream.upstream_branch_url,
+    queue.bucket,
+    queue.priority
 FROM
     queue
 LEFT JOIN package ON package.name = queue.package
 LEFT OUTER JOIN upstream ON upstream.name = package.name
+"""
+    args: List[Any] = []
+    conditions = []
+    if package is not None:
+        args.append(package)
+        conditions.append("queue.package = $%d" % len(args))
+    if after is not None:
+        conditions.append(queue_cursor_condition(after, args))
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += """
 ORDER BY
 queue.bucket ASC,
 queue.priority ASC,
@@ -599,7 +1294,7 @@ queue.id ASC
 """
     if limit:
         query += " LIMIT %d" % limit
-    for row in await conn.fetch(query):
+    for row in await conn.fetch(query, *args):
         yield QueueItem.from_row(row)
 
 
@@ -695,40 +1390,17 @@ order by package.name, debian_build.version desc
 
 async def iter_previous_runs(
         conn: asyncpg.Connection,
-        package: str, suite: str) -> AsyncIterable[Run]:
+        package: str, suite: str,
+        fields: Optional[List[str]] = None) -> AsyncIterable[Run]:
     for row in await conn.fetch("""
-SELECT
-  id,
-  command,
-  start_time,
-  finish_time,
-  description,
-  package,
-  build_version,
-  build_distribution,
-  result_code,
-  branch_name,
-  main_branch_revision,
-  revision,
-  context,
-  result,
-  suite,
-  instigated_context,
-  branch_url,
-  logfilenames,
-  review_status,
-  review_comment,
-  worker,
-  array(SELECT row(role, remote_name, base_revision,
-   revision) FROM new_result_branch WHERE run_id = id),
-  result_tags
+SELECT %s
 FROM
   run
 WHERE
   package = $1 AND suite = $2
 ORDER BY start_time DESC
-""", package, suite):
-        yield Run.from_row(row)
+""" % run_columns(fields), package, suite):
+        yield _run_from_row(fields, row)
 
 
 async def get_last_unabsorbed_run(
@@ -842,36 +1514,27 @@ async def iter_last_runs(
         conn: asyncpg.Connection,
         result_code: Optional[str] = None,
         suite: Optional[str] = None,
-        main_branch_revision: Optional[bytes] = None
+        main_branch_revision: Optional[bytes] = None,
+        fields: Optional[List[str]] = None,
+        limit: Optional[int] = None,
+        after: Optional[str] = None
         ) -> AsyncIterable[Run]:
+    """Iterate over the last run for each package/suite, newest first.
+
+    Args:
+      result_code: Only include runs with this result code
+      suite: Only include runs for this suite
+      main_branch_revision: Only include runs for this main branch revision
+      fields: Run fields to retrieve (None for all); see Run.from_partial_row
+      limit: Maximum number of runs to return
+      after: Cursor (see run_cursor) of the last run on the previous page
+    Raises:
+      ValueError: if the cursor is invalid
+    """
     query = """
-SELECT
-  id,
-  command,
-  start_time,
-  finish_time,
-  description,
-  package,
-  build_version,
-  build_distribution,
-  result_code,
-  branch_name,
-  main_branch_revision,
-  revision,
-  context,
-  result,
-  suite,
-  instigated_context,
-  branch_url,
-  logfilenames,
-  review_status,
-  review_comment,
-  worker,
-  array(SELECT row(role, remote_name, base_revision,
-   revision) FROM new_result_branch WHERE run_id = id),
-  result_tags
+SELECT %s
 FROM last_runs
-"""
+""" % run_columns(fields)
     where = []
     args: List[Any] = []
     if result_code is not None:
@@ -883,20 +1546,33 @@ FROM last_runs
     if main_branch_revision:
         args.append(main_branch_revision)
         where.append("main_branch_revision = $%d" % len(args))
+    if after is not None:
+        args.extend(_decode_run_cursor(after))
+        where.append(
+            "(start_time, id) < ($%d, $%d)" % (len(args) - 1, len(args)))
     if where:
         query += " WHERE " + " AND ".join(where)
-    query += " ORDER BY start_time DESC"
+    query += " ORDER BY start_time DESC, id DESC"
+    if limit:
+        query += " LIMIT %d" % limit
     async with conn.transaction():
         async for row in conn.cursor(query, *args):
-            yield Run.from_row(row)
+            yield _run_from_row(fields, row)
 
 
 async def update_run_result(
         conn: asyncpg.Connection, log_id: str, code: str, description: str
         ) -> None:
-    await conn.execute(
-        'UPDATE run SET result_code = $1, description = $2 WHERE id = $3',
-        code, description, log_id)
+    async with conn.transaction():
+        await conn.execute(
+            'UPDATE run SET result_code = $1, description = $2 WHERE '
+            + run_id_condition(3), code, description, log_id)
+        # run_lintian_fix only lists the fixes of successful runs.
+        if code == 'success':
+            await _store_lintian_fixes(conn, log_id)
+        else:
+            await conn.execute(
+                'DELETE FROM run_lintian_fix WHERE run_id = $1', log_id)
 
 
 async def already_published(
@@ -1208,8 +1884,8 @@ async def set_run_review_status(
         conn: asyncpg.Connection, run_id: str,
         review_status: str, review_comment: Optional[str] = None) -> None:
     await conn.execute(
-        'UPDATE run SET review_status = $1, review_comment = $2 WHERE id = $3',
-        review_status, review_comment, run_id)
+        'UPDATE run SET review_status = $1, review_comment = $2 WHERE '
+        + run_id_condition(3), review_status, review_comment, run_id)
 
 
 async def iter_review_status(conn: asyncpg.Connection):
@@ -1321,6 +1997,10 @@ async def get_publish_attempt_count(
         revision.decode('utf-8'), transient_result_codes)
 
 
+# Channel that is notified when the worker table changes.
+WORKER_CHANGE_CHANNEL = 'worker_change'
+
+
 async def check_worker_credentials(
         conn: asyncpg.Connection, login: str, password: str) -> bool:
     row = await conn.fetchrow(
@@ -1353,8 +2033,55 @@ ON CONFLICT (id) DO UPDATE SET userinfo = EXCLUDED.userinfo""",
 
 
 async def get_site_session(conn: asyncpg.Connection, session_id: str) -> Any:
+    # Expired sessions are only deleted periodically, see
+    # expire_site_sessions.
     return await conn.fetchrow(
-        "SELECT userinfo FROM site_session WHERE id = $1", session_id)
+        "SELECT userinfo FROM site_session "
+        "WHERE id = $1 AND timestamp >= NOW() - $2::interval",
+        session_id, SITE_SESSION_EXPIRY)
+
+
+async def expire_site_sessions(
+        conn: asyncpg.Connection,
+        batch_size: int = SITE_SESSION_EXPIRY_BATCH_SIZE) -> int:
+    """Delete expired site sessions.
+
+    Sessions are deleted in small batches, so that logins don't have to wait
+    for a long-running delete.
+
+    Returns:
+      number of sessions deleted
+    """
+    total = 0
+    while True:
+        status = await conn.execute("""
+DELETE FROM site_session WHERE id IN (
+  SELECT id FROM site_session WHERE timestamp < NOW() - $1::interval
+  ORDER BY timestamp LIMIT $2)""", SITE_SESSION_EXPIRY, batch_size)
+        count = int(status.split(' ')[-1])
+        total += count
+        if count < batch_size:
+            return total
+
+
+async def get_data_versions(
+        conn: asyncpg.Connection, names: List[str]
+        ) -> Dict[str, Tuple[int, datetime.datetime]]:
+    """Get the versions of data shown on the site.
+
+    Args:
+      conn: Database connection
+      names: Names of the data, e.g. 'runs' or 'package:foo' (see the
+        data_version table)
+    Returns:
+      dictionary mapping names to version and modification time; data that
+      hasn't changed since the table was created is missing
+    """
+    return {
+        name: (version, modified)
+        for (name, version, modified) in await conn.fetch(
+            "SELECT name, version, modified FROM data_version "
+            "WHERE name = ANY($1::text[])", names)}
 
 
 async def has_cotenants(
@@ -1374,3 +2101,6 @@ async def has_cotenants(
         warning('Unable to figure out if %s has cotenants on %s',
                 package, url)
         return None
+
+
+instrument_queries(sys.modules[__name__])
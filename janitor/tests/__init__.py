@@ -26,6 +26,7 @@ from breezy.tests import TestCaseWithTransport  # noqa: F401
 def test_suite():
     names = [
         'build',
+        'build_log',
         'debdiff',
         'fix_build',
         'pull_worker',
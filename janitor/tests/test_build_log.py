@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# Copyright (C) 2021 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+from io import BytesIO
+
+from janitor.debian.build_log import summarize_build_log
+
+import unittest
+
+
+def section(title):
+    sep = b'+' + (b'-' * 78) + b'+\n'
+    return sep + b'| ' + title.ljust(76).encode() + b' |\n' + sep
+
+
+class SummarizeBuildLogTests(unittest.TestCase):
+
+    def test_build_failure(self):
+        log = (
+            section('Build') + b'\n' +
+            b''.join(b'line %d\n' % i for i in range(30)) +
+            b"make[1]: *** No rule to make target 'foo', "
+            b"needed by 'bar'.  Stop.\n" +
+            section('Summary') + b'\n' +
+            b'Fail-Stage: build\n')
+        summary = summarize_build_log(BytesIO(log), 5)
+        self.assertEqual('build', summary['failed_stage'])
+        self.assertEqual([35], summary['highlight_lines'])
+        self.assertEqual([30, 35], summary['include_lines'])
+        self.assertEqual(
+            "make[1]: *** No rule to make target 'foo', "
+            "needed by 'bar'.  Stop.\n", summary['excerpt'][-1])
+        start, end = summary['include_bytes']
+        self.assertEqual(
+            ''.join(summary['excerpt']).encode(), log[start:end])
+        self.assertEqual(
+            ['build', 'summary'],
+            [title for (title, first, last) in summary['sections']])
+
+    def test_no_sections(self):
+        log = b''.join(b'line %d\n' % i for i in range(10))
+        summary = summarize_build_log(BytesIO(log), 5)
+        self.assertIs(None, summary['failed_stage'])
+        self.assertEqual([], summary['highlight_lines'])
+        self.assertEqual(['line %d\n' % i for i in range(6, 10)],
+                         summary['excerpt'][-4:])
+        start, end = summary['include_bytes']
+        self.assertEqual(
+            ''.join(summary['excerpt']).encode(), log[start:end])
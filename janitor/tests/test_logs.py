@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# Copyright (C) 2021 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import asyncio
+import gzip
+from io import BytesIO
+
+from aiohttp import web
+from aiohttp.test_utils import AioHTTPTestCase
+
+from janitor.logs import (
+    LogFileManager,
+    gunzip_chunks,
+    iter_file_chunks,
+    )
+from janitor.site.serve import (
+    read_range,
+    stream_log,
+    )
+
+import unittest
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+class IterFileChunksTests(unittest.TestCase):
+
+    def test_chunks(self):
+        f = BytesIO(b'abcdefg')
+        chunks = asyncio.run(collect(iter_file_chunks(f, chunk_size=3)))
+        self.assertEqual([b'abc', b'def', b'g'], chunks)
+        self.assertTrue(f.closed)
+
+    def test_close_unstarted(self):
+        f = BytesIO(b'abcdefg')
+        asyncio.run(iter_file_chunks(f).aclose())
+        self.assertTrue(f.closed)
+
+    def test_close_partially_read(self):
+        f = BytesIO(b'abcdefg')
+
+        async def read_one():
+            chunks = iter_file_chunks(f, chunk_size=3)
+            self.assertEqual(b'abc', await chunks.__anext__())
+            await chunks.aclose()
+            self.assertEqual([], await collect(chunks))
+        asyncio.run(read_one())
+        self.assertTrue(f.closed)
+
+
+class GunzipChunksTests(unittest.TestCase):
+
+    def test_multiple_members(self):
+        data = gzip.compress(b'foo\n') + gzip.compress(b'bar\n')
+        chunks = asyncio.run(collect(gunzip_chunks(
+            iter_file_chunks(BytesIO(data), chunk_size=5))))
+        self.assertEqual(b'foo\nbar\n', b''.join(chunks))
+
+
+def chunked(data, chunk_size=4):
+    return iter_file_chunks(BytesIO(data), chunk_size=chunk_size)
+
+
+class ReadRangeTests(unittest.TestCase):
+
+    def read_range(self, start, stop, limit=100):
+        return asyncio.run(read_range(
+            chunked(b'0123456789abcdef'), start, stop, limit=limit))
+
+    def test_range(self):
+        self.assertEqual((3, b'3456789a', None), self.read_range(3, 11))
+
+    def test_until_end(self):
+        self.assertEqual((10, b'abcdef', 16), self.read_range(10, None))
+
+    def test_suffix(self):
+        self.assertEqual((11, b'bcdef', 16), self.read_range(-5, None))
+
+    def test_beyond_end(self):
+        self.assertEqual((20, b'', 16), self.read_range(20, None))
+
+    def test_limit(self):
+        self.assertEqual((2, b'234', None), self.read_range(2, None, limit=3))
+        self.assertEqual((13, b'def', 16), self.read_range(-5, None, limit=3))
+
+
+class FakeLogFileManager(LogFileManager):
+
+    def __init__(self, logs):
+        self.logs = logs
+
+    async def iter_log_chunks(self, pkg, run_id, name, timeout=None):
+        try:
+            data = self.logs[(pkg, run_id, name)]
+        except KeyError:
+            raise FileNotFoundError(name)
+        return 'gzip', chunked(gzip.compress(data), chunk_size=16)
+
+
+class StreamLogTests(AioHTTPTestCase):
+
+    log = b''.join(b'line %d\n' % i for i in range(100))
+
+    async def get_application(self):
+        logfile_manager = FakeLogFileManager(
+            {('foo', 'run-id', 'build.log'): self.log})
+
+        async def handle(request):
+            return await stream_log(
+                request, logfile_manager, 'foo', request.match_info['run_id'],
+                request.match_info['filename'])
+
+        app = web.Application()
+        app.router.add_get('/{run_id}/{filename}', handle)
+        return app
+
+    async def test_gzip(self):
+        resp = await self.client.get(
+            '/run-id/build.log', headers={'Accept-Encoding': 'gzip'},
+            auto_decompress=False)
+        self.assertEqual(200, resp.status)
+        self.assertEqual('gzip', resp.headers['Content-Encoding'])
+        self.assertEqual(self.log, gzip.decompress(await resp.read()))
+
+    async def test_uncompressed(self):
+        resp = await self.client.get(
+            '/run-id/build.log', headers={'Accept-Encoding': 'identity'})
+        self.assertEqual(200, resp.status)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual('bytes', resp.headers['Accept-Ranges'])
+        self.assertEqual(self.log, await resp.read())
+
+    async def test_range(self):
+        resp = await self.client.get(
+            '/run-id/build.log',
+            headers={'Range': 'bytes=100-149', 'Accept-Encoding': 'gzip'})
+        self.assertEqual(206, resp.status)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual('bytes 100-149/*', resp.headers['Content-Range'])
+        self.assertEqual(self.log[100:150], await resp.read())
+
+    async def test_suffix_range(self):
+        resp = await self.client.get(
+            '/run-id/build.log', headers={'Range': 'bytes=-8'})
+        self.assertEqual(206, resp.status)
+        self.assertEqual(
+            'bytes %d-%d/%d' % (len(self.log) - 8, len(self.log) - 1,
+                                len(self.log)),
+            resp.headers['Content-Range'])
+        self.assertEqual(self.log[-8:], await resp.read())
+
+    async def test_unsatisfiable_range(self):
+        resp = await self.client.get(
+            '/run-id/build.log', headers={'Range': 'bytes=100000-'})
+        self.assertEqual(416, resp.status)
+        self.assertEqual(
+            'bytes */%d' % len(self.log), resp.headers['Content-Range'])
+
+    async def test_missing(self):
+        resp = await self.client.get('/other-id/build.log')
+        self.assertEqual(404, resp.status)
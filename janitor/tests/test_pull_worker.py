@@ -17,15 +17,23 @@
 
 from aiohttp.multipart import MultipartReader
 
+import asyncio
 from io import BytesIO
 
 import os
 import shutil
 import tempfile
+import unittest
+from unittest import mock
 
 import asynctest
 
-from janitor.pull_worker import bundle_results
+from janitor.pull_worker import (
+    ResultUploadFailure,
+    bundle_results,
+    process_batch,
+    process_run,
+    )
 
 
 class AsyncBytesIO:
@@ -92,3 +100,105 @@ class BundleResultsTests(asynctest.TestCase):
                 b'some data\n',
                 bytes(await part.read()))
             self.assertTrue(part.at_eof())
+
+
+class ProcessBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        super(ProcessBatchTests, self).setUp()
+        self.processed = []
+        patcher = mock.patch(
+            'janitor.pull_worker.process_batch_run', self.process_batch_run)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def process_batch_run(
+            self, session, base_url, batch_assignment, *args, **kwargs):
+        self.processed.append(batch_assignment['id'])
+        if batch_assignment['id'] == 'fails':
+            raise RuntimeError('worker crashed')
+        if batch_assignment['id'] == 'upload-fails':
+            raise ResultUploadFailure('no such run')
+        return {'id': batch_assignment['id']}
+
+    def test_all_succeed(self):
+        self.assertTrue(asyncio.run(process_batch(
+            None, 'https://example.com/api/', [{'id': 'a'}, {'id': 'b'}])))
+        self.assertEqual(['a', 'b'], self.processed)
+
+    def test_failed_run(self):
+        self.assertTrue(asyncio.run(process_batch(
+            None, 'https://example.com/api/',
+            [{'id': 'a'}, {'id': 'fails'}, {'id': 'b'}])))
+        self.assertEqual(['a', 'fails', 'b'], self.processed)
+
+    def test_failed_upload(self):
+        self.assertFalse(asyncio.run(process_batch(
+            None, 'https://example.com/api/',
+            [{'id': 'upload-fails'}, {'id': 'b'}])))
+        self.assertEqual(['upload-fails', 'b'], self.processed)
+
+
+class WorkerResult(object):
+
+    description = 'Did something.'
+
+    def json(self):
+        return {'description': self.description}
+
+
+class ProcessRunTests(unittest.TestCase):
+
+    def setUp(self):
+        super(ProcessRunTests, self).setUp()
+        self.output_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_directory)
+        self.addCleanup(os.environ.update, dict(os.environ))
+        self.uploaded = []
+
+    def process_run(self, run_worker, upload_results):
+        assignment = {
+            'id': 'run-id', 'suite': 'lintian-fixes', 'resume': None,
+            'command': ['lintian-brush'], 'legacy_branch_name': 'master',
+            'build': {'environment': {}}}
+        with mock.patch('janitor.pull_worker.run_worker', run_worker), \
+                mock.patch('janitor.pull_worker.upload_results',
+                           upload_results):
+            return asyncio.run(process_run(
+                None, 'https://example.com/api/', assignment,
+                dict(os.environ), 'https://example.com/foo', '', 'git',
+                None, self.output_directory))
+
+    async def upload_results(
+            self, session, base_url, run_id, metadata, output_directory):
+        self.uploaded.append((run_id, metadata['code']))
+        return {'id': run_id}
+
+    async def failing_upload_results(
+            self, session, base_url, run_id, metadata, output_directory):
+        self.uploaded.append((run_id, metadata['code']))
+        raise ResultUploadFailure('no such run')
+
+    def test_success(self):
+        self.assertEqual(
+            {'id': 'run-id'},
+            self.process_run(
+                lambda *args, **kwargs: WorkerResult(), self.upload_results))
+        self.assertEqual([('run-id', None)], self.uploaded)
+
+    def test_upload_failure(self):
+        self.assertRaises(
+            ResultUploadFailure, self.process_run,
+            lambda *args, **kwargs: WorkerResult(),
+            self.failing_upload_results)
+        self.assertEqual([('run-id', None)], self.uploaded)
+
+    def test_upload_failure_after_exception(self):
+        def run_worker(*args, **kwargs):
+            raise RuntimeError('worker crashed')
+        # The exception from the worker is more useful than the one from
+        # the upload.
+        self.assertRaises(
+            RuntimeError, self.process_run, run_worker,
+            self.failing_upload_results)
+        self.assertEqual([('run-id', 'worker-exception')], self.uploaded)
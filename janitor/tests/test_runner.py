@@ -16,11 +16,22 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 import asyncio
+from contextlib import asynccontextmanager
+import json
 import os
+import unittest
+from unittest import mock
 
 from breezy.tests import TestCaseWithTransport
 
-from janitor.runner import run_subprocess
+from janitor.runner import (
+    ActiveRemoteRun,
+    QueueProcessor,
+    handle_assign,
+    run_subprocess,
+    )
+from janitor.state import QueueItem
+from janitor.vcs import BranchOpenFailure
 
 
 class RunSubprocessTests(TestCaseWithTransport):
@@ -36,3 +47,174 @@ class RunSubprocessTests(TestCaseWithTransport):
 
         asyncio.run(run_subprocess(
             ['cat'], {}))
+
+
+def make_queue_item(queue_id, package, suite):
+    return QueueItem(
+        id=queue_id, branch_url='https://example.com/%s' % package,
+        subpath='', package=package, context=None,
+        command=['some-command'], estimated_duration=None, suite=suite,
+        refresh=False, requestor=None, vcs_type='git',
+        upstream_branch_url=None)
+
+
+class BatchRunsTests(unittest.TestCase):
+
+    def test_batch_runs(self):
+        queue_processor = QueueProcessor(None, None, 'local', None)
+        first = ActiveRemoteRun(
+            make_queue_item(1, 'foo', 'lintian-fixes'), 'worker',
+            'lintian-fixes')
+        queue_processor.register_run(first)
+        second = ActiveRemoteRun(
+            make_queue_item(2, 'foo', 'unchanged'), 'worker', 'unchanged',
+            batch_id=first.log_id)
+        queue_processor.register_run(second)
+        other = ActiveRemoteRun(
+            make_queue_item(3, 'bar', 'unchanged'), 'worker', 'unchanged')
+        queue_processor.register_run(other)
+        self.assertEqual([second], queue_processor.batch_runs(first.log_id))
+        self.assertEqual([], queue_processor.batch_runs(other.log_id))
+        self.assertTrue(queue_processor.queue_item_assigned(
+            make_queue_item(2, 'foo', 'unchanged')))
+
+
+class FakeDatabase(object):
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield None
+
+
+class FakeVcsManager(object):
+
+    base_url = 'https://janitor.example.com/'
+
+    def get_branch_url(self, package, branch_name, vcs_type):
+        return 'https://janitor.example.com/git/%s' % package
+
+
+class FakeSuiteConfig(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.branch_name = name
+
+
+class FakeApp(object):
+
+    def __init__(self, queue_processor):
+        self.queue_processor = queue_processor
+
+
+class FakeRequest(object):
+
+    def __init__(self, app, body):
+        self.app = app
+        self._body = body
+
+    async def json(self):
+        return self._body
+
+
+async def open_canonical_main_branch(conn, item, possible_transports=None):
+    raise BranchOpenFailure('branch-unavailable', 'no such branch')
+
+
+async def suite_assignment(
+        conn, queue_processor, active_run, suite_config, main_branch,
+        vcs_type, possible_hosters=None):
+    return {'id': active_run.log_id, 'suite': suite_config.name}
+
+
+def get_suite_config(config, name):
+    if name == 'unknown':
+        raise KeyError(name)
+    return FakeSuiteConfig(name)
+
+
+class HandleAssignTests(unittest.TestCase):
+
+    def setUp(self):
+        super(HandleAssignTests, self).setUp()
+        for name, replacement in [
+                ('open_canonical_main_branch', open_canonical_main_branch),
+                ('suite_assignment', suite_assignment),
+                ('get_suite_config', get_suite_config)]:
+            patcher = mock.patch('janitor.runner.' + name, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_queue_processor(self, queue, batch_suites):
+        queue_processor = QueueProcessor(
+            FakeDatabase(), None, 'local', None,
+            public_vcs_manager=FakeVcsManager(), batch_suites=batch_suites)
+
+        async def next_queue_item(n):
+            return [item for item in queue
+                    if not queue_processor.queue_item_assigned(item)][:n]
+
+        async def next_batch_items(item):
+            return [other for other in queue
+                    if other.package == item.package and other.id != item.id]
+
+        queue_processor.next_queue_item = next_queue_item
+        queue_processor.next_batch_items = next_batch_items
+        return queue_processor
+
+    def assign(self, queue_processor):
+        async def assign():
+            try:
+                resp = await handle_assign(FakeRequest(
+                    FakeApp(queue_processor), {'worker': 'worker'}))
+            finally:
+                for active_run in queue_processor.active_runs.values():
+                    active_run.stop_watchdog()
+            self.assertEqual(201, resp.status)
+            return json.loads(resp.body)
+        return asyncio.run(assign())
+
+    def test_batch(self):
+        queue_processor = self.make_queue_processor([
+            make_queue_item(1, 'foo', 'lintian-fixes'),
+            make_queue_item(2, 'foo', 'unchanged'),
+            make_queue_item(3, 'bar', 'unchanged'),
+            make_queue_item(4, 'foo', 'unknown')], batch_suites=True)
+        assignment = self.assign(queue_processor)
+        self.assertEqual('lintian-fixes', assignment['suite'])
+        self.assertEqual(
+            ['unchanged'], [batch['suite'] for batch in assignment['batch']])
+        [batch_run] = queue_processor.batch_runs(assignment['id'])
+        self.assertEqual(assignment['batch'][0]['id'], batch_run.log_id)
+        self.assertEqual(2, batch_run.queue_item.id)
+        # The unknown suite is left in the queue, as is the other package.
+        self.assertEqual(
+            [1, 2], sorted(active_run.queue_item.id
+                           for active_run
+                           in queue_processor.active_runs.values()))
+        assignment = self.assign(queue_processor)
+        self.assertEqual(3, queue_processor.active_runs[
+            assignment['id']].queue_item.id)
+        self.assertNotIn('batch', assignment)
+
+    def test_batch_skips_assigned(self):
+        queue = [
+            make_queue_item(1, 'foo', 'lintian-fixes'),
+            make_queue_item(2, 'foo', 'unchanged')]
+        queue_processor = self.make_queue_processor(queue, batch_suites=True)
+        queue_processor.register_run(ActiveRemoteRun(
+            queue[1], 'other-worker', 'unchanged'))
+        assignment = self.assign(queue_processor)
+        self.assertEqual('lintian-fixes', assignment['suite'])
+        self.assertNotIn('batch', assignment)
+        self.assertEqual([], queue_processor.batch_runs(assignment['id']))
+
+    def test_no_batch(self):
+        queue_processor = self.make_queue_processor([
+            make_queue_item(1, 'foo', 'lintian-fixes'),
+            make_queue_item(2, 'foo', 'unchanged')], batch_suites=False)
+        assignment = self.assign(queue_processor)
+        self.assertNotIn('batch', assignment)
+        assignment = self.assign(queue_processor)
+        self.assertEqual('unchanged', assignment['suite'])
+        self.assertNotIn('batch', assignment)
@@ -15,13 +15,59 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
-from datetime import timedelta
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from io import BytesIO, StringIO
+import gc
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
 
-from janitor.site import format_duration
+from aiohttp import ClientConnectionError, ClientTimeout, web
+from aiohttp.test_utils import AioHTTPTestCase
+from yarl import URL
+
+from janitor.config import read_config
+from janitor.http_client import (
+    CircuitBreaker,
+    CircuitOpen,
+    HttpClient,
+    )
+from janitor.policy import read_policy
+from janitor.site import (
+    WorkerCredentialCache,
+    env,
+    format_duration,
+    precompile_templates,
+    setup_template_cache,
+    )
+from janitor.site.common import _memoize
+from janitor.site.serve import (
+    LAST_MODIFIED_MIN_AGE,
+    ResponseCache,
+    compute_etag,
+    conditional_middleware,
+    create_app,
+    etag_matches,
+    )
+from janitor.state import (
+    decode_cursor,
+    encode_cursor,
+    queue_cursor,
+    queue_cursor_condition,
+    )
 
 import unittest
 
 
+utc = timezone.utc
+
+
 class FormatDurationTests(unittest.TestCase):
 
     def test_some(self):
@@ -30,3 +76,586 @@ class FormatDurationTests(unittest.TestCase):
         self.assertEqual('1h0m', format_duration(timedelta(hours=1)))
         self.assertEqual('1d1h', format_duration(timedelta(days=1, hours=1)))
         self.assertEqual('2w1d', format_duration(timedelta(weeks=2, days=1)))
+
+
+class MemoizeTests(unittest.TestCase):
+
+    def test_started_once(self):
+        calls = []
+
+        @_memoize
+        async def fetch(name):
+            calls.append(name)
+            await asyncio.sleep(0)
+            return name.upper()
+
+        async def run():
+            # The first call starts the fetch; later calls share it.
+            task = fetch('a')
+            self.assertEqual(['A', 'A', 'B'], [
+                await fetch('a'), await task, await fetch('b')])
+        asyncio.run(run())
+        self.assertEqual(['a', 'b'], calls)
+
+    def test_unused_failure(self):
+        async def run():
+            @_memoize
+            async def fetch():
+                raise ValueError('backend unavailable')
+            # Started, but never awaited.
+            fetch()
+            await asyncio.sleep(0)
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        errors = []
+        loop.set_exception_handler(
+            lambda loop, context: errors.append(context['message']))
+        loop.run_until_complete(run())
+        gc.collect()
+        self.assertEqual([], errors)
+
+
+class ETagTests(unittest.TestCase):
+
+    def test_compute_etag(self):
+        modified = datetime(2021, 1, 1)
+        etag = compute_etag('v1', ['route', '/url'], {'runs': (1, modified)})
+        self.assertTrue(etag.startswith('"') and etag.endswith('"'))
+        self.assertEqual(etag, compute_etag(
+            'v1', ['route', '/url'], {'runs': (1, datetime(2021, 1, 2))}))
+        self.assertNotEqual(etag, compute_etag(
+            'v1', ['route', '/url'], {'runs': (2, modified)}))
+        self.assertNotEqual(etag, compute_etag(
+            'v2', ['route', '/url'], {'runs': (1, modified)}))
+        self.assertNotEqual(etag, compute_etag(
+            'v1', ['route', '/other'], {'runs': (1, modified)}))
+        self.assertNotEqual(etag, compute_etag(
+            'v1', ['route/', 'url'], {'runs': (1, modified)}))
+
+    def test_compute_weak_etag(self):
+        modified = datetime(2021, 1, 1)
+        etag = compute_etag('v1', ['route', '/url'], {'runs': (1, modified)})
+        self.assertEqual('W/' + etag, compute_etag(
+            'v1', ['route', '/url'], {'runs': (1, modified)}, weak=True))
+
+    def test_etag_matches(self):
+        self.assertTrue(etag_matches('"abc"', '"abc"'))
+        self.assertTrue(etag_matches('"x", W/"abc"', '"abc"'))
+        self.assertTrue(etag_matches('"abc"', 'W/"abc"'))
+        self.assertTrue(etag_matches('W/"abc"', 'W/"abc"'))
+        self.assertTrue(etag_matches('*', '"abc"'))
+        self.assertFalse(etag_matches('"abcd"', '"abc"'))
+        self.assertFalse(etag_matches('', '"abc"'))
+
+
+class CursorTests(unittest.TestCase):
+
+    def test_roundtrip(self):
+        cursor = encode_cursor(['2021-01-01T00:00:00', 'some-id'])
+        self.assertNotIn('=', cursor)
+        self.assertEqual(
+            ['2021-01-01T00:00:00', 'some-id'], decode_cursor(cursor))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, decode_cursor, '!!!')
+        self.assertRaises(ValueError, decode_cursor, encode_cursor({}))
+        self.assertRaises(ValueError, decode_cursor, 'bm90IGpzb24')
+
+    def test_queue_cursor_condition(self):
+        args = ['foo']
+        self.assertEqual(
+            "(queue.bucket, queue.priority, queue.id) > "
+            "($2::queue_bucket, $3, $4)",
+            queue_cursor_condition(queue_cursor('default', -10, 42), args))
+        self.assertEqual(['foo', 'default', -10, 42], args)
+
+    def test_queue_cursor_invalid(self):
+        for key in [
+                ['default', 1], ['unknown', 1, 2], [['default'], 1, 2],
+                ['default', 'x', 2], ['default', None, 2],
+                ['default', 2 ** 63, 2], ['default', 1, 2 ** 31],
+                ['default', 1, float('inf')]]:
+            args = []
+            self.assertRaises(
+                ValueError, queue_cursor_condition, encode_cursor(key), args)
+            self.assertEqual([], args)
+
+
+class CircuitBreakerTests(unittest.TestCase):
+
+    def setUp(self):
+        super(CircuitBreakerTests, self).setUp()
+        self.now = 1000.0
+        patcher = mock.patch(
+            'janitor.http_client.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(
+            'backend', failure_threshold=3, reset_timeout=30)
+
+    def open(self):
+        for i in range(3):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open)
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.is_open)
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open)
+        self.assertFalse(self.breaker.allow())
+
+    def test_trial_succeeds(self):
+        self.open()
+        self.now += 29
+        self.assertFalse(self.breaker.allow())
+        self.now += 1
+        self.assertTrue(self.breaker.allow())
+        # Only a single trial request at a time.
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertFalse(self.breaker.is_open)
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+    def test_trial_fails(self):
+        self.open()
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open)
+        self.assertFalse(self.breaker.allow())
+        self.now += 29
+        self.assertFalse(self.breaker.allow())
+        self.now += 1
+        self.assertTrue(self.breaker.allow())
+
+    def test_trial_abandoned(self):
+        self.open()
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.abandon()
+        self.assertTrue(self.breaker.is_open)
+        self.assertTrue(self.breaker.allow())
+
+
+class FakeClientResponse(object):
+
+    def __init__(self, status):
+        self.status = status
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+class FakeClientSession(object):
+    """Client session that returns (or raises) prepared results."""
+
+    def __init__(self, results, timeout=ClientTimeout(total=1)):
+        self.results = list(results)
+        self.timeout = timeout
+        self.requests = []
+
+    async def request(self, method, url, **kwargs):
+        self.requests.append((method, str(url), kwargs))
+        result = self.results.pop(0)
+        if isinstance(result, BaseException):
+            raise result
+        return FakeClientResponse(result)
+
+
+class HttpClientTests(unittest.TestCase):
+
+    def setUp(self):
+        super(HttpClientTests, self).setUp()
+        patcher = mock.patch('janitor.http_client.RETRY_BACKOFF', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, client, method, url='http://differ:9920/x', **kwargs):
+        async def run():
+            async with client.request(method, url, **kwargs) as resp:
+                return resp
+        return asyncio.run(run())
+
+    def test_retry_connection_error(self):
+        session = FakeClientSession([ClientConnectionError(), 200])
+        client = HttpClient(session, retries=2)
+        self.assertEqual(200, self.request(client, 'GET').status)
+        self.assertEqual(2, len(session.requests))
+
+    def test_retry_unavailable(self):
+        session = FakeClientSession([503, 503, 503])
+        client = HttpClient(session, retries=2)
+        resp = self.request(client, 'GET')
+        self.assertEqual(503, resp.status)
+        self.assertEqual(3, len(session.requests))
+        # The outcome of the request as a whole counts as a single failure.
+        backend = client.get_backend(URL('http://differ:9920/'))
+        self.assertEqual(1, backend.breaker.failures)
+
+    def test_no_retry_post(self):
+        session = FakeClientSession([ClientConnectionError(), 200])
+        client = HttpClient(session, retries=2)
+        self.assertRaises(
+            ClientConnectionError, self.request, client, 'POST')
+        self.assertEqual(1, len(session.requests))
+
+    def test_no_retry_streamed_body(self):
+        session = FakeClientSession([503, 200])
+        client = HttpClient(session, retries=2)
+        resp = self.request(client, 'PUT', data=BytesIO(b'body'))
+        self.assertEqual(503, resp.status)
+        self.assertEqual(1, len(session.requests))
+
+    def test_no_retry_timeout(self):
+        session = FakeClientSession([asyncio.TimeoutError(), 200])
+        client = HttpClient(session, retries=2)
+        self.assertRaises(asyncio.TimeoutError, self.request, client, 'GET')
+        self.assertEqual(1, len(session.requests))
+
+    def test_circuit_open(self):
+        session = FakeClientSession([ClientConnectionError(), 200])
+        client = HttpClient(session, retries=0, failure_threshold=1)
+        self.assertRaises(
+            ClientConnectionError, self.request, client, 'GET')
+        self.assertFalse(client.is_available('http://differ:9920/'))
+        self.assertTrue(client.is_available('http://vcs-store:9921/'))
+        self.assertRaises(CircuitOpen, self.request, client, 'GET')
+        self.assertEqual(1, len(session.requests))
+
+    def test_cancelled_trial(self):
+        session = FakeClientSession(
+            [ClientConnectionError(), asyncio.CancelledError(), 200])
+        client = HttpClient(
+            session, retries=0, failure_threshold=1, reset_timeout=0)
+        self.assertRaises(
+            ClientConnectionError, self.request, client, 'GET')
+        self.assertRaises(
+            asyncio.CancelledError, self.request, client, 'GET')
+        # The cancelled trial request doesn't keep the circuit open.
+        self.assertEqual(200, self.request(client, 'GET').status)
+        self.assertTrue(client.is_available('http://differ:9920/'))
+
+    def test_slot_timeout(self):
+        session = FakeClientSession(
+            [200, 200, 200], timeout=ClientTimeout(total=0.1))
+        client = HttpClient(session, concurrency=1)
+
+        async def run():
+            async with client.get('http://differ:9920/a'):
+                with self.assertRaises(asyncio.TimeoutError):
+                    async with client.get('http://differ:9920/b'):
+                        pass
+                async with client.get('http://differ:9920/c', limit=False):
+                    pass
+            async with client.get('http://differ:9920/d'):
+                pass
+        asyncio.run(run())
+        self.assertEqual(
+            ['http://differ:9920/a', 'http://differ:9920/c',
+             'http://differ:9920/d'],
+            [url for (method, url, kwargs) in session.requests])
+        # Waiting for a slot is not a failure of the backend.
+        backend = client.get_backend(URL('http://differ:9920/'))
+        self.assertEqual(0, backend.breaker.failures)
+
+
+class ResponseCacheTests(unittest.TestCase):
+
+    def test_put_get(self):
+        cache = ResponseCache()
+        self.assertIsNone(cache.get('key'))
+        cache.put('key', {'runs'}, web.Response(
+            body=b'page', headers={'Content-Length': '4', 'X-Foo': 'bar'}))
+        entry = cache.get('key')
+        self.assertEqual(b'page', entry.body)
+        self.assertEqual('bar', entry.headers['X-Foo'])
+        self.assertNotIn('Content-Length', entry.headers)
+
+    def test_invalidate(self):
+        cache = ResponseCache()
+        cache.put('a', {'runs', 'package:foo'}, web.Response(body=b'a'))
+        cache.put('b', {'runs', 'package:bar'}, web.Response(body=b'b'))
+        cache.put('c', {'publish'}, web.Response(body=b'c'))
+        generation = cache.generation
+        self.assertEqual(1, cache.invalidate(['package:foo']))
+        self.assertEqual(generation + 1, cache.generation)
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('b'))
+        self.assertEqual(1, cache.invalidate(['runs', 'package:foo']))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(0, cache.invalidate(['runs']))
+
+    def test_evict_least_recently_used(self):
+        cache = ResponseCache(max_size=2)
+        cache.put('a', set(), web.Response(body=b'a'))
+        cache.put('b', set(), web.Response(body=b'b'))
+        cache.get('a')
+        cache.put('c', set(), web.Response(body=b'c'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_expiry(self):
+        cache = ResponseCache(max_age=-1)
+        cache.put('a', {'runs'}, web.Response(body=b'a'))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, cache.invalidate(['runs']))
+
+
+class FakeDatabase(object):
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield None
+
+
+class ConditionalMiddlewareTests(AioHTTPTestCase):
+
+    async def get_application(self):
+        @web.middleware
+        async def user_middleware(request, handler):
+            request.user = request.headers.get('X-User')
+            return await handler(request)
+
+        async def handle(request):
+            self.rendered += 1
+            return web.Response(text='page %d' % self.rendered)
+
+        self.rendered = 0
+        self.versions = {'packages': (1, datetime(2021, 1, 1, tzinfo=utc))}
+        app = web.Application(
+            middlewares=[user_middleware, conditional_middleware])
+        app.database = FakeDatabase()
+        app.site_version = 'v1'
+        app.started = datetime(2021, 1, 1, tzinfo=utc)
+        app.router.add_get('/packages', handle, name='package-list')
+        app.router.add_get(
+            '/pkg/{pkg}', handle, name='generic-package')
+        app.router.add_get('/other', handle, name='other')
+        return app
+
+    async def get_data_versions(self, conn, names):
+        return {
+            name: version for (name, version) in self.versions.items()
+            if name in names}
+
+    def setUp(self):
+        super(ConditionalMiddlewareTests, self).setUp()
+        patcher = mock.patch(
+            'janitor.state.get_data_versions', self.get_data_versions)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_headers(self):
+        resp = await self.client.get('/packages')
+        self.assertEqual(200, resp.status)
+        self.assertTrue(resp.headers['ETag'].startswith('"'))
+        self.assertEqual('max-age=600', resp.headers['Cache-Control'])
+        self.assertEqual(
+            'Fri, 01 Jan 2021 00:00:00 GMT', resp.headers['Last-Modified'])
+        vary = [v.strip() for v in resp.headers['Vary'].split(',')]
+        self.assertIn('Cookie', vary)
+        self.assertIn('Accept-Encoding', vary)
+
+    async def test_if_none_match(self):
+        resp = await self.client.get('/packages')
+        etag = resp.headers['ETag']
+        resp = await self.client.get(
+            '/packages', headers={'If-None-Match': etag})
+        self.assertEqual(304, resp.status)
+        self.assertEqual(etag, resp.headers['ETag'])
+        self.assertEqual('max-age=600', resp.headers['Cache-Control'])
+        self.assertEqual(1, self.rendered)
+        self.versions['packages'] = (2, datetime.now(utc))
+        resp = await self.client.get(
+            '/packages', headers={'If-None-Match': etag})
+        self.assertEqual(200, resp.status)
+        self.assertNotEqual(etag, resp.headers['ETag'])
+        self.assertEqual(2, self.rendered)
+
+    async def test_if_modified_since(self):
+        resp = await self.client.get('/packages', headers={
+            'If-Modified-Since': 'Fri, 01 Jan 2021 00:00:00 GMT'})
+        self.assertEqual(304, resp.status)
+        resp = await self.client.get('/packages', headers={
+            'If-Modified-Since': 'Wed, 30 Dec 2020 00:00:00 GMT'})
+        self.assertEqual(200, resp.status)
+
+    async def test_if_modified_since_recent_change(self):
+        # Changes within LAST_MODIFIED_MIN_AGE may not be visible yet, so
+        # they're only validated by ETag.
+        self.versions['packages'] = (
+            2, datetime.now(utc) - timedelta(
+                seconds=LAST_MODIFIED_MIN_AGE / 2))
+        future = (
+            datetime.now(utc) + timedelta(days=1)).strftime(
+                '%a, %d %b %Y %H:%M:%S GMT')
+        resp = await self.client.get(
+            '/packages', headers={'If-Modified-Since': future})
+        self.assertEqual(200, resp.status)
+        self.assertNotIn('Last-Modified', resp.headers)
+        self.assertIn('ETag', resp.headers)
+
+    async def test_unversioned_weak_etag(self):
+        resp = await self.client.get('/pkg/foo')
+        self.assertEqual(200, resp.status)
+        etag = resp.headers['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertEqual('no-cache', resp.headers['Cache-Control'])
+        resp = await self.client.get(
+            '/pkg/foo', headers={'If-None-Match': etag})
+        self.assertEqual(304, resp.status)
+
+    async def test_logged_in(self):
+        resp = await self.client.get('/packages')
+        etag = resp.headers['ETag']
+        resp = await self.client.get(
+            '/packages', headers={'If-None-Match': etag, 'X-User': 'joe'})
+        self.assertEqual(200, resp.status)
+        self.assertNotIn('ETag', resp.headers)
+        self.assertEqual(2, self.rendered)
+
+    async def test_not_conditional(self):
+        resp = await self.client.get('/other')
+        self.assertEqual(200, resp.status)
+        self.assertNotIn('ETag', resp.headers)
+
+
+# Upper bounds (in seconds) for the startup benchmarks. These are generous,
+# so that the tests don't fail on slow machines; they catch regressions like
+# importing every route module (or breezy) at startup.
+MAX_IMPORT_TIME = 5.0
+MAX_CACHED_TEMPLATE_LOAD_TIME = 2.0
+MAX_CREATE_APP_TIME = 2.0
+
+# Modules that the site should only load once a page needs them.
+LAZY_MODULES = [
+    'janitor.site.lintian_fixes', 'janitor.site.pkg', 'janitor.vcs',
+    'lintian_brush', 'silver_platter']
+
+
+class WorkerCredentialCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        super(WorkerCredentialCacheTests, self).setUp()
+        self.checked = []
+        self.on_check = None
+        patcher = mock.patch(
+            'janitor.state.check_worker_credentials', self.check)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def check(self, conn, login, password):
+        self.checked.append(login)
+        if self.on_check is not None:
+            self.on_check()
+        return (login, password) == ('worker', 'secret')
+
+    def test_not_listening(self):
+        cache = WorkerCredentialCache(FakeDatabase())
+        self.assertTrue(asyncio.run(cache.check('worker', 'secret')))
+        self.assertTrue(asyncio.run(cache.check('worker', 'secret')))
+        self.assertEqual(['worker', 'worker'], self.checked)
+
+    def test_cached(self):
+        cache = WorkerCredentialCache(FakeDatabase())
+        cache.listening = True
+        self.assertTrue(asyncio.run(cache.check('worker', 'secret')))
+        self.assertTrue(asyncio.run(cache.check('worker', 'secret')))
+        self.assertEqual(['worker'], self.checked)
+        self.assertFalse(asyncio.run(cache.check('worker', 'wrong')))
+        self.assertFalse(asyncio.run(cache.check('worker', 'wrong')))
+        self.assertEqual(['worker', 'worker', 'worker'], self.checked)
+        cache.invalidate()
+        self.assertTrue(asyncio.run(cache.check('worker', 'secret')))
+        self.assertEqual(4, len(self.checked))
+
+    def test_expired(self):
+        cache = WorkerCredentialCache(FakeDatabase(), ttl=-1)
+        cache.listening = True
+        self.assertTrue(asyncio.run(cache.check('worker', 'secret')))
+        self.assertTrue(asyncio.run(cache.check('worker', 'secret')))
+        self.assertEqual(2, len(self.checked))
+
+    def test_changed_while_checking(self):
+        cache = WorkerCredentialCache(FakeDatabase())
+        cache.listening = True
+        self.on_check = cache.invalidate
+        self.assertTrue(asyncio.run(cache.check('worker', 'secret')))
+        self.on_check = None
+        self.assertTrue(asyncio.run(cache.check('worker', 'secret')))
+        self.assertTrue(asyncio.run(cache.check('worker', 'secret')))
+        self.assertEqual(2, len(self.checked))
+
+
+class StartupTests(unittest.TestCase):
+
+    def test_import_time(self):
+        script = """\
+import sys, time
+start = time.perf_counter()
+import janitor.site.serve
+print(time.perf_counter() - start)
+for name in %r:
+    if name in sys.modules:
+        print(name)
+""" % (LAZY_MODULES, )
+        output = subprocess.check_output(
+            [sys.executable, '-c', script],
+            cwd=os.path.join(os.path.dirname(__file__), '..', '..'))
+        lines = output.decode().splitlines()
+        self.assertLess(float(lines[0]), MAX_IMPORT_TIME)
+        self.assertEqual([], lines[1:])
+
+    def test_precompile_templates(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(env.cache.clear)
+        self.addCleanup(setattr, env, 'bytecode_cache', None)
+        setup_template_cache(directory)
+        count = precompile_templates()
+        self.assertEqual(len(env.list_templates()), count)
+        self.assertEqual(count, len(os.listdir(directory)))
+        # A new process starts with an empty in-memory cache, but can load
+        # the compiled templates from the bytecode cache.
+        env.cache.clear()
+        start = time.perf_counter()
+        self.assertEqual(count, precompile_templates())
+        self.assertLess(
+            time.perf_counter() - start, MAX_CACHED_TEMPLATE_LOAD_TIME)
+
+    def test_create_app(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        config = read_config(StringIO("""\
+database_location: "postgresql://localhost/janitor"
+logs_location: "{directory}/logs"
+artifact_location: "{directory}/artifacts"
+suite {{ name: "lintian-fixes" }}
+""".format(directory=directory)))
+        policy_config = read_policy(StringIO(''))
+
+        async def create():
+            start = time.perf_counter()
+            app = create_app(
+                config, policy_config, 'http://localhost:9912/',
+                'http://localhost:9911/', 'http://localhost:9914/',
+                'http://localhost:9921/', 'http://localhost:9920/')
+            duration = time.perf_counter() - start
+            await app.http_client_session.close()
+            return app, duration
+
+        app, duration = asyncio.run(create())
+        self.assertLess(duration, MAX_CREATE_APP_TIME)
+        self.assertIn('generic-package', app.router.named_resources())
+        self.assertIsNone(app.external_url)
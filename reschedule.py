@@ -60,7 +60,9 @@ async def main(db, result_code, rejected, min_age=0):
             packages[package.name] = package
 
         async for run in state.iter_last_runs(
-                conn1, result_code, suite=args.suite):
+                conn1, result_code, suite=args.suite,
+                fields=['package', 'suite', 'command', 'times',
+                        'description', 'review_status']):
             if run.package not in packages:
                 continue
             if rejected and run.review_status != 'rejected':
@@ -1,3 +1,5 @@
+-- Requires PostgreSQL 13 or later, for BEFORE row triggers on partitioned
+-- tables (see run_key below).
 CREATE EXTENSION IF NOT EXISTS debversion;
 CREATE DOMAIN distribution_name AS TEXT check (value similar to '[a-z0-9][a-z0-9+-.]+');
 CREATE TABLE IF NOT EXISTS upstream (
@@ -50,21 +52,58 @@ CREATE TABLE IF NOT EXISTS merge_proposal (
    revision text,
    merged_by text,
    merged_at timestamp,
+   -- When the janitor recorded the current status; set by
+   -- set_merge_proposal_status_changed.
+   status_changed timestamp,
    foreign key (package) references package(name),
    primary key(url)
 );
 CREATE INDEX ON merge_proposal (revision);
 CREATE INDEX ON merge_proposal (url);
+CREATE INDEX ON merge_proposal (status_changed);
+CREATE OR REPLACE FUNCTION set_merge_proposal_status_changed()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS
+$$
+BEGIN
+  IF TG_OP = 'INSERT' OR NEW.status IS DISTINCT FROM OLD.status THEN
+    NEW.status_changed := NOW();
+  END IF;
+  RETURN NEW;
+END;
+$$;
+CREATE TRIGGER set_merge_proposal_status_changed_trigger
+  BEFORE INSERT OR UPDATE OF status
+  ON merge_proposal
+  FOR EACH ROW
+  EXECUTE PROCEDURE set_merge_proposal_status_changed();
 CREATE DOMAIN suite_name AS TEXT check (value similar to '[a-z0-9][a-z0-9+-.]+');
 CREATE TYPE review_status AS ENUM('unreviewed', 'approved', 'rejected');
+-- Runs are partitioned by start time; janitor.run_archive creates new
+-- partitions and moves old ones to cold storage. PostgreSQL requires the
+-- partition key in unique constraints on a partitioned table, so the primary
+-- key of run is (id, start_time) and other tables can not have foreign keys
+-- referencing run (id). Instead, they reference run_key, which has one row
+-- per run and is maintained by triggers on run. This costs an extra index
+-- insert per run, but keeps referential integrity and lets lookups by id
+-- prune the partitions they don't need by looking up the start time first:
+--   SELECT ... FROM run WHERE id = $1 AND
+--     start_time = (SELECT start_time FROM run_key WHERE id = $1)
+-- Note that dropping a partition doesn't fire the triggers, so
+-- janitor.run_archive removes the run_key rows of the runs it archives.
+--
+-- To convert an existing unpartitioned run table, rename it, create the new
+-- table, create partitions for the existing runs with
+-- "python3 -m janitor.run_archive --first-month=YYYY-MM" and then copy the
+-- rows over with INSERT INTO run SELECT * FROM old_run.
 CREATE TABLE IF NOT EXISTS run (
-   id text not null primary key,
+   id text not null,
    command text,
    description text,
-   start_time timestamp,
+   start_time timestamp not null,
    finish_time timestamp,
-   -- Disabled for now: requires postgresql > 12
-   -- duration interval generated always as (finish_time - start_time) stored,
+   duration interval generated always as (finish_time - start_time) stored,
    package text not null,
    -- Debian version text of the built package
    build_version debversion,
@@ -78,7 +117,20 @@ CREATE TABLE IF NOT EXISTS run (
    main_branch_revision text,
    branch_name text,
    revision text,
-   result json,
+   result jsonb,
+   -- Frequently queried fields from result, so that queries don't have to
+   -- parse the JSON of every row. Databases converted with
+   -- janitor.migrate_run_result have regular columns here instead, which are
+   -- maintained by a trigger.
+   result_fixed_lintian_tags jsonb generated always as (
+      jsonb_path_query_array(
+         result, '$.applied[*].fixed_lintian_tags[*]')) stored,
+   result_applied_hint_links jsonb generated always as (
+      jsonb_path_query_array(result, '$."applied-hints"[*].link')) stored,
+   result_upstream_branch_url text generated always as (
+      result->>'upstream_branch_url') stored,
+   result_lintian_brush_version text generated always as (
+      result#>>'{versions,lintian-brush}') stored,
    suite suite_name not null,
    branch_url text,
    logfilenames text[] not null,
@@ -92,10 +144,20 @@ CREATE TABLE IF NOT EXISTS run (
    result_branches result_branch[],
    result_tags result_tag[],
    subpath text,
+   -- Whether all result branches of this run have been pushed or merged.
+   -- Maintained by triggers, see run_is_absorbed.
+   absorbed boolean not null default false,
+   absorbed_at timestamp,
+   primary key (id, start_time),
    foreign key (package) references package(name)
-);
+) PARTITION BY RANGE (start_time);
+-- Catches runs that don't fall in any of the monthly partitions, as well as
+-- runs that were kept when their partition was archived.
+CREATE TABLE IF NOT EXISTS run_default PARTITION OF run DEFAULT;
 CREATE INDEX ON run (package, suite, start_time DESC);
 CREATE INDEX ON run (start_time);
+-- Used by janitor.export to find runs that finished since the last export.
+CREATE INDEX ON run (finish_time);
 CREATE INDEX ON run (suite, start_time);
 CREATE INDEX ON run (package, suite);
 CREATE INDEX ON run (suite);
@@ -103,6 +165,83 @@ CREATE INDEX ON run (build_distribution);
 CREATE INDEX ON run (result_code);
 CREATE INDEX ON run (revision);
 CREATE INDEX ON run (main_branch_revision);
+CREATE INDEX ON run (package, suite, start_time DESC)
+  WHERE result_code = 'success' AND NOT absorbed;
+CREATE INDEX ON run USING gin (result_fixed_lintian_tags);
+CREATE INDEX ON run USING gin (result_applied_hint_links);
+CREATE INDEX ON run (suite, result_lintian_brush_version);
+CREATE TABLE IF NOT EXISTS run_key (
+   id text not null primary key,
+   start_time timestamp not null
+);
+-- To populate run_key for an existing database, run:
+--   INSERT INTO run_key (id, start_time) SELECT id, start_time FROM run;
+CREATE OR REPLACE FUNCTION update_run_key()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS
+$$
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    DELETE FROM run_key WHERE id = OLD.id;
+    RETURN OLD;
+  END IF;
+  IF TG_OP = 'UPDATE' AND OLD.id != NEW.id THEN
+    DELETE FROM run_key WHERE id = OLD.id;
+  END IF;
+  -- Runs that are kept when their partition is archived are inserted again,
+  -- hence the upsert.
+  INSERT INTO run_key (id, start_time) VALUES (NEW.id, NEW.start_time)
+    ON CONFLICT (id) DO UPDATE SET start_time = EXCLUDED.start_time;
+  RETURN NEW;
+END;
+$$;
+-- This is a BEFORE trigger so that run_key is up to date by the time other
+-- triggers on run (and foreign keys on the tables they modify) look at it.
+CREATE TRIGGER update_run_key_trigger
+  BEFORE INSERT OR DELETE OR UPDATE OF id, start_time
+  ON run
+  FOR EACH ROW
+  EXECUTE PROCEDURE update_run_key();
+-- The last run per package/suite. Maintained by triggers, see
+-- refresh_last_runs.
+CREATE TABLE IF NOT EXISTS last_run (
+   package text not null,
+   suite suite_name not null,
+   run_id text not null references run_key (id) on delete cascade,
+   primary key (package, suite)
+);
+CREATE INDEX ON last_run (run_id);
+-- The last run per package/suite that wasn't 'nothing-new-to-do'.
+CREATE TABLE IF NOT EXISTS last_effective_run (
+   package text not null,
+   suite suite_name not null,
+   run_id text not null references run_key (id) on delete cascade,
+   primary key (package, suite)
+);
+CREATE INDEX ON last_effective_run (run_id);
+-- The last effective run per package/suite, if it hasn't been absorbed yet.
+CREATE TABLE IF NOT EXISTS last_unabsorbed_run (
+   package text not null,
+   suite suite_name not null,
+   run_id text not null references run_key (id) on delete cascade,
+   primary key (package, suite)
+);
+CREATE INDEX ON last_unabsorbed_run (run_id);
+-- Summary of runs per package/suite that have been moved to cold storage by
+-- janitor.run_archive.
+CREATE TABLE IF NOT EXISTS archived_run_summary (
+   package text not null,
+   suite suite_name not null,
+   -- Name of the archive the runs were exported to
+   archive text not null,
+   run_count integer not null,
+   success_count integer not null,
+   first_start_time timestamp not null,
+   last_start_time timestamp not null,
+   last_result_code text not null,
+   primary key (package, suite, archive)
+);
 CREATE TYPE publish_mode AS ENUM('push', 'attempt-push', 'propose', 'build-only', 'push-derived', 'skip');
 CREATE TABLE IF NOT EXISTS publish (
    id text not null,
@@ -123,6 +262,33 @@ CREATE TABLE IF NOT EXISTS publish (
 CREATE INDEX ON publish (revision);
 CREATE INDEX ON publish (merge_proposal_url);
 CREATE INDEX ON publish (timestamp);
+
+-- Daily rollups for the graphs on the stats pages, maintained by
+-- janitor.rollup. Since rows for older days are kept, these also cover runs
+-- that have since been archived.
+CREATE TABLE IF NOT EXISTS run_rollup (
+   day date not null,
+   suite suite_name not null,
+   result_code text not null,
+   -- Run duration in seconds, rounded down to a power of two
+   duration_bucket integer not null,
+   count integer not null,
+   primary key (day, suite, result_code, duration_bucket)
+);
+CREATE TABLE IF NOT EXISTS publish_rollup (
+   day date not null,
+   mode publish_mode not null,
+   result_code text not null,
+   count integer not null,
+   primary key (day, mode, result_code)
+);
+CREATE TABLE IF NOT EXISTS merge_proposal_rollup (
+   day date not null,
+   -- Either 'opened' or 'merged'
+   event text not null,
+   count integer not null,
+   primary key (day, event)
+);
 CREATE TYPE queue_bucket AS ENUM(
     'update-existing-mp', 'webhook', 'manual', 'reschedule', 'control', 'update-new-mp', 'default');
 CREATE TABLE IF NOT EXISTS queue (
@@ -180,28 +346,39 @@ CREATE TABLE worker (
    password text not null,
    link text
 );
+-- Notify the site, which caches verified worker credentials, when workers
+-- are added, changed or removed.
+CREATE OR REPLACE FUNCTION notify_worker_change()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS
+$$
+BEGIN
+  PERFORM pg_notify('worker_change', '');
+  RETURN NULL;
+END;
+$$;
+CREATE TRIGGER notify_worker_change_trigger
+  AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+  ON worker
+  FOR EACH STATEMENT
+  EXECUTE PROCEDURE notify_worker_change();
 
 -- The last run per package/suite
 CREATE VIEW last_runs AS
-  SELECT DISTINCT ON (package, suite)
-  *
-  FROM
-  run
-  WHERE NOT EXISTS (SELECT FROM package WHERE name = package and removed)
-  ORDER BY package, suite, start_time DESC;
+  SELECT run.*
+  FROM last_run
+  INNER JOIN run ON run.id = last_run.run_id
+  WHERE NOT EXISTS (SELECT FROM package WHERE name = run.package and removed);
 
 -- The last effective run per package/suite; i.e. the last run that
 -- wasn't an attempt to incrementally improve things that yielded no new
 -- changes.
 CREATE OR REPLACE VIEW last_effective_runs AS
-  SELECT DISTINCT ON (package, suite)
-  *
-  FROM
-  run
-  WHERE
-    NOT EXISTS (SELECT FROM package WHERE name = package and removed) AND
-    result_code != 'nothing-new-to-do'
-  ORDER BY package, suite, start_time DESC;
+  SELECT run.*
+  FROM last_effective_run
+  INNER JOIN run ON run.id = last_effective_run.run_id
+  WHERE NOT EXISTS (SELECT FROM package WHERE name = run.package and removed);
 
 CREATE OR REPLACE VIEW absorbed_revisions AS
    SELECT revision FROM publish WHERE revision IS NOT NULL AND ((mode = 'push' and result_code = 'success') OR (mode = 'propose' AND result_code = 'empty-merge-proposal'))
@@ -209,20 +386,18 @@ CREATE OR REPLACE VIEW absorbed_revisions AS
    SELECT revision FROM merge_proposal WHERE revision IS NOT NULL AND status in ('merged', 'applied');
 
 -- The last "unabsorbed" change. An unabsorbed change is the last change that
--- was not yet merged or pushed.
+-- was not yet merged or pushed; either because it failed, or because one
+-- of its result branch revisions has not been absorbed yet.
 CREATE OR REPLACE VIEW last_unabsorbed_runs AS
-  SELECT * FROM last_effective_runs WHERE
-     -- Either the last run is unabsorbed because it failed:
-     result_code NOT in ('nothing-to-do', 'success')
-     -- or because one of the result branch revisions has not been absorbed yet
-     OR id in (SELECT run_id from new_result_branch WHERE revision NOT IN (SELECT * FROM absorbed_revisions));
+  SELECT run.*
+  FROM last_unabsorbed_run
+  INNER JOIN run ON run.id = last_unabsorbed_run.run_id
+  WHERE NOT EXISTS (SELECT FROM package WHERE name = run.package and removed);
 
 create or replace view suites as select distinct suite as name from run;
 
 CREATE OR REPLACE VIEW absorbed_runs AS
-  SELECT * FROM run WHERE result_code = 'success' and
-  exists (select from new_result_branch WHERE run_id = run.id) and
-  not exists (select from new_result_branch WHERE run_id = run.id AND revision not in (SELECT revision FROM absorbed_revisions));
+  SELECT * FROM run WHERE absorbed;
 
 CREATE OR REPLACE VIEW absorbed_lintian_fixes AS
   select absorbed_runs.*, x.summary, x.description as fix_description, x.certainty, x.fixed_lintian_tags from absorbed_runs, json_to_recordset((result->'applied')::json) as x("summary" text, "description" text, "certainty" text, "fixed_lintian_tags" text[]);
@@ -258,50 +433,53 @@ CREATE TRIGGER drop_candidates_when_removed
   EXECUTE PROCEDURE drop_candidates_for_deleted_packages();
 
 CREATE OR REPLACE VIEW absorbed_multiarch_hints AS
-  select package, id, x->>'binary' as binary, x->>'link'::text as link, x->>'severity' as severity, x->>'source' as source, (x->>'version')::debversion as version, x->'action' as action, x->>'certainty' as certainty from (select package, id, json_array_elements(result->'applied-hints') as x from absorbed_runs where suite = 'multiarch-fixes') as f;
+  select package, id, x->>'binary' as binary, x->>'link'::text as link, x->>'severity' as severity, x->>'source' as source, (x->>'version')::debversion as version, x->'action' as action, x->>'certainty' as certainty from (select package, id, jsonb_array_elements(result->'applied-hints') as x from absorbed_runs where suite = 'multiarch-fixes') as f;
 
 CREATE OR REPLACE VIEW multiarch_hints AS
-  select package, id, x->>'binary' as binary, x->>'link'::text as link, x->>'severity' as severity, x->>'source' as source, (x->>'version')::debversion as version, x->'action' as action, x->>'certainty' as certainty from (select package, id, json_array_elements(result->'applied-hints') as x from run where suite = 'multiarch-fixes') as f;
+  select package, id, x->>'binary' as binary, x->>'link'::text as link, x->>'severity' as severity, x->>'source' as source, (x->>'version')::debversion as version, x->'action' as action, x->>'certainty' as certainty from (select package, id, jsonb_array_elements(result->'applied-hints') as x from run where suite = 'multiarch-fixes') as f;
 
 CREATE TABLE site_session (
   id text primary key,
   timestamp timestamp not null default now(),
   userinfo json
 );
-
-
-CREATE FUNCTION expire_site_session_delete_old_rows() RETURNS trigger
-  LANGUAGE PLPGSQL
-  AS
-$$
-BEGIN
-  DELETE FROM site_session WHERE timestamp < NOW() - INTERVAL '1 week';
-  RETURN NEW;
-END;
-$$;
-
-CREATE TRIGGER expire_site_session_delete_old_rows_trigger
-   AFTER INSERT ON site_session
-   EXECUTE PROCEDURE expire_site_session_delete_old_rows();
+-- Expired sessions are deleted in batches by the runner, see
+-- expire_site_sessions. Existing databases should drop the trigger that
+-- used to do this on every insert:
+--
+--   DROP TRIGGER expire_site_session_delete_old_rows_trigger
+--     ON site_session;
+--   DROP FUNCTION expire_site_session_delete_old_rows();
+CREATE INDEX ON site_session (timestamp);
 
 CREATE VIEW queue_positions AS SELECT
     package,
     suite,
-    row_number() OVER (ORDER BY priority ASC, id ASC) AS position,
-    SUM(estimated_duration) OVER (ORDER BY priority ASC, id ASC)
+    row_number() OVER (ORDER BY bucket ASC, priority ASC, id ASC) AS position,
+    SUM(estimated_duration) OVER (ORDER BY bucket ASC, priority ASC, id ASC)
         - coalesce(estimated_duration, interval '0') AS wait_time
 FROM
     queue
 ORDER BY bucket ASC, priority ASC, id ASC;
 
 CREATE TABLE debian_build (
- run_id text not null references run (id),
+ run_id text not null references run_key (id),
  -- Debian version text of the built package
  version debversion not null,
  -- Distribution the package was built for (e.g. "lintian-fixes")
  distribution text not null,
  source text not null
 );
+CREATE INDEX ON debian_build (run_id);
+
+-- Summary of the build log of a run (see janitor.debian.build_log), stored
+-- by the runner when it imports the logs so that the run pages don't have to
+-- retrieve and parse the log. Runs without a summary (e.g. runs from before
+-- this table existed) are analysed by the site when they are viewed.
+CREATE TABLE build_log_summary (
+ run_id text not null primary key references run_key (id),
+ summary jsonb not null
+);
 
 CREATE TABLE result_branch (
  role text not null,
@@ -311,7 +489,7 @@ CREATE TABLE result_branch (
 );
 
 CREATE TABLE new_result_branch (
- run_id text not null references run (id),
+ run_id text not null references run_key (id),
  role text not null,
  remote_name text,
  base_revision text not null,
@@ -321,6 +499,23 @@ CREATE TABLE new_result_branch (
 
 CREATE INDEX ON new_result_branch (revision);
 
+-- Lintian tags fixed by successful runs, so that the lintian-fixes pages
+-- don't have to dig through the results of all runs. Maintained by store_run
+-- and update_run_result. To populate the table for an existing database,
+-- run:
+--   INSERT INTO run_lintian_fix (run_id, package, tag)
+--   SELECT id, package, jsonb_array_elements_text(result_fixed_lintian_tags)
+--   FROM run WHERE result_code = 'success' ON CONFLICT DO NOTHING;
+CREATE TABLE run_lintian_fix (
+ run_id text not null references run_key (id),
+ package text not null,
+ tag text not null,
+ UNIQUE(run_id, tag)
+);
+
+CREATE INDEX ON run_lintian_fix (tag);
+CREATE INDEX ON run_lintian_fix (package);
+
 CREATE TABLE result_tag (
  actual_name text,
  revision text not null
@@ -373,14 +568,364 @@ CREATE OR REPLACE VIEW publishable AS
    WHERE rb.run_id = run.id AND revision NOT IN (SELECT revision FROM absorbed_revisions)
   ) AS unpublished_branches
 FROM
-  last_effective_runs AS run
+  last_unabsorbed_run AS lur
+-- Joining on package and suite as well as id lets PostgreSQL use the partial
+-- index on unabsorbed successful runs.
+INNER JOIN run ON
+    run.package = lur.package AND run.suite = lur.suite AND
+    run.id = lur.run_id
 INNER JOIN package ON package.name = run.package
 INNER JOIN policy ON
     policy.package = run.package AND policy.suite = run.suite
 WHERE
-  result_code = 'success' AND NOT package.removed;
+  run.result_code = 'success' AND NOT run.absorbed AND NOT package.removed;
 
 CREATE OR REPLACE VIEW publish_ready AS SELECT * FROM publishable WHERE ARRAY_LENGTH(unpublished_branches, 1) > 0;
 
 CREATE VIEW upstream_branch_urls as (
-    select package, result->>'upstream_branch_url' as url from run where suite = 'fresh-snapshots' and result->>'upstream_branch_url' != '') union (select name as package, upstream_branch_url as url from upstream);
+    select package, result_upstream_branch_url as url from run where suite = 'fresh-snapshots' and result_upstream_branch_url != '') union (select name as package, upstream_branch_url as url from upstream);
+
+-- Recompute the last_run, last_effective_run and last_unabsorbed_run entries
+-- for a single package/suite. This only looks at the most recent runs for
+-- the package/suite, so it is cheap regardless of the size of run.
+--
+-- To populate the tables for an existing database, run:
+--   SELECT refresh_run_absorbed(id) FROM run WHERE result_code = 'success';
+--   SELECT refresh_last_runs(package, suite)
+--   FROM (SELECT DISTINCT package, suite FROM run) AS r;
+CREATE OR REPLACE FUNCTION refresh_last_runs(_package text, _suite text)
+  RETURNS VOID
+  LANGUAGE PLPGSQL
+  AS
+$$
+DECLARE
+  _last_run_id text;
+  _last_effective_run_id text;
+  _unabsorbed boolean;
+BEGIN
+  SELECT id INTO _last_run_id FROM run
+    WHERE package = _package AND suite = _suite
+    ORDER BY start_time DESC LIMIT 1;
+  -- Runs that had nothing to do and successful runs without result branches
+  -- have nothing to absorb.
+  SELECT
+    id,
+    result_code NOT IN ('nothing-to-do', 'success') OR (
+      result_code = 'success' AND NOT absorbed AND
+      EXISTS (SELECT FROM new_result_branch rb WHERE rb.run_id = run.id))
+    INTO _last_effective_run_id, _unabsorbed
+    FROM run
+    WHERE package = _package AND suite = _suite AND
+          result_code != 'nothing-new-to-do'
+    ORDER BY start_time DESC LIMIT 1;
+
+  IF _last_run_id IS NULL THEN
+    DELETE FROM last_run WHERE package = _package AND suite = _suite;
+  ELSE
+    INSERT INTO last_run (package, suite, run_id)
+      VALUES (_package, _suite, _last_run_id)
+      ON CONFLICT (package, suite) DO UPDATE SET run_id = EXCLUDED.run_id;
+  END IF;
+
+  IF _last_effective_run_id IS NULL THEN
+    DELETE FROM last_effective_run WHERE package = _package AND suite = _suite;
+  ELSE
+    INSERT INTO last_effective_run (package, suite, run_id)
+      VALUES (_package, _suite, _last_effective_run_id)
+      ON CONFLICT (package, suite) DO UPDATE SET run_id = EXCLUDED.run_id;
+  END IF;
+
+  IF _unabsorbed THEN
+    INSERT INTO last_unabsorbed_run (package, suite, run_id)
+      VALUES (_package, _suite, _last_effective_run_id)
+      ON CONFLICT (package, suite) DO UPDATE SET run_id = EXCLUDED.run_id;
+  ELSE
+    DELETE FROM last_unabsorbed_run WHERE package = _package AND suite = _suite;
+  END IF;
+END;
+$$;
+
+-- Whether a run is absorbed, i.e. it was successful and all of its result
+-- branches have been pushed or merged.
+CREATE OR REPLACE FUNCTION run_is_absorbed(_run_id text, _result_code text)
+  RETURNS boolean
+  LANGUAGE SQL
+  STABLE
+  AS
+$$
+  SELECT _result_code = 'success' AND
+    EXISTS (SELECT FROM new_result_branch WHERE run_id = _run_id) AND
+    NOT EXISTS (
+      SELECT FROM new_result_branch rb
+      WHERE rb.run_id = _run_id AND NOT EXISTS (
+        SELECT FROM absorbed_revisions ar WHERE ar.revision = rb.revision));
+$$;
+
+CREATE OR REPLACE FUNCTION refresh_run_absorbed(_run_id text)
+  RETURNS VOID
+  LANGUAGE PLPGSQL
+  AS
+$$
+BEGIN
+  UPDATE run SET
+    absorbed = NOT absorbed,
+    absorbed_at = CASE WHEN absorbed THEN NULL ELSE NOW() END
+  WHERE id = _run_id
+    AND start_time = (SELECT start_time FROM run_key WHERE id = _run_id)
+    AND absorbed != run_is_absorbed(id, result_code);
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION set_run_absorbed()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS
+$$
+BEGIN
+  IF NEW.absorbed != run_is_absorbed(NEW.id, NEW.result_code) THEN
+    NEW.absorbed := NOT NEW.absorbed;
+    NEW.absorbed_at := CASE WHEN NEW.absorbed THEN NOW() ELSE NULL END;
+  END IF;
+  RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER set_run_absorbed_trigger
+  BEFORE UPDATE OF result_code
+  ON run
+  FOR EACH ROW
+  EXECUTE PROCEDURE set_run_absorbed();
+
+-- Recompute the absorbed flag and last run entries for all runs that
+-- produced a revision.
+CREATE OR REPLACE FUNCTION refresh_last_runs_for_revision(_revision text)
+  RETURNS VOID
+  LANGUAGE PLPGSQL
+  AS
+$$
+DECLARE
+  r RECORD;
+BEGIN
+  FOR r IN
+    SELECT DISTINCT run.id, run.package, run.suite FROM new_result_branch rb
+    INNER JOIN run ON run.id = rb.run_id
+    WHERE rb.revision = _revision
+  LOOP
+    PERFORM refresh_run_absorbed(r.id);
+    PERFORM refresh_last_runs(r.package, r.suite);
+  END LOOP;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION refresh_last_runs_for_run()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS
+$$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    PERFORM refresh_last_runs(OLD.package, OLD.suite);
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    PERFORM refresh_last_runs(NEW.package, NEW.suite);
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER refresh_last_runs_for_run_trigger
+  AFTER INSERT OR DELETE OR UPDATE OF package, suite, start_time, result_code
+  ON run
+  FOR EACH ROW
+  EXECUTE PROCEDURE refresh_last_runs_for_run();
+
+CREATE OR REPLACE FUNCTION refresh_last_runs_for_result_branch()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS
+$$
+DECLARE
+  r RECORD;
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    SELECT id, package, suite INTO r FROM run WHERE id = OLD.run_id
+      AND start_time = (
+        SELECT start_time FROM run_key WHERE id = OLD.run_id);
+  ELSE
+    SELECT id, package, suite INTO r FROM run WHERE id = NEW.run_id
+      AND start_time = (
+        SELECT start_time FROM run_key WHERE id = NEW.run_id);
+  END IF;
+  IF FOUND THEN
+    PERFORM refresh_run_absorbed(r.id);
+    PERFORM refresh_last_runs(r.package, r.suite);
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER refresh_last_runs_for_result_branch_trigger
+  AFTER INSERT OR UPDATE OR DELETE
+  ON new_result_branch
+  FOR EACH ROW
+  EXECUTE PROCEDURE refresh_last_runs_for_result_branch();
+
+-- Publishing or merging a revision can absorb the last run.
+CREATE OR REPLACE FUNCTION refresh_last_runs_for_absorbed_revision()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS
+$$
+BEGIN
+  IF TG_OP = 'UPDATE' AND OLD.revision IS DISTINCT FROM NEW.revision AND
+        OLD.revision IS NOT NULL THEN
+    PERFORM refresh_last_runs_for_revision(OLD.revision);
+  END IF;
+  IF NEW.revision IS NOT NULL THEN
+    PERFORM refresh_last_runs_for_revision(NEW.revision);
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER refresh_last_runs_for_publish_trigger
+  AFTER INSERT
+  ON publish
+  FOR EACH ROW
+  EXECUTE PROCEDURE refresh_last_runs_for_absorbed_revision();
+
+CREATE TRIGGER refresh_last_runs_for_merge_proposal_trigger
+  AFTER INSERT OR UPDATE OF status, revision
+  ON merge_proposal
+  FOR EACH ROW
+  EXECUTE PROCEDURE refresh_last_runs_for_absorbed_revision();
+
+-- Versions of the data shown on the site and the API, from which they derive
+-- ETags (see janitor.site.serve.CONDITIONAL_ROUTES). The names are:
+--  runs, publish, merge-proposals, queue, candidates, packages: any change to
+--    the respective table
+--  suite:<name>: a run or candidate in the suite changed
+--  package:<name>: the package, or one of its runs, publishes, merge
+--    proposals, queue items, candidates or policies changed
+--
+-- The row triggers below only record which names changed. The versions are
+-- bumped when the transaction commits, in a single statement, so that the
+-- rows in data_version (some of which change very often) are only locked
+-- briefly and always in the same order.
+CREATE TABLE data_version (
+   name text not null primary key,
+   version bigint not null default 1,
+   modified timestamptz not null default clock_timestamp()
+);
+
+CREATE OR REPLACE FUNCTION record_data_change()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS
+$$
+DECLARE
+  _names text[] := ARRAY[]::text[];
+  _row jsonb;
+BEGIN
+  IF TG_OP = 'UPDATE' AND OLD IS NOT DISTINCT FROM NEW THEN
+    RETURN NULL;
+  END IF;
+  -- The tables have different columns, so look at the rows as JSON.
+  FOREACH _row IN ARRAY CASE TG_OP
+      WHEN 'INSERT' THEN ARRAY[to_jsonb(NEW)]
+      WHEN 'DELETE' THEN ARRAY[to_jsonb(OLD)]
+      ELSE ARRAY[to_jsonb(OLD), to_jsonb(NEW)] END LOOP
+    _names := _names || CASE TG_ARGV[0]
+      WHEN 'run' THEN ARRAY[
+        'runs', 'suite:' || (_row->>'suite'),
+        'package:' || (_row->>'package')]
+      WHEN 'candidate' THEN ARRAY[
+        'candidates', 'suite:' || (_row->>'suite'),
+        'package:' || (_row->>'package')]
+      WHEN 'package' THEN ARRAY['packages', 'package:' || (_row->>'name')]
+      WHEN 'policy' THEN ARRAY['package:' || (_row->>'package')]
+      ELSE ARRAY[TG_ARGV[0], 'package:' || (_row->>'package')] END;
+  END LOOP;
+  IF to_regclass('pg_temp.changed_data') IS NULL THEN
+    CREATE TEMPORARY TABLE changed_data (name text primary key)
+      ON COMMIT DELETE ROWS;
+  END IF;
+  INSERT INTO changed_data (name)
+    SELECT DISTINCT n FROM unnest(_names) AS n WHERE n IS NOT NULL
+    ON CONFLICT DO NOTHING;
+  PERFORM set_config('janitor.data_changed', 'true', true);
+  RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION bump_data_versions()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS
+$$
+BEGIN
+  -- This runs once for every changed row; the first one does the work.
+  IF current_setting('janitor.data_changed', true) IS DISTINCT FROM 'true'
+  THEN
+    RETURN NULL;
+  END IF;
+  INSERT INTO data_version (name)
+    SELECT name FROM changed_data ORDER BY name
+    ON CONFLICT (name) DO UPDATE SET
+      version = data_version.version + 1, modified = clock_timestamp();
+  TRUNCATE changed_data;
+  PERFORM set_config('janitor.data_changed', 'false', true);
+  RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER record_run_change_trigger
+  AFTER INSERT OR UPDATE OR DELETE ON run
+  FOR EACH ROW EXECUTE PROCEDURE record_data_change('run');
+CREATE TRIGGER record_publish_change_trigger
+  AFTER INSERT OR UPDATE OR DELETE ON publish
+  FOR EACH ROW EXECUTE PROCEDURE record_data_change('publish');
+CREATE TRIGGER record_merge_proposal_change_trigger
+  AFTER INSERT OR UPDATE OR DELETE ON merge_proposal
+  FOR EACH ROW EXECUTE PROCEDURE record_data_change('merge-proposals');
+CREATE TRIGGER record_queue_change_trigger
+  AFTER INSERT OR UPDATE OR DELETE ON queue
+  FOR EACH ROW EXECUTE PROCEDURE record_data_change('queue');
+CREATE TRIGGER record_candidate_change_trigger
+  AFTER INSERT OR UPDATE OR DELETE ON candidate
+  FOR EACH ROW EXECUTE PROCEDURE record_data_change('candidate');
+CREATE TRIGGER record_package_change_trigger
+  AFTER INSERT OR UPDATE OR DELETE ON package
+  FOR EACH ROW EXECUTE PROCEDURE record_data_change('package');
+CREATE TRIGGER record_policy_change_trigger
+  AFTER INSERT OR UPDATE OR DELETE ON policy
+  FOR EACH ROW EXECUTE PROCEDURE record_data_change('policy');
+
+CREATE CONSTRAINT TRIGGER bump_run_versions_trigger
+  AFTER INSERT OR UPDATE OR DELETE ON run
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW EXECUTE PROCEDURE bump_data_versions();
+CREATE CONSTRAINT TRIGGER bump_publish_versions_trigger
+  AFTER INSERT OR UPDATE OR DELETE ON publish
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW EXECUTE PROCEDURE bump_data_versions();
+CREATE CONSTRAINT TRIGGER bump_merge_proposal_versions_trigger
+  AFTER INSERT OR UPDATE OR DELETE ON merge_proposal
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW EXECUTE PROCEDURE bump_data_versions();
+CREATE CONSTRAINT TRIGGER bump_queue_versions_trigger
+  AFTER INSERT OR UPDATE OR DELETE ON queue
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW EXECUTE PROCEDURE bump_data_versions();
+CREATE CONSTRAINT TRIGGER bump_candidate_versions_trigger
+  AFTER INSERT OR UPDATE OR DELETE ON candidate
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW EXECUTE PROCEDURE bump_data_versions();
+CREATE CONSTRAINT TRIGGER bump_package_versions_trigger
+  AFTER INSERT OR UPDATE OR DELETE ON package
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW EXECUTE PROCEDURE bump_data_versions();
+CREATE CONSTRAINT TRIGGER bump_policy_versions_trigger
+  AFTER INSERT OR UPDATE OR DELETE ON policy
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW EXECUTE PROCEDURE bump_data_versions();